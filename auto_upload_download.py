@@ -1,5 +1,6 @@
 import os
 import time
+import argparse
 import requests
 import json
 import shutil
@@ -8,11 +9,26 @@ from pathlib import Path
 import schedule
 import logging
 from urllib.parse import urljoin, quote
+from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
+from urllib3.exceptions import HTTPError as Urllib3Error
 import re
+import random
 import sys
 import io
 import subprocess
+import threading
+import select
+import struct
+import uuid
+import http.server
+import itertools
+import queue
+import hashlib
+import fnmatch
+import base64
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
 # 强制 stdout 和 stderr 使用 UTF-8 编码
 if sys.stdout:
     sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8')
@@ -32,34 +48,812 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# 服务器在最后一个分块合并完成后返回的消息
+UPLOAD_COMPLETE_MESSAGE = '上传并合并完成，已加入转换队列'
+
+# 可直接导出为文本文件的字幕编码: {codec_name: (扩展名, ffmpeg 输出编码)}
+# ASS/SSA 只在 subtitle_keep_ass 开启时保留原格式，默认与其他字幕一样转换为 SRT
+TEXT_SUBTITLE_CODECS = {
+    'subrip': ('srt', 'srt'),
+    'srt': ('srt', 'srt'),
+    'text': ('srt', 'srt'),
+    'mov_text': ('srt', 'srt'),
+    'webvtt': ('srt', 'srt'),
+    'ass': ('ass', 'copy'),
+    'ssa': ('ass', 'ass'),
+}
+
+# 文件名中表示已经是 3D/SBS 视频的标记
+STEREO_3D_NAME_PATTERN = re.compile(r'(?i)(?:^|[\W_])(?:h?sbs|full[\W_]?sbs|half[\W_]?sbs|h?tab|lrf|3d)(?:$|[\W_])')
+
+# 空闲时检查网站转换状态的默认间隔（分钟）
+DEFAULT_DOWNLOAD_CHECK_INTERVAL_MINUTES = 30
+
+# 支持的视频格式
+VIDEO_EXTENSIONS = {'.mp4', '.avi', '.mkv', '.mov', '.wmv', '.flv', '.webm'}
+
+
+def _atomic_write_json(path, data):
+    """先写临时文件再原子替换，避免写入中途崩溃导致文件损坏"""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, indent=4, ensure_ascii=False)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+# 支持校验的摘要算法（RFC 9530 名称 -> hashlib 名称），按优先级排列
+DIGEST_ALGORITHMS = {'sha-512': 'sha512', 'sha-256': 'sha256'}
+
+
+def _parse_digest_header(value):
+    """解析 Repr-Digest/Content-Digest（sha-256=:base64:）或旧式 Digest（SHA-256=base64）响应头，
+    返回优先级最高的 (hashlib 算法名, base64 摘要)，没有支持的算法时返回 None"""
+    if not value:
+        return None
+    digests = {}
+    for item in value.split(','):
+        name, _, encoded = item.strip().partition('=')
+        encoded = encoded.strip().strip(':')
+        if name.lower() in DIGEST_ALGORITHMS and encoded:
+            digests[name.lower()] = encoded
+    for name, algorithm in DIGEST_ALGORITHMS.items():
+        if name in digests:
+            return algorithm, digests[name]
+    return None
+
+
+def _response_repr_digest(response):
+    """服务器提供的完整文件摘要：Repr-Digest / Digest，未编码的完整（200）响应也可使用 Content-Digest"""
+    headers = response.headers
+    value = headers.get('Repr-Digest') or headers.get('Digest')
+    if not value and response.status_code == 200 and headers.get('Content-Encoding', 'identity') == 'identity':
+        value = headers.get('Content-Digest')
+    return _parse_digest_header(value)
+
+
+class JsonHistoryStore:
+    """整文件 JSON 历史记录（旧版格式）。JSON 文件无法局部更新，每次写入都要重写整个文件，
+    因此 flush_seconds 大于 0 时单条记录的变更由后台定时器合并，距上次写入至少 flush_seconds 秒后一起写入"""
+
+    def __init__(self, path, flush_seconds=0, lock=None):
+        self.path = path
+        self.flush_seconds = flush_seconds
+        self._lock = lock or threading.RLock()  # 与修改历史记录的代码共用，写入时内容不会变化
+        self._dirty = None  # 有尚未写入的变更时为对应的历史记录
+        self._timer = None
+        self._written_at = 0.0
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def load(self):
+        """返回 {section: {key: record}}，文件不存在时返回 None"""
+        if not self.exists():
+            return None
+        with open(self.path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def put(self, history, section, key):
+        self._schedule(history)
+
+    def delete(self, history, section, key):
+        self._schedule(history)
+
+    def _schedule(self, history):
+        if self.flush_seconds <= 0:
+            self.save_all(history)
+            return
+        with self._lock:
+            self._dirty = history
+            if self._timer is None:
+                delay = max(0.0, self._written_at + self.flush_seconds - time.monotonic())
+                # 非守护线程：进程正常退出前仍会写入最后的变更
+                self._timer = threading.Timer(delay, self.flush)
+                self._timer.start()
+
+    def flush(self):
+        """写入尚未写入的变更"""
+        with self._lock:
+            self._timer = None
+            if self._dirty is not None:
+                try:
+                    self.save_all(self._dirty)
+                except Exception as e:
+                    logger.error(f"保存历史记录失败: {e}")
+
+    def save_all(self, history):
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            _atomic_write_json(self.path, history)
+            self._dirty = None
+            self._written_at = time.monotonic()
+
+    def close(self):
+        self.flush()
+
+
+class JournalHistoryStore:
+    """追加写日志历史记录：每次变更追加一行，定期压缩为快照"""
+
+    def __init__(self, path, compact_every=1000, fsync=True):
+        self.path = path
+        self.compact_every = compact_every
+        self.fsync = fsync
+        self._pending_records = 0  # 自上次压缩以来追加的记录数
+        self._file = None
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def load(self):
+        """重放日志得到历史记录，文件不存在时返回 None"""
+        if not self.exists():
+            return None
+        history = {}
+        line_count = 0
+        damaged = False
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line_no, line in enumerate(f, 1):
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    op = json.loads(line)
+                except json.JSONDecodeError:
+                    # 崩溃时最后一行可能只写了一半，忽略即可
+                    logger.warning(f"历史日志第 {line_no} 行不完整，已忽略: {self.path}")
+                    damaged = True
+                    continue
+                section = history.setdefault(op['section'], {})
+                if op.get('op') == 'del':
+                    section.pop(op['key'], None)
+                else:
+                    section[op['key']] = op['value']
+                line_count += 1
+        self._pending_records = line_count
+        if damaged:
+            # 立即重写日志去掉不完整的行，否则之后追加的记录会接在半行后面，下次加载时一起被忽略
+            self.save_all(history)
+        return history
+
+    def _append(self, op):
+        if self._file is None:
+            self._file = open(self.path, 'a', encoding='utf-8')
+            # 上次写入可能在行尾换行符之前中断，先补上换行，保证新记录独占一行
+            if self._file.tell() > 0:
+                with open(self.path, 'rb') as f:
+                    f.seek(-1, os.SEEK_END)
+                    if f.read(1) != b'\n':
+                        self._file.write('\n')
+        self._file.write(json.dumps(op, ensure_ascii=False) + '\n')
+        self._file.flush()
+        if self.fsync:
+            os.fsync(self._file.fileno())
+        self._pending_records += 1
+
+    def put(self, history, section, key):
+        self._append({'op': 'put', 'section': section, 'key': key, 'value': history[section][key]})
+        self._maybe_compact(history)
+
+    def delete(self, history, section, key):
+        self._append({'op': 'del', 'section': section, 'key': key})
+        self._maybe_compact(history)
+
+    def _maybe_compact(self, history):
+        record_count = sum(len(records) for records in history.values())
+        # 日志行数远多于有效记录数时才压缩
+        if self._pending_records - record_count >= self.compact_every:
+            self.save_all(history)
+
+    def save_all(self, history):
+        """将当前完整状态写为新日志（压缩），原子替换旧文件"""
+        self.close()
+        tmp_path = f"{self.path}.tmp"
+        count = 0
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            for section, records in history.items():
+                for key, value in records.items():
+                    f.write(json.dumps({'op': 'put', 'section': section, 'key': key, 'value': value}, ensure_ascii=False) + '\n')
+                    count += 1
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        self._pending_records = count
+        logger.info(f"历史日志已压缩: {self.path} ({count} 条记录)")
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class SqliteHistoryStore:
+    """SQLite 历史记录：每条记录一行，按主键原子 upsert"""
+
+    def __init__(self, path, compact_every=1000):
+        import sqlite3
+        self.path = path
+        self.compact_every = compact_every
+        self._writes_since_checkpoint = 0
+        self._existed = os.path.exists(path)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS history ('
+            'section TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, '
+            'PRIMARY KEY (section, key))'
+        )
+        self._conn.commit()
+
+    def exists(self):
+        return self._existed
+
+    def load(self):
+        if not self._existed:
+            return None
+        history = {}
+        for section, key, value in self._conn.execute('SELECT section, key, value FROM history'):
+            history.setdefault(section, {})[key] = json.loads(value)
+        return history
+
+    def put(self, history, section, key):
+        with self._conn:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO history (section, key, value) VALUES (?, ?, ?)',
+                (section, key, json.dumps(history[section][key], ensure_ascii=False))
+            )
+        self._maybe_checkpoint()
+
+    def delete(self, history, section, key):
+        with self._conn:
+            self._conn.execute('DELETE FROM history WHERE section = ? AND key = ?', (section, key))
+        self._maybe_checkpoint()
+
+    def _maybe_checkpoint(self):
+        self._writes_since_checkpoint += 1
+        if self._writes_since_checkpoint >= self.compact_every:
+            # 定期把 WAL 合并回主库，防止 WAL 文件无限增长
+            self._conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+            self._writes_since_checkpoint = 0
+
+    def save_all(self, history):
+        with self._conn:
+            self._conn.execute('DELETE FROM history')
+            self._conn.executemany(
+                'INSERT INTO history (section, key, value) VALUES (?, ?, ?)',
+                [(section, key, json.dumps(value, ensure_ascii=False))
+                 for section, records in history.items() for key, value in records.items()]
+            )
+        self._existed = True
+
+    def close(self):
+        self._conn.close()
+
+
+class InotifyWatcher:
+    """基于 Linux inotify 的文件夹监听，通过 ctypes 直接调用 libc，无需额外依赖"""
+
+    IN_CLOSE_WRITE = 0x00000008  # 以写方式打开的文件被关闭
+    IN_MOVED_TO = 0x00000080  # 文件被移动/重命名到监听的文件夹中
+    IN_CREATE = 0x00000100  # 在监听的文件夹中新建了文件或子文件夹
+    IN_Q_OVERFLOW = 0x00004000  # 事件队列溢出，可能丢失了事件
+    IN_ISDIR = 0x40000000
+    IN_CLOEXEC = 0o2000000
+    _EVENT_HEADER = struct.Struct('iIII')  # wd, mask, cookie, len
+
+    def __init__(self):
+        import ctypes
+        import ctypes.util
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self._fd = self._libc.inotify_init1(self.IN_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 失败')
+        self._watches = {}  # {wd: 文件夹路径}
+
+    @staticmethod
+    def is_supported():
+        return sys.platform.startswith('linux')
+
+    def add_watch(self, folder_path, watch_subdirs=False):
+        """watch_subdirs 为 True 时同时报告新建的子文件夹（递归监听时使用）"""
+        import ctypes
+        mask = self.IN_CLOSE_WRITE | self.IN_MOVED_TO
+        if watch_subdirs:
+            mask |= self.IN_CREATE
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(folder_path), mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), f'inotify_add_watch 失败: {folder_path}')
+        self._watches[wd] = folder_path
+
+    def read_events(self, timeout):
+        """等待最多 timeout 秒，返回 (文件夹路径, 名称, mask) 列表（子文件夹事件带 IN_ISDIR）；
+        队列溢出时返回 (None, None, IN_Q_OVERFLOW)"""
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        if not readable:
+            return []
+        buffer = os.read(self._fd, 64 * 1024)
+        events = []
+        offset = 0
+        while offset + self._EVENT_HEADER.size <= len(buffer):
+            wd, mask, _cookie, name_len = self._EVENT_HEADER.unpack_from(buffer, offset)
+            offset += self._EVENT_HEADER.size
+            name = buffer[offset:offset + name_len].rstrip(b'\0')
+            offset += name_len
+            if mask & self.IN_Q_OVERFLOW:
+                events.append((None, None, mask))
+            elif wd in self._watches and name:
+                events.append((self._watches[wd], os.fsdecode(name), mask))
+        return events
+
+    def close(self):
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+
+class RateLimiter:
+    """令牌桶限速器，多个线程共享同一个实例即限制它们的总速率；rate 为 0 时不限速。
+    速率可以随时修改，正在等待的线程最多 1 秒后按新速率继续"""
+
+    def __init__(self, rate=0, burst_seconds=1.0):
+        self._lock = threading.Lock()
+        self.burst_seconds = burst_seconds
+        self.rate = 0.0  # 字节/秒
+        self._tokens = 0.0
+        self._updated = time.monotonic()
+        self.set_rate(rate)
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.rate * self.burst_seconds, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def set_rate(self, rate):
+        with self._lock:
+            self._refill()
+            self.rate = max(0.0, float(rate or 0))
+            if self.rate <= 0:
+                self._tokens = 0.0  # 不限速时清空欠账，等待中的线程立即继续
+
+    def block_size(self, size):
+        """限速时每次读写的块大小（约 1/4 秒的流量），避免一次性突发大块数据"""
+        rate = self.rate
+        if rate <= 0:
+            return size
+        return max(64 * 1024, min(size, int(rate / 4)))
+
+    def consume(self, amount):
+        """取走 amount 个令牌，令牌不足时（允许先欠账）等待补足"""
+        if self.rate <= 0:
+            return
+        with self._lock:
+            self._refill()
+            self._tokens -= amount
+        while True:
+            with self._lock:
+                if self.rate <= 0:
+                    return
+                self._refill()
+                if self._tokens >= 0:
+                    return
+                wait = min(1.0, -self._tokens / self.rate)
+            time.sleep(wait)
+
+
+class FileChunk:
+    """源文件中的一个分块区间（只记录位置，不持有数据）"""
+
+    def __init__(self, file_obj, file_lock, offset, length):
+        self.file_obj = file_obj
+        self.file_lock = file_lock
+        self.offset = offset
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def prefetch(self):
+        """提示操作系统预读该区间（仅支持 posix_fadvise 的平台），不占用进程内存"""
+        if hasattr(os, 'posix_fadvise'):
+            try:
+                os.posix_fadvise(self.file_obj.fileno(), self.offset, self.length, os.POSIX_FADV_WILLNEED)
+            except OSError:
+                pass
+
+
+class StreamingMultipartBody:
+    """流式 multipart/form-data 请求体：表单字段预先编码，文件块部分在发送时
+    分段读入一个可复用的小缓冲区，内存占用与分块大小无关"""
+
+    def __init__(self, fields, file_field, file_name, chunk, block_size=256 * 1024, limiter=None):
+        boundary = uuid.uuid4().hex
+        self.content_type = f'multipart/form-data; boundary={boundary}'
+        head = b''
+        for name, value in fields.items():
+            head += (f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n'
+                     f'{value}\r\n').encode('utf-8')
+        head += (f'--{boundary}\r\nContent-Disposition: form-data; name="{file_field}"; '
+                 f'filename="{file_name}"\r\n\r\n').encode('utf-8')
+        self._head = head
+        self._tail = f'\r\n--{boundary}--\r\n'.encode('utf-8')
+        self._chunk = chunk
+        self._buffer = bytearray(block_size)
+        self._limiter = limiter  # 上传限速（RateLimiter），按实际读出的文件数据计数
+        self._pos = 0  # 整个请求体中的读取位置
+        self.len = len(head) + chunk.length + len(self._tail)
+
+    def __len__(self):
+        return self.len
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.len
+        head_len = len(self._head)
+        body_end = head_len + self._chunk.length
+        if self._pos < head_len:
+            data = self._head[self._pos:self._pos + size]
+        elif self._pos < body_end:
+            offset = self._pos - head_len
+            n = min(size, len(self._buffer), self._chunk.length - offset)
+            if self._limiter is not None:
+                n = self._limiter.block_size(n)
+            view = memoryview(self._buffer)[:n]
+            file_offset = self._chunk.offset + offset
+            if hasattr(os, 'preadv'):
+                # 按位置读取，不移动共享文件句柄的指针，无需加锁
+                n = os.preadv(self._chunk.file_obj.fileno(), [view], file_offset)
+            else:
+                with self._chunk.file_lock:
+                    self._chunk.file_obj.seek(file_offset)
+                    n = self._chunk.file_obj.readinto(view)
+            if not n:
+                raise IOError(f"源文件在上传过程中被截断 (偏移 {file_offset})")
+            if self._limiter is not None:
+                self._limiter.consume(n)
+            # 缓冲区在下一次 read 时才会被覆盖，发送方此前已写完当前数据，可以直接返回视图
+            data = view[:n]
+        elif self._pos < self.len:
+            data = self._tail[self._pos - body_end:self._pos - body_end + size]
+        else:
+            return b''
+        self._pos += len(data)
+        return data
+
+
+class AdaptiveChunkSizer:
+    """根据每个服务器实测的分块耗时和失败率，为下一个文件选择分块大小。
+    服务器要求首块即给出 total_chunks，因此同一文件内分块大小固定，按文件调整。"""
+
+    def __init__(self, initial_size, min_size, max_size, target_seconds=5.0, smoothing=0.3):
+        self.initial_size = initial_size
+        self.min_size = min_size
+        self.max_size = max_size
+        self.target_seconds = target_seconds
+        self.smoothing = smoothing
+        self._stats = {}  # {server_url: {'throughput': 字节/秒, 'failure_rate': 0~1}}
+        self._lock = threading.Lock()
+
+    def record(self, server_url, num_bytes, seconds, success):
+        """记录一次分块发送的结果（指数加权平均）"""
+        with self._lock:
+            stats = self._stats.setdefault(server_url, {'throughput': None, 'failure_rate': 0.0})
+            a = self.smoothing
+            stats['failure_rate'] = (1 - a) * stats['failure_rate'] + a * (0.0 if success else 1.0)
+            if success and seconds > 0:
+                throughput = num_bytes / seconds
+                if stats['throughput'] is None:
+                    stats['throughput'] = throughput
+                else:
+                    stats['throughput'] = (1 - a) * stats['throughput'] + a * throughput
+
+    def choose(self, server_url):
+        """返回 (分块大小, 选择原因)"""
+        with self._lock:
+            stats = self._stats.get(server_url)
+            if not stats or stats['throughput'] is None:
+                size = self.initial_size
+                reason = '暂无测量数据，使用初始值'
+            else:
+                # 让单个分块的耗时接近目标值：局域网用大块摊薄请求开销，慢速链路用小块减少重传损失
+                size = stats['throughput'] * self.target_seconds
+                reason = f"吞吐 {stats['throughput'] / (1024 * 1024):.1f}MB/s"
+                if stats['failure_rate'] > 0.1:
+                    # 失败率越高，分块越小
+                    size *= max(0.25, 1 - stats['failure_rate'])
+                reason += f"，失败率 {stats['failure_rate']:.0%}"
+        mb = 1024 * 1024
+        size = int(min(self.max_size, max(self.min_size, size)))
+        size = max(mb, size // mb * mb)  # 取整到 1MB
+        return size, reason
+
+
+# 运行中修改配置文件后立即生效的设置
+LIVE_CONFIG_KEYS = ('upload_rate_limit_mb', 'download_rate_limit_mb', 'bandwidth_schedule')
+
+
+# 指标说明: {名称: (类型, 说明)}
+METRIC_DESCRIPTIONS = {
+    'iw3_scan_seconds': ('histogram', '扫描监控文件夹 (find_new_videos) 耗时'),
+    'iw3_new_videos_total': ('counter', '扫描发现的新视频数'),
+    'iw3_probe_seconds': ('histogram', 'ffprobe 媒体探测耗时'),
+    'iw3_upload_chunk_seconds': ('histogram', '单次分块上传请求耗时'),
+    'iw3_upload_bytes_total': ('counter', '上传成功的字节数'),
+    'iw3_upload_seconds': ('histogram', '单个文件上传（含合并）总耗时'),
+    'iw3_status_poll_seconds': ('histogram', '/api/status 请求耗时'),
+    'iw3_conversion_wait_seconds': ('histogram', '从上传完成到开始下载的时间（服务器排队 + 转换）'),
+    'iw3_download_seconds': ('histogram', '单个文件下载耗时'),
+    'iw3_download_bytes_total': ('counter', '下载写入的字节数'),
+    'iw3_download_verify_failures_total': ('counter', '下载大小或摘要校验失败的次数'),
+    'iw3_subtitle_seconds': ('histogram', '单个文件字幕提取耗时'),
+    'iw3_retries_total': ('counter', '按阶段统计的重试次数'),
+    'iw3_job_queue_depth': ('gauge', '本地任务队列中等待提交的任务数'),
+    'iw3_uploads_in_progress': ('gauge', '正在上传的文件数'),
+    'iw3_pending_jobs': ('gauge', '已上传、等待下载的任务数'),
+    'iw3_server_queue_depth': ('gauge', '服务器 /api/status 报告的队列长度'),
+    'iw3_subtitle_queue_depth': ('gauge', '等待提取字幕的任务数'),
+    'iw3_rate_limit_bytes_per_second': ('gauge', '当前生效的上传/下载限速（0 为不限速）'),
+    'iw3_disk_free_bytes': ('gauge', '输出文件夹所在文件系统的剩余空间'),
+    'iw3_disk_committed_bytes': ('gauge', '已上传或正在上传、尚未下载的任务预计占用的输出空间'),
+}
+
+
+class Metrics:
+    """进程内指标（计数器、直方图，以及导出时采集的仪表），以 Prometheus 文本格式导出。
+    未启用时记录方法直接返回，埋点几乎没有开销。"""
+
+    BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600, 7200)
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self._counters = {}  # {(名称, 标签): 值}
+        self._histograms = {}  # {(名称, 标签): [各桶计数..., 总和, 次数]}
+        self._collectors = []  # 导出时调用，返回 [(名称, 标签字典, 值)] 形式的仪表
+        self._lock = threading.Lock()
+
+    def inc(self, name, value=1, **labels):
+        """计数器加 value"""
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        """向直方图记录一次耗时（秒）"""
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [0] * (len(self.BUCKETS) + 2)
+            for i, bound in enumerate(self.BUCKETS):
+                if seconds <= bound:
+                    histogram[i] += 1
+                    break
+            histogram[-2] += seconds
+            histogram[-1] += 1
+
+    def add_collector(self, collector):
+        """注册导出时采集仪表的回调"""
+        self._collectors.append(collector)
+
+    @staticmethod
+    def _format_labels(labels, extra=()):
+        items = list(labels) + list(extra)
+        if not items:
+            return ''
+        escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in items)
+        return '{' + ','.join(f'{key}="{value}"' for (key, _), value in zip(items, escaped)) + '}'
+
+    def render(self):
+        """生成 Prometheus 文本格式"""
+        samples = {}  # {名称: [行]}
+        with self._lock:
+            for (name, labels), value in self._counters.items():
+                samples.setdefault(name, []).append(f"{name}{self._format_labels(labels)} {value}")
+            for (name, labels), histogram in self._histograms.items():
+                lines = samples.setdefault(name, [])
+                cumulative = 0
+                for bound, count in zip(self.BUCKETS, histogram):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{self._format_labels(labels, [('le', bound)])} {cumulative}")
+                lines.append(f"{name}_bucket{self._format_labels(labels, [('le', '+Inf')])} {histogram[-1]}")
+                lines.append(f"{name}_sum{self._format_labels(labels)} {histogram[-2]:.6f}")
+                lines.append(f"{name}_count{self._format_labels(labels)} {histogram[-1]}")
+        for collector in self._collectors:
+            try:
+                for name, labels, value in collector():
+                    samples.setdefault(name, []).append(f"{name}{self._format_labels(sorted(labels.items()))} {value}")
+            except Exception as e:
+                logger.debug(f"采集指标失败: {e}")
+
+        output = []
+        for name in sorted(samples):
+            metric_type, description = METRIC_DESCRIPTIONS.get(name, ('untyped', name))
+            output.append(f"# HELP {name} {description}")
+            output.append(f"# TYPE {name} {metric_type}")
+            output.extend(samples[name])
+        return '\n'.join(output) + '\n'
+
+
+class _MetricsHandler(http.server.BaseHTTPRequestHandler):
+    """提供 /metrics 的 HTTP 处理器，metrics 由 server.metrics 提供"""
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = self.server.metrics.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # 抓取请求频繁，不写入日志
+
+
 class AutoUploadDownload:
     def __init__(self, config_file='auto_config.json'):
         self.config_file = config_file
         self.config = {
             'website_url': 'http://localhost:5000',  # 您的网站地址
+            'servers': [],  # 多个转换服务器 [{'url', 'weight', 'max_concurrent_jobs'}]，为空时只使用 website_url
             'check_interval_minutes': 30,  # 检查间隔（分钟）
-            'download_check_interval_minutes': 30,  # 下载检查间隔（分钟）
+            'download_check_interval_minutes': DEFAULT_DOWNLOAD_CHECK_INTERVAL_MINUTES,  # 下载检查间隔（分钟）
+            'file_stable_seconds': 60,  # 文件大小和修改时间保持不变多少秒后才上传（0 为不检查）
+            'watch_mode': 'auto',  # 新文件检测方式: auto（Linux 上使用 inotify）/ inotify / poll（仅定时扫描）
+            'status_poll_min_seconds': 30,  # 有待转换任务时的状态轮询间隔（秒）
+            'status_long_poll_seconds': 0,  # 状态接口长轮询等待时间（秒），0 为不使用
             'folders_to_monitor': [
                 {
                     'path': 'D:/videos',  # 监控的文件夹路径
                     'additional_args': ''  # 预设参数
                 }
             ],
+            'recursive_scan': False,  # 是否递归扫描子文件夹（可在每个监控文件夹中用 recursive 单独设置），VR 输出文件夹始终跳过
+            'scan_include': [],  # 只上传匹配这些通配符的视频（相对监控文件夹的路径或文件名），为空时不限制
+            'scan_exclude': [],  # 跳过匹配这些通配符的视频和子文件夹
+            'scan_dir_cache': True,  # 记录各文件夹的修改时间，未变化的文件夹不重新列出
             'history_file': 'upload_history.json',  # 历史记录文件
+            'history_backend': 'json',  # 历史记录存储方式: json / journal / sqlite
+            'history_flush_seconds': 5,  # json 后端合并写入的间隔（秒），0 为每次变更立即写入
+            'history_compact_every': 1000,  # journal/sqlite 累计多少次写入后压缩
+            'content_dedup': True,  # 按文件内容指纹去重，重命名/移动/修改时间变化的文件不再重复上传
+            'fingerprint_mode': 'sampled',  # 内容指纹方式: sampled（抽样头/中/尾）/ full（完整读取）
+            'fingerprint_sample_kb': 1024,  # sampled 模式下每个抽样块的大小（KB）
+            'upload_concurrency': 2,  # 同时上传的文件数
+            'max_uploads_per_server': 2,  # 单个服务器同时上传的文件数上限
+            'upload_chunk_size_mb': 10,  # 初始分块大小（MB）
+            'min_chunk_size_mb': 2,  # 自适应分块大小下限（MB）
+            'max_chunk_size_mb': 64,  # 自适应分块大小上限（MB）
+            'adaptive_chunk_size': True,  # 是否按实测吞吐和失败率自动调整分块大小
+            'target_chunk_seconds': 5,  # 自适应模式下单个分块的目标上传耗时（秒）
+            'upload_streaming': True,  # 分块从源文件边读边发，不把整个分块读入内存
+            'upload_pipeline_mode': 'readahead',  # 分块发送方式: sequential / readahead / parallel
+            'upload_inflight_chunks': 4,  # parallel 模式下同时在途的分块数
+            'upload_resume': True,  # 是否保存分块进度以便中断后续传
+            'upload_progress_save_seconds': 10,  # 续传进度最短保存间隔（秒）
+            'upload_status_endpoint': '/api/upload_status',  # 查询已接收分块的接口（服务器不支持时使用本地记录）
+            'download_buffer_size_mb': 4,  # 下载写入缓冲区大小（MB）
+            'download_preallocate': True,  # 下载前预分配目标文件空间
+            'download_segments': 1,  # 服务器支持 Range 时并发下载的分段数（1 为单连接）
+            'download_min_segment_mb': 32,  # 每个下载分段的最小大小（MB）
+            'download_verify': True,  # 服务器提供摘要（Repr-Digest/Content-Digest）时校验下载的文件
+            'upload_rate_limit_mb': 0,  # 所有上传的总速率上限（MB/s），0 为不限速
+            'download_rate_limit_mb': 0,  # 所有下载的总速率上限（MB/s），0 为不限速
+            'disk_reserve_gb': 2,  # 输出文件夹所在磁盘至少保留的剩余空间（GB），空间不足时推迟下载并暂停提交上传，0 为不检查
+            'output_size_factor': 2.0,  # 预计转换结果大小 = 原视频大小 × 此系数（SBS 输出约为原视频的 2 倍）
+            'after_download_action': 'keep',  # 下载并校验完成后原始视频的处理: keep / delete / move（可在每个监控文件夹中单独设置）
+            'after_download_move_to': '',  # move 时原始视频移动到的文件夹（保留相对监控文件夹的路径）
+            'bandwidth_schedule': [],  # 按时间段限速 [{'start': '08:00', 'end': '23:00', 'upload_rate_limit_mb': 2, 'download_rate_limit_mb': 2}]
+            'media_probe': True,  # 上传前用 ffprobe 探测视频信息（按内容指纹缓存）
+            'media_probe_timeout_seconds': 60,  # 单次 ffprobe 探测的最长运行时间（秒）
+            'skip_3d_sources': True,  # 跳过已经是 3D/SBS 的视频
+            'skip_3d_by_filename': False,  # 只凭文件名中的 SBS/TAB/3D 等标记也跳过
+            'upload_order': 'priority',  # 同一优先级内的上传顺序: shortest_first（时长短的先传，priority 为其别名）/ newest_first / scan
+            'max_in_flight_per_server': 3,  # 每个服务器已上传未下载 + 正在上传的任务数上限，0 为不限制
+            'fresh_reserved_slots': 1,  # 上述名额中只留给新剧集的数量
+            'pending_expiry_hours': 24,  # 已上传超过多少小时仍未转换完成的任务不再占用上述名额，0 为不过期
+            'fresh_hours': 48,  # 修改时间在多少小时内的视频视为新剧集（优先上传）
+            'subtitle_extraction': True,  # 下载完成后在后台提取原始视频的内封文本字幕
+            'subtitle_keep_ass': False,  # ASS/SSA 字幕保留原格式（.ass），默认转换为 .srt
+            'subtitle_workers': 1,  # 同时运行的 ffmpeg 字幕提取进程数
+            'subtitle_queue_size': 64,  # 字幕提取队列长度，队列满时任务留待下次扫描
+            'subtitle_timeout_seconds': 3600,  # 单个文件 ffprobe/ffmpeg 的最长运行时间（秒）
+            'metrics_port': 0,  # 指标 HTTP 接口端口（/metrics，Prometheus 格式），0 为不启用
+            'metrics_bind': '127.0.0.1',  # 指标 HTTP 接口监听地址
+            'metrics_textfile': '',  # 定期写入指标的文件路径（node_exporter textfile collector），为空不写入
+            'metrics_textfile_seconds': 15,  # 指标文件写入间隔（秒）
+            'http_pool_size': 16,  # 每个服务器的 HTTP 连接池大小
+            'http_retry_total': 3,  # 连接失败、502/503/504 等由连接池自动重试的次数
+            'http_retry_backoff': 1.0,  # 连接池自动重试的退避系数（秒）
             'max_retries': 5,  # 最大重试次数
-            'retry_delay': 10  # 重试延迟（秒）
+            'retry_delay': 10,  # 重试延迟（秒），多次重试时按指数增长并加入随机抖动
+            'retry_max_delay': 300  # 单次重试等待的上限（秒）
         }
         
         # 加载配置
+        self._live_config_defaults = {key: self.config[key] for key in LIVE_CONFIG_KEYS}
+        self._config_mtime = None
         self.load_config()
         
-        # 加载历史记录
-        self.history = self.load_history()
+        # 多个上传线程共享历史记录，所有修改都需持有此锁
+        self.history_lock = threading.RLock()
+        self._uploads_in_progress = set()  # 正在上传的文件路径
+        self._server_semaphores = {}  # {server_url: BoundedSemaphore}
+        self._sequential_upload_servers = set()  # 不支持乱序分块、需回退为顺序发送的服务器
+        self._server_uploading = {}  # {server_url: 已分配到该服务器、正在上传的文件数}
+        self._uploading_names = {}  # {(server_url, 服务器上的文件名): 正在上传的原始文件路径}
+        self._name_conflicts = set()  # 已提示过因同名任务而等待的原始文件路径
+        self._server_queue_depth = {}  # {server_url: /api/status 报告的队列长度}
+        self._unmatched_reported = set()  # 已记录过无法匹配的 (server_url, 已转换文件名)
+        self._capped_servers = set()  # 已提示过达到任务上限的服务器
+        self._job_queue = {}  # 本地任务队列 {video_path: video}，按优先级提交
+        self._job_seq = itertools.count()  # 入队顺序
+        self._dispatched_paths = set()  # 已提交到上传线程池、尚未结束的文件路径
+        self._http_sessions = {}  # {server_url: requests.Session}，长期复用连接
+        self._status_check_lock = threading.Lock()  # 防止轮询线程与扫描流程同时检查状态
+        self._poll_wakeup = threading.Event()  # 有新上传时唤醒轮询线程
+        self._stop_event = threading.Event()
+        self._poller_thread = None
+        self._watcher_thread = None
+        self._upload_executor = None  # 本地任务队列提交上传使用的线程池
+        self._subtitle_queue = None  # 字幕提取任务队列（有界），由后台线程消费
+        self._subtitle_threads = []
+        self._subtitle_stop = threading.Event()
+        self._subtitle_queued = set()  # 已排队或正在提取字幕的原始视频路径
+        self._tool_paths = {}  # {ffmpeg/ffprobe: 可执行文件路径或 None}
+        self._metrics_server = None
+        self._metrics_writer = None
+        self._skipped_3d = set()  # 已提示过跳过的 3D/SBS 视频
+        self._name_only_3d = set()  # 已提示过只有文件名像 3D、仍照常转换的视频
+        self._file_stability = {}  # {path: (size, mtime, 首次见到该状态的时间)}
+        self._stability_timers = {}  # {path: threading.Timer}，监听模式下等待文件写完
+        self._volume_of = {}  # {文件夹: 所在文件系统的 st_dev}
+        self._output_estimates = {}  # {原视频路径: (st_dev, 预计输出大小)}
+        self._disk_blocked = set()  # 因空间不足暂停提交上传的文件系统
+        self._disk_deferred = set()  # 因空间不足推迟下载的文件名
+        self._deferred_records = set()  # json 后端尚未写入的缓存记录 {(section, key)}
+        self._deferred_since = None  # 最早一条未写入的缓存记录产生的时间
+        
+        mb = 1024 * 1024
+        self.chunk_sizer = AdaptiveChunkSizer(
+            initial_size=int(self.config.get('upload_chunk_size_mb', 10) * mb),
+            min_size=int(self.config.get('min_chunk_size_mb', 2) * mb),
+            max_size=int(self.config.get('max_chunk_size_mb', 64) * mb),
+            target_seconds=self.config.get('target_chunk_seconds', 5)
+        )
+        
+        # 上传/下载限速，所有并发传输共享；速率按 bandwidth_schedule 的时间段定期更新
+        self.upload_limiter = RateLimiter()
+        self.download_limiter = RateLimiter()
+        self._rate_limits = None
+        self._schedule_warned = set()
+        self.refresh_rate_limits()
+        
+        # 各阶段耗时、字节数和重试次数；未配置导出方式时不记录
+        self.metrics = Metrics(enabled=bool(self.config.get('metrics_port') or self.config.get('metrics_textfile')))
+        self.metrics.add_collector(self._collect_metrics)
         
         # 确保历史文件夹存在
         history_dir = os.path.dirname(self.config['history_file'])
         if history_dir:
             os.makedirs(history_dir, exist_ok=True)
+        
+        # 初始化历史记录存储后端并加载历史记录
+        self.history_store = self.create_history_store()
+        self.history = self.load_history()
+        
+        # 构建历史记录内存索引（file_hash / 文件名 -> 路径），避免每次线性扫描
+        self._rebuild_history_index()
     
     def load_config(self):
         """加载配置文件"""
@@ -70,6 +864,7 @@ class AutoUploadDownload:
                     # 合并配置，保留默认值
                     for key, value in loaded_config.items():
                         self.config[key] = value
+                self._config_mtime = os.stat(self.config_file).st_mtime_ns
                 logger.info(f"已加载配置文件: {self.config_file}")
             else:
                 # 创建默认配置文件
@@ -78,6 +873,26 @@ class AutoUploadDownload:
         except Exception as e:
             logger.error(f"加载配置文件失败: {e}")
     
+    def reload_live_config(self):
+        """配置文件修改后重新读取可在运行中调整的设置（LIVE_CONFIG_KEYS），其余设置仍需重启生效"""
+        try:
+            mtime = os.stat(self.config_file).st_mtime_ns
+        except OSError:
+            return False
+        if mtime == self._config_mtime:
+            return False
+        try:
+            with open(self.config_file, 'r', encoding='utf-8') as f:
+                loaded_config = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.error(f"重新加载配置文件失败: {e}")
+            return False
+        self._config_mtime = mtime
+        for key in LIVE_CONFIG_KEYS:
+            self.config[key] = loaded_config.get(key, self._live_config_defaults[key])
+        logger.info(f"配置文件已修改，已重新加载限速设置: {self.config_file}")
+        return True
+    
     def save_config(self):
         """保存配置文件"""
         try:
@@ -87,18 +902,45 @@ class AutoUploadDownload:
         except Exception as e:
             logger.error(f"保存配置文件失败: {e}")
     
+    def create_history_store(self):
+        """根据配置创建历史记录存储后端"""
+        backend = self.config.get('history_backend', 'json')
+        json_path = self.config['history_file']
+        base_path = os.path.splitext(json_path)[0]
+        compact_every = self.config.get('history_compact_every', 1000)
+        
+        if backend == 'journal':
+            store = JournalHistoryStore(f"{base_path}.journal", compact_every=compact_every)
+        elif backend == 'sqlite':
+            store = SqliteHistoryStore(f"{base_path}.db", compact_every=compact_every)
+        else:
+            if backend != 'json':
+                logger.warning(f"未知的历史记录存储方式 '{backend}'，使用 json")
+            return JsonHistoryStore(json_path, flush_seconds=self.config.get('history_flush_seconds', 5),
+                                    lock=self.history_lock)
+        
+        # 一次性迁移：新后端尚无数据而旧 JSON 文件存在时导入
+        if not store.exists() and os.path.exists(json_path):
+            try:
+                legacy_history = JsonHistoryStore(json_path).load()
+                store.save_all(legacy_history)
+                os.replace(json_path, f"{json_path}.migrated")
+                logger.info(f"已将历史记录从 {json_path} 迁移到 {backend} 存储（原文件已重命名为 .migrated）")
+            except Exception as e:
+                logger.error(f"迁移历史记录失败: {e}")
+        return store
+    
     def load_history(self):
         """加载历史记录"""
         try:
-            if os.path.exists(self.config['history_file']):
-                with open(self.config['history_file'], 'r', encoding='utf-8') as f:
-                    history = json.load(f)
-                    # 确保所有必要的键都存在
-                    if 'uploaded_files' not in history:
-                        history['uploaded_files'] = {}
-                    if 'downloaded_files' not in history:
-                        history['downloaded_files'] = {}
-                    return history
+            history = self.history_store.load()
+            if history is not None:
+                # 确保所有必要的键都存在
+                if 'uploaded_files' not in history:
+                    history['uploaded_files'] = {}
+                if 'downloaded_files' not in history:
+                    history['downloaded_files'] = {}
+                return history
             else:
                 # 创建默认历史记录
                 history = {
@@ -115,22 +957,231 @@ class AutoUploadDownload:
             }
     
     def save_history(self, history=None):
-        """保存历史记录"""
+        """完整保存历史记录（journal 后端即为压缩）"""
         try:
             if history is None:
                 history = self.history
-            with open(self.config['history_file'], 'w', encoding='utf-8') as f:
-                json.dump(history, f, indent=4, ensure_ascii=False)
-            logger.info(f"历史记录已保存到: {self.config['history_file']}")
+            with self.history_lock:
+                self.history_store.save_all(history)
+            logger.info(f"历史记录已保存 ({self.config.get('history_backend', 'json')})")
         except Exception as e:
             logger.error(f"保存历史记录失败: {e}")
     
+    def save_history_record(self, section, key):
+        """只持久化单条历史记录的变更，写入量与变更大小成正比"""
+        try:
+            with self.history_lock:
+                if key in self.history[section]:
+                    self.history_store.put(self.history, section, key)
+                else:
+                    self.history_store.delete(self.history, section, key)
+            logger.debug(f"历史记录已更新: {section}/{key}")
+        except Exception as e:
+            logger.error(f"保存历史记录失败 {section}/{key}: {e}")
+    
+    def save_history_records(self, section, keys):
+        """持久化多条历史记录的变更；json 后端只整体重写一次，不逐条重写"""
+        keys = list(keys)
+        if not keys:
+            return
+        if not isinstance(self.history_store, JsonHistoryStore):
+            for key in keys:
+                self.save_history_record(section, key)
+            return
+        try:
+            with self.history_lock:
+                self.history_store.save_all(self.history)
+            logger.debug(f"历史记录已更新: {section} ({len(keys)} 条)")
+        except Exception as e:
+            logger.error(f"保存历史记录失败 {section}: {e}")
+    
+    def defer_history_record(self, section, key):
+        """持久化缓存类记录（内容指纹等）。json 后端每次写入都要重写整个文件，
+        因此先累积，由 flush_history 在一轮扫描/探测结束时一次写入（最多延迟 60 秒）；其他后端直接写入"""
+        if not isinstance(self.history_store, JsonHistoryStore):
+            self.save_history_record(section, key)
+            return
+        with self.history_lock:
+            self._deferred_records.add((section, key))
+            if self._deferred_since is None:
+                self._deferred_since = time.monotonic()
+            due = time.monotonic() - self._deferred_since >= 60
+        if due:
+            self.flush_history()
+    
+    def flush_history(self):
+        """写入 defer_history_record 累积的记录"""
+        with self.history_lock:
+            if not self._deferred_records:
+                return
+            count = len(self._deferred_records)
+            self._deferred_records.clear()
+            self._deferred_since = None
+            try:
+                self.history_store.save_all(self.history)
+                logger.debug(f"历史记录已更新: 缓存记录 {count} 条")
+            except Exception as e:
+                logger.error(f"保存历史记录失败: {e}")
+    
+    def _rebuild_history_index(self):
+        """根据当前历史记录重建内存索引"""
+        self._hash_index = {}  # {file_hash: full_path}
+        # 以下索引只包含状态为 uploaded、等待下载的记录
+        self._pending_paths = set()
+        self._pending_by_server = {}  # {server_url: set(full_path)}
+        self._pending_by_name = {}  # {(server_url, 服务器上的文件名): set(full_path)}
+        self._pending_by_session = {}  # {(server_url, session_id): full_path}
+        self._fingerprint_index = {}  # {content_fingerprint: full_path}
+        for uploaded_path, info in self.history['uploaded_files'].items():
+            self._index_uploaded_entry(uploaded_path, info)
+    
+    def _index_uploaded_entry(self, uploaded_path, info):
+        """将一条上传记录加入索引"""
+        file_hash = info.get('file_hash')
+        if file_hash:
+            self._hash_index[file_hash] = uploaded_path
+        fingerprint = info.get('content_fingerprint')
+        if fingerprint:
+            self._fingerprint_index[fingerprint] = uploaded_path
+        if info.get('status') == 'uploaded':
+            server_url = (info.get('url') or '').rstrip('/')
+            self._pending_paths.add(uploaded_path)
+            self._pending_by_server.setdefault(server_url, set()).add(uploaded_path)
+            self._pending_by_name.setdefault((server_url, os.path.basename(uploaded_path)), set()).add(uploaded_path)
+            if info.get('session_id'):
+                self._pending_by_session[(server_url, info['session_id'])] = uploaded_path
+    
+    def _unindex_uploaded_entry(self, uploaded_path):
+        """从索引中移除一条上传记录（覆盖写入前调用）"""
+        info = self.history['uploaded_files'].get(uploaded_path)
+        if not info:
+            return
+        file_hash = info.get('file_hash')
+        if file_hash and self._hash_index.get(file_hash) == uploaded_path:
+            del self._hash_index[file_hash]
+        fingerprint = info.get('content_fingerprint')
+        if fingerprint and self._fingerprint_index.get(fingerprint) == uploaded_path:
+            del self._fingerprint_index[fingerprint]
+        if uploaded_path in self._pending_paths:
+            server_url = (info.get('url') or '').rstrip('/')
+            self._pending_paths.discard(uploaded_path)
+            for index, key in ((self._pending_by_server, server_url),
+                               (self._pending_by_name, (server_url, os.path.basename(uploaded_path)))):
+                paths = index.get(key)
+                if paths:
+                    paths.discard(uploaded_path)
+                    if not paths:
+                        del index[key]
+            session_key = (server_url, info.get('session_id'))
+            if self._pending_by_session.get(session_key) == uploaded_path:
+                del self._pending_by_session[session_key]
+    
+    def find_pending_upload(self, server_url, filename, session_id=None):
+        """根据服务器和服务器上的文件名（或 session_id）查找等待下载的原始文件路径，O(1)。
+        acquire_server 保证同一服务器上同名的未过期任务只有一个；旧版本留下的同名记录优先匹配未过期、先上传的"""
+        with self.history_lock:
+            if session_id:
+                uploaded_path = self._pending_by_session.get((server_url, session_id))
+                if uploaded_path:
+                    return uploaded_path
+            paths = self._pending_by_name.get((server_url, filename))
+            if not paths:
+                return None
+            if len(paths) == 1:
+                return next(iter(paths))
+            now = datetime.now()
+            return min(paths, key=lambda path: (self._is_pending_expired(self.history['uploaded_files'][path], now),
+                                                self.history['uploaded_files'][path].get('uploaded_at', '')))
+    
+    def set_uploaded_entry(self, uploaded_path, info):
+        """写入/覆盖一条上传记录，并同步更新索引"""
+        with self.history_lock:
+            self._unindex_uploaded_entry(uploaded_path)
+            self.history['uploaded_files'][uploaded_path] = info
+            self._index_uploaded_entry(uploaded_path, info)
+    
+    def mark_downloaded(self, uploaded_path, filename):
+        """将上传记录标记为已下载，写入下载历史并同步索引"""
+        with self.history_lock:
+            self._unindex_uploaded_entry(uploaded_path)
+            info = self.history['uploaded_files'][uploaded_path]
+            # 更新上传历史中的状态
+            info['status'] = 'downloaded'
+            info['downloaded_at'] = datetime.now().isoformat()
+            self._index_uploaded_entry(uploaded_path, info)
+            
+            # 将信息添加到下载历史
+            self.history['downloaded_files'][uploaded_path] = {
+                'downloaded_at': datetime.now().isoformat(),
+                'target_folder': info['target_folder'],
+                'original_filename': filename
+            }
+            self.save_history_record('uploaded_files', uploaded_path)
+            self.save_history_record('downloaded_files', uploaded_path)
+    
+    def get_http_session(self, server_url):
+        """获取某个服务器的共享 HTTP 会话：连接在分块、轮询和下载之间复用"""
+        with self.history_lock:
+            session = self._http_sessions.get(server_url)
+            if session is not None:
+                return session
+            
+            retry_kwargs = dict(
+                total=self.config.get('http_retry_total', 3),
+                backoff_factor=self.config.get('http_retry_backoff', 1.0),
+                status_forcelist=(502, 503, 504),
+                raise_on_status=False,  # 重试用尽后返回最后的响应，由调用方处理
+                respect_retry_after_header=True
+            )
+            try:
+                retry = Retry(backoff_jitter=self.config.get('http_retry_backoff', 1.0), **retry_kwargs)
+            except TypeError:
+                # urllib3 < 2.0 不支持 backoff_jitter
+                retry = Retry(**retry_kwargs)
+            pool_size = self.config.get('http_pool_size', 16)
+            adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+            
+            session = requests.Session()
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            self._http_sessions[server_url] = session
+            logger.debug(f"已创建 HTTP 连接池: {server_url} (大小 {pool_size})")
+            return session
+    
+    def _retry_sleep(self, attempt, stage):
+        """重试前等待：retry_delay 按指数增长并加入随机抖动，避免多个线程同时重试"""
+        self.metrics.inc('iw3_retries_total', stage=stage)
+        delay = min(self.config.get('retry_max_delay', 300), self.config.get('retry_delay', 10) * (2 ** attempt))
+        time.sleep(delay * random.uniform(0.5, 1.0))
+    
+    def close(self):
+        """等待上传线程和字幕提取线程结束，关闭指标接口，释放连接池和历史记录存储"""
+        with self.history_lock:
+            self._job_queue.clear()  # 未提交的任务下次扫描时会重新加入
+        if self._upload_executor is not None:
+            self._upload_executor.shutdown(wait=True)
+            self._upload_executor = None
+        # 正在运行的 ffmpeg 完成后退出，队列中剩余的任务在历史记录中保持 pending，下次启动继续
+        self._subtitle_stop.set()
+        for thread in self._subtitle_threads:
+            thread.join()
+        self._subtitle_threads = []
+        if self._metrics_server is not None:
+            self._metrics_server.shutdown()
+            self._metrics_server.server_close()
+            self._metrics_server = None
+        with self.history_lock:
+            for session in self._http_sessions.values():
+                session.close()
+            self._http_sessions.clear()
+            self.flush_history()
+            self.history_store.close()
+    
     def get_file_hash(self, file_path):
         """生成文件的唯一标识（基于文件路径和大小）"""
         try:
             stat = os.stat(file_path)
             file_info = f"{file_path}|{stat.st_size}|{stat.st_mtime}"
-            import hashlib
             return hashlib.md5(file_info.encode('utf-8')).hexdigest()
         except Exception as e:
             logger.error(f"生成文件哈希失败 {file_path}: {e}")
@@ -142,14 +1193,143 @@ class AutoUploadDownload:
         if not file_hash:
             return False
             
-        # 检查是否已经上传过
-        for uploaded_info in self.history['uploaded_files'].values():
-            if uploaded_info.get('file_hash') == file_hash:
-                return True
-        return False
+        # 检查是否已经上传过（O(1) 索引查找）
+        if file_hash in self._hash_index:
+            return True
+        if not self.config.get('content_dedup', True):
+            return False
+        
+        # 路径/修改时间变了，但内容可能与已处理的文件相同（重命名、移动、touch）
+        fingerprint = self.get_content_fingerprint(file_path)
+        if not fingerprint:
+            return False
+        with self.history_lock:
+            original_path = self._fingerprint_index.get(fingerprint)
+        if original_path is None:
+            return False
+        if original_path != file_path:
+            logger.debug(f"文件内容与已处理的文件相同，跳过: {file_path} (原文件: {original_path})")
+        return True
+    
+    def _compute_content_fingerprint(self, file_path, size):
+        """计算内容指纹：文件大小 + 头/中/尾抽样块（或完整内容）的 blake2b 摘要"""
+        mode = self.config.get('fingerprint_mode', 'sampled')
+        digest = hashlib.blake2b(str(size).encode('ascii'), digest_size=16)
+        with open(file_path, 'rb') as f:
+            if mode == 'full':
+                for block in iter(lambda: f.read(1024 * 1024), b''):
+                    digest.update(block)
+            else:
+                mode = 'sampled'
+                sample_size = max(4096, int(self.config.get('fingerprint_sample_kb', 1024) * 1024))
+                if size <= sample_size * 3:
+                    digest.update(f.read())
+                else:
+                    for offset in (0, (size - sample_size) // 2, size - sample_size):
+                        f.seek(offset)
+                        digest.update(f.read(sample_size))
+        return f"{mode}:{digest.hexdigest()}"
+    
+    def get_content_fingerprint(self, file_path, stat=None):
+        """获取文件内容指纹，按 (设备, inode, 大小, 修改时间) 缓存，未变化的文件不会被重复读取"""
+        try:
+            if stat is None:
+                stat = os.stat(file_path)
+        except OSError as e:
+            logger.error(f"读取文件信息失败 {file_path}: {e}")
+            return None
+        
+        cache_key = f"{stat.st_dev}:{stat.st_ino}"
+        mode = self.config.get('fingerprint_mode', 'sampled')
+        with self.history_lock:
+            cached = self.history.get('fingerprint_cache', {}).get(cache_key)
+        if (cached and cached.get('size') == stat.st_size and cached.get('mtime_ns') == stat.st_mtime_ns
+                and cached.get('fingerprint', '').startswith(f"{mode}:")):
+            if cached.get('path') != file_path:
+                # 同一文件被重命名/移动，只更新路径
+                with self.history_lock:
+                    cached['path'] = file_path
+                self.defer_history_record('fingerprint_cache', cache_key)
+            return cached['fingerprint']
+        
+        try:
+            start = time.monotonic()
+            fingerprint = self._compute_content_fingerprint(file_path, stat.st_size)
+        except OSError as e:
+            logger.error(f"计算内容指纹失败 {file_path}: {e}")
+            return None
+        logger.debug(f"内容指纹 {file_path}: {fingerprint} ({time.monotonic() - start:.2f}s)")
+        
+        with self.history_lock:
+            self.history.setdefault('fingerprint_cache', {})[cache_key] = {
+                'path': file_path,
+                'size': stat.st_size,
+                'mtime_ns': stat.st_mtime_ns,
+                'fingerprint': fingerprint
+            }
+        self.defer_history_record('fingerprint_cache', cache_key)
+        return fingerprint
+    
+    def is_file_stable(self, file_path, stat=None):
+        """文件在 file_stable_seconds 内大小和修改时间都没有变化时才视为写入完成"""
+        quiet_seconds = self.config.get('file_stable_seconds', 60)
+        if quiet_seconds <= 0:
+            return True
+        try:
+            if stat is None:
+                stat = os.stat(file_path)
+        except OSError:
+            self._forget_file_stability(file_path)
+            return False
+        
+        now = time.time()
+        signature = (stat.st_size, stat.st_mtime)
+        with self.history_lock:
+            cached = self._file_stability.get(file_path)
+            if cached is None or cached[:2] != signature:
+                # 首次见到或有变化：重新开始计时
+                cached = (stat.st_size, stat.st_mtime, now)
+                self._file_stability[file_path] = cached
+        first_seen = cached[2]
+        # 修改时间早于静默期的文件（例如脚本启动前就已存在）无需再等待
+        return now - first_seen >= quiet_seconds or now - stat.st_mtime >= quiet_seconds
+    
+    def _forget_file_stability(self, file_path):
+        """文件已处理或已不存在时不再跟踪其写入状态，避免 _file_stability 随媒体库增长"""
+        with self.history_lock:
+            self._file_stability.pop(file_path, None)
+    
+    def _scan_rules(self, folder_info):
+        """文件夹的扫描规则: (是否递归, include 通配符, exclude 通配符)"""
+        return (bool(folder_info.get('recursive', self.config.get('recursive_scan', False))),
+                list(folder_info.get('include', self.config.get('scan_include', [])) or []),
+                list(folder_info.get('exclude', self.config.get('scan_exclude', [])) or []))
+    
+    @staticmethod
+    def _match_patterns(rel_path, patterns):
+        """相对路径（/ 分隔）或其最后一级名称匹配任一通配符"""
+        name = rel_path.rsplit('/', 1)[-1]
+        return any(fnmatch.fnmatch(rel_path, pattern) or fnmatch.fnmatch(name, pattern)
+                   for pattern in patterns)
     
-    def find_new_videos(self):
-        """查找新的视频文件（仅限监控文件夹根目录，不递归）"""
+    def _scan_allows(self, folder_info, path, is_dir=False):
+        """按 VR 文件夹和 include/exclude 规则判断监控文件夹中的文件/子文件夹是否需要处理"""
+        _recursive, include, exclude = self._scan_rules(folder_info)
+        rel_path = os.path.relpath(path, folder_info['path']).replace(os.sep, '/')
+        if rel_path == '.':
+            return True
+        if 'VR' in rel_path.split('/')[:None if is_dir else -1]:
+            return False
+        if is_dir:
+            return not self._match_patterns(rel_path, exclude)
+        if include and not self._match_patterns(rel_path, include):
+            return False
+        return not self._match_patterns(rel_path, exclude)
+    
+    def find_new_videos(self, stats=None):
+        """查找新的视频文件：默认只扫描监控文件夹根目录，recursive 为 true 时递归扫描子文件夹（跳过 VR 输出文件夹）。
+        传入 stats 时重新列出所有文件夹，并统计跳过的文件数 {'processed', 'unstable'}"""
+        started = time.monotonic()
         new_videos = []
         
         for folder_info in self.config['folders_to_monitor']:
@@ -159,36 +1339,449 @@ class AutoUploadDownload:
                 continue
                 
             try:
-                # 支持的视频格式
-                video_extensions = {'.mp4', '.avi', '.mkv', '.mov', '.wmv', '.flv', '.webm'}
-                
-                # ---  关键修改：只遍历根目录，不递归 ---
-                # 方法一：使用 os.scandir() (推荐，效率高)
-                with os.scandir(folder_path) as entries:
-                    for entry in entries:
-                        # 只处理文件，忽略目录
-                        if entry.is_file():
-                            file_ext = os.path.splitext(entry.name.lower())[1]
-                            if file_ext in video_extensions:
-                                file_path = entry.path # entry.path 包含完整路径
-                                # 检查文件是否已经处理过
-                                if not self.is_file_processed(file_path):
-                                    new_videos.append({
-                                        'path': file_path,
-                                        'folder_info': folder_info,
-                                        'target_folder': os.path.dirname(file_path)  # 目标文件夹是原文件夹
-                                    })
-                                else:
-                                    logger.debug(f"跳过已处理的文件: {file_path}")
-
+                self._scan_folder(folder_info, new_videos, stats)
             except Exception as e:
                 logger.error(f"扫描文件夹失败 {folder_path}: {e}")
         
+        self.flush_history()
+        # 未再出现的文件（被删除、移走，或所在文件夹不再扫描）不再跟踪
+        with self.history_lock:
+            tracked = list(self._file_stability)
+        for file_path in tracked:
+            if not os.path.exists(file_path):
+                self._forget_file_stability(file_path)
+        self.metrics.observe('iw3_scan_seconds', time.monotonic() - started)
+        self.metrics.inc('iw3_new_videos_total', len(new_videos))
         return new_videos
     
-    def upload_video(self, video_path, additional_args, target_folder):
+    def _list_scan_dir(self, dir_path, rel_dir, recursive, include, exclude):
+        """列出一个文件夹：返回 (需要进入的子文件夹名, 符合规则的视频文件名)"""
+        subdirs = []
+        videos = []
+        with os.scandir(dir_path) as entries:
+            for entry in entries:
+                rel_path = f"{rel_dir}/{entry.name}" if rel_dir else entry.name
+                if recursive and entry.is_dir(follow_symlinks=False):
+                    # 脚本输出的 VR 文件夹始终跳过，避免把转换结果再次上传
+                    if entry.name != 'VR' and not self._match_patterns(rel_path, exclude):
+                        subdirs.append(entry.name)
+                elif entry.is_file():
+                    if os.path.splitext(entry.name.lower())[1] not in VIDEO_EXTENSIONS:
+                        continue
+                    if include and not self._match_patterns(rel_path, include):
+                        continue
+                    if not self._match_patterns(rel_path, exclude):
+                        videos.append(entry.name)
+        return sorted(subdirs), sorted(videos)
+    
+    def _scan_folder(self, folder_info, new_videos, stats=None):
+        """扫描一个监控文件夹。修改时间与上次相同的文件夹直接使用缓存的子文件夹和未处理文件列表，
+        已处理的文件不再逐个检查，重新扫描的开销只与有变化的文件夹数量相关"""
+        root = folder_info['path']
+        recursive, include, exclude = self._scan_rules(folder_info)
+        use_cache = self.config.get('scan_dir_cache', True)
+        rules = json.dumps([recursive, include, exclude], ensure_ascii=False)
+        with self.history_lock:
+            dir_cache = self.history.setdefault('dir_cache', {})
+        changed_keys = []
+        visited = set()
+        listed = 0
+        
+        stack = [(root, '')]
+        while stack:
+            dir_path, rel_dir = stack.pop()
+            visited.add(dir_path)
+            try:
+                dir_stat = os.stat(dir_path)
+                with self.history_lock:
+                    cached = dir_cache.get(dir_path)
+                if (stats is None and use_cache and cached and cached.get('mtime_ns') == dir_stat.st_mtime_ns
+                        and cached.get('rules') == rules):
+                    subdirs, candidates = cached['subdirs'], cached['pending']
+                else:
+                    subdirs, candidates = self._list_scan_dir(dir_path, rel_dir, recursive, include, exclude)
+                    listed += 1
+            except OSError as e:
+                logger.warning(f"无法读取文件夹 {dir_path}: {e}")
+                continue
+            
+            for name in reversed(subdirs):
+                stack.append((os.path.join(dir_path, name), f"{rel_dir}/{name}" if rel_dir else name))
+            
+            pending = []
+            for name in candidates:
+                file_path = os.path.join(dir_path, name)
+                try:
+                    file_stat = os.stat(file_path)
+                except OSError:
+                    self._forget_file_stability(file_path)
+                    continue  # 文件已被删除或移走
+                pending.append(name)
+                # 仍在写入（大小或修改时间在静默期内有变化）的文件先跳过，也不计算哈希
+                if not self.is_file_stable(file_path, file_stat):
+                    logger.debug(f"文件仍在写入，稍后再处理: {file_path}")
+                    if stats is not None:
+                        stats['unstable'] = stats.get('unstable', 0) + 1
+                    continue
+                # 检查文件是否已经处理过
+                if not self.is_file_processed(file_path):
+                    new_videos.append(self._make_video_entry(file_path, folder_info))
+                else:
+                    pending.pop()
+                    self._forget_file_stability(file_path)
+                    logger.debug(f"跳过已处理的文件: {file_path}")
+                    if stats is not None:
+                        stats['processed'] = stats.get('processed', 0) + 1
+            
+            if not use_cache:
+                continue
+            # 修改时间距现在太近时，同一时间戳内可能还有未列出的变更，不缓存
+            mtime_ns = dir_stat.st_mtime_ns if time.time() - dir_stat.st_mtime > 2 else None
+            entry = {'mtime_ns': mtime_ns, 'rules': rules, 'subdirs': subdirs, 'pending': pending}
+            with self.history_lock:
+                if dir_cache.get(dir_path) != entry:
+                    dir_cache[dir_path] = entry
+                    changed_keys.append(dir_path)
+        
+        if use_cache:
+            # 清理已删除或不再扫描的文件夹
+            prefix = os.path.join(root, '')
+            with self.history_lock:
+                stale = [path for path in dir_cache
+                         if (path == root or path.startswith(prefix)) and path not in visited]
+                for path in stale:
+                    del dir_cache[path]
+            self.save_history_records('dir_cache', changed_keys + stale)
+        logger.debug(f"扫描 {root}: {len(visited)} 个文件夹，重新列出 {listed} 个")
+    
+    def _send_chunk(self, session, upload, chunk_index, chunk_data):
+        """发送单个分块（带重试），成功返回服务器响应 JSON，失败返回 None"""
+        filename = upload['filename']
+        total_chunks = upload['total_chunks']
+        
+        # 准备分块数据
+        data = {
+            'filename': filename,
+            'chunk_index': chunk_index,
+            'total_chunks': total_chunks,
+            'additional_args': upload['additional_args']
+        }
+        
+        # 带重试的上传
+        for attempt in range(self.config['max_retries']):
+            # 🟡 关键：如果已有 session_id，则添加到 data 中（首块上传时不会发送）
+            if upload['session_id'] is not None:
+                data['session_id'] = upload['session_id']
+            success = False
+            started = time.monotonic()
+            try:
+                logger.debug(f"上传块 {chunk_index + 1}/{total_chunks} (尝试 {attempt + 1})")
+                
+                if isinstance(chunk_data, FileChunk):
+                    # 流式请求体：每次尝试重新构建，从源文件边读边发
+                    body = StreamingMultipartBody(data, 'chunk', 'chunk', chunk_data, limiter=self.upload_limiter)
+                    response = session.post(
+                        f"{upload['server_url']}/upload",  # 使用 /upload 接口
+                        data=body,
+                        headers={'Content-Type': body.content_type},
+                        timeout=300  # 每块上传超时5分钟
+                    )
+                else:
+                    # 非流式上传只能在发送整个分块前按分块大小限速
+                    self.upload_limiter.consume(len(chunk_data))
+                    response = session.post(
+                        f"{upload['server_url']}/upload",  # 使用 /upload 接口
+                        files={'chunk': ('chunk', chunk_data)},  # 文件块数据
+                        data=data,
+                        timeout=300  # 每块上传超时5分钟
+                    )
+                
+                if response.status_code == 200:
+                    try:
+                        result = response.json()
+                    except requests.exceptions.JSONDecodeError as e:
+                        logger.error(f"解析服务器响应失败 (HTTP 200): {e}")
+                        logger.error(f"响应内容: {response.text}")
+                        # 如果解析失败，本次尝试视为失败，进行重试
+                        result = None
+                    
+                    if result is not None:
+                        # 🟡 关键：检查是否是最终的合并成功消息
+                        if result.get('message') == UPLOAD_COMPLETE_MESSAGE:
+                            success = True
+                            return result
+                        
+                        # 如果不是最终成功，但块上传成功 (例如 '块 X/Y 上传成功')
+                        if 'message' in result and ('上传成功' in result['message'] or '上传完成' in result['message']):
+                            logger.info(f" [{filename}] 块 {chunk_index + 1}/{total_chunks} 上传成功: {result.get('message', 'OK')}")
+                            success = True
+                            return result
+                        # 服务器返回了 200 但消息不是预期的成功，视为失败
+                        logger.warning(f" [{filename}] 块 {chunk_index} 上传未成功 (HTTP 200 但消息异常): {result}")
+                        if upload['session_id'] is not None and self._names_session(result.get('error') or result.get('message')):
+                            upload['session_lost'] = True
+                            return None
+                        with upload['lock']:
+                            upload['rejected_chunks'].add(chunk_index)
+                        
+                else:
+                    logger.warning(f" [{filename}] 块 {chunk_index} 上传失败 (HTTP {response.status_code}): {response.text}")
+                    if upload['session_id'] is not None and (response.status_code == 404 or self._names_session(response.text)):
+                        # 服务器已不认识该 session，重试也不会成功
+                        upload['session_lost'] = True
+                        return None
+                    if 400 <= response.status_code < 500:
+                        # 服务器拒绝了该分块（可能不接受乱序分块）；5xx 和超时视为临时故障
+                        with upload['lock']:
+                            upload['rejected_chunks'].add(chunk_index)
+                    
+            except Exception as e:
+                logger.warning(f" [{filename}] 块 {chunk_index} 上传异常 (尝试 {attempt + 1}): {e}")
+            finally:
+                # 每次尝试的耗时和结果都交给自适应分块控制器
+                elapsed = time.monotonic() - started
+                self.chunk_sizer.record(upload['server_url'], len(chunk_data), elapsed, success)
+                self.metrics.observe('iw3_upload_chunk_seconds', elapsed, server=upload['server_url'],
+                                     result='ok' if success else 'error')
+                if success:
+                    self.metrics.inc('iw3_upload_bytes_total', len(chunk_data), server=upload['server_url'])
+            
+            # 重试前等待
+            if attempt < self.config['max_retries'] - 1:
+                self._retry_sleep(attempt, 'upload_chunk')
+        
+        # 所有重试均失败
+        logger.error(f" [{filename}] 块 {chunk_index} 达到最大重试次数，上传中断")
+        return None
+    
+    @staticmethod
+    def _names_session(error):
+        """错误信息是否提到 session（服务器不认识或已丢弃该上传会话）"""
+        return 'session' in str(error or '').lower()
+    
+    def _apply_chunk_result(self, upload, chunk_index, result):
+        """根据分块响应更新上传状态并记录进度，返回是否已收到最终合并成功消息"""
+        with upload['lock']:
+            # 🟡 关键：检查响应是否包含新的 session_id (首次上传或后续上传都会返回)
+            if 'session_id' in result:
+                upload['session_id'] = result['session_id']
+                logger.debug(f"获取/更新 session_id: {upload['session_id']}")
+            upload['acked_chunks'].add(chunk_index)
+        self._save_upload_progress(upload)
+        return result.get('message') == UPLOAD_COMPLETE_MESSAGE
+    
+    def _save_upload_progress(self, upload, force=False):
+        """持久化断点续传进度（session_id 与已确认的分块），按时间间隔节流。
+        上传过程中的定期保存走 defer_history_record（json 后端不逐次重写整个文件，丢失时可向服务器查询已收到的分块），
+        force 为 True（上传失败或中断）时立即写入"""
+        if not self.config.get('upload_resume', True) or upload['session_id'] is None:
+            return
+        now = time.monotonic()
+        with upload['lock']:
+            if not force and now - upload['progress_saved_at'] < self.config.get('upload_progress_save_seconds', 10):
+                return
+            upload['progress_saved_at'] = now
+            acked_chunks = sorted(upload['acked_chunks'])
+            # 连续确认到的最后一个分块索引
+            last_acked_chunk = -1
+            while last_acked_chunk + 1 in upload['acked_chunks']:
+                last_acked_chunk += 1
+            record = {
+                'session_id': upload['session_id'],
+                'server_url': upload['server_url'],
+                'file_hash': upload['file_hash'],
+                'chunk_size': upload['chunk_size'],
+                'total_chunks': upload['total_chunks'],
+                'last_acked_chunk': last_acked_chunk,
+                'acked_chunks': acked_chunks,
+                'updated_at': datetime.now().isoformat()
+            }
+        with self.history_lock:
+            self.history.setdefault('upload_sessions', {})[upload['video_path']] = record
+        if force:
+            self.save_history_record('upload_sessions', upload['video_path'])
+        else:
+            self.defer_history_record('upload_sessions', upload['video_path'])
+    
+    def _clear_upload_progress(self, video_path):
+        """删除断点续传记录（残留的记录在下次上传时会被识别为无效，不必立即写入）"""
+        with self.history_lock:
+            removed = self.history.get('upload_sessions', {}).pop(video_path, None) is not None
+        if removed:
+            self.defer_history_record('upload_sessions', video_path)
+    
+    def _query_received_chunks(self, session, server_url, session_id):
+        """向服务器查询某个 session 已收到的分块；服务器不支持该接口时返回 None，
+        服务器明确表示不认识该 session 时返回 False"""
+        endpoint = self.config.get('upload_status_endpoint', '/api/upload_status')
+        if not endpoint:
+            return None
+        try:
+            response = session.get(f"{server_url}{endpoint}", params={'session_id': session_id}, timeout=20)
+            if response.status_code == 404 and self._names_session(response.text):
+                return False
+            if response.status_code != 200:
+                logger.debug(f"服务器未提供分块查询接口 (HTTP {response.status_code})")
+                return None
+            received = response.json().get('received_chunks')
+            if isinstance(received, list):
+                return {int(i) for i in received}
+        except Exception as e:
+            logger.debug(f"查询已接收分块失败: {e}")
+        return None
+    
+    def _load_upload_progress(self, session, upload):
+        """读取可续传的进度，返回仍需发送的分块索引列表；无可用进度时返回 None"""
+        if not self.config.get('upload_resume', True):
+            return None
+        saved = self.history.get('upload_sessions', {}).get(upload['video_path'])
+        if not saved:
+            return None
+        # 文件、分块大小或服务器发生变化时，旧进度作废
+        if (saved.get('file_hash') != upload['file_hash'] or
+                saved.get('chunk_size') != upload['chunk_size'] or
+                saved.get('total_chunks') != upload['total_chunks'] or
+                saved.get('server_url') != upload['server_url']):
+            logger.info(f"[{upload['filename']}] 文件或上传参数已变化，放弃旧的续传进度")
+            self._clear_upload_progress(upload['video_path'])
+            return None
+        
+        received = self._query_received_chunks(session, upload['server_url'], saved['session_id'])
+        if received is False:
+            logger.warning(f"[{upload['filename']}] 服务器已不存在旧的上传会话，从头上传")
+            self._clear_upload_progress(upload['video_path'])
+            return None
+        if received is None:
+            # 服务器无法报告时，以本地记录的连续确认位置为准
+            received = set(range(saved.get('last_acked_chunk', -1) + 1))
+        remaining = [i for i in range(upload['total_chunks']) if i not in received]
+        if not remaining:
+            return None
+        upload['session_id'] = saved['session_id']
+        upload['acked_chunks'] = set(received)
+        logger.info(f"[{upload['filename']}] 从分块 {remaining[0] + 1}/{upload['total_chunks']} 续传 (session_id: {saved['session_id']})")
+        return remaining
+    
+    def _send_chunks_sequential(self, session, upload, chunk_indices, read_chunk, readahead):
+        """按顺序发送分块；readahead 为 True 时，上传当前块的同时后台读取下一块。
+        返回 'merged'（已合并）、'ok'（全部发送成功）或 'failed'"""
+        if not chunk_indices:
+            return 'ok'
+        with ThreadPoolExecutor(max_workers=1, thread_name_prefix='chunk-reader') as reader:
+            pending = reader.submit(read_chunk, chunk_indices[0]) if readahead else None
+            for pos, chunk_index in enumerate(chunk_indices):
+                if readahead:
+                    chunk_data = pending.result()
+                    if pos + 1 < len(chunk_indices):
+                        pending = reader.submit(read_chunk, chunk_indices[pos + 1])
+                else:
+                    chunk_data = read_chunk(chunk_index)
+                
+                result = self._send_chunk(session, upload, chunk_index, chunk_data)
+                del chunk_data
+                if result is None:
+                    return 'failed'
+                if self._apply_chunk_result(upload, chunk_index, result):
+                    return 'merged'
+        return 'ok'
+    
+    def _send_chunks_parallel(self, session, upload, chunk_indices, read_chunk, inflight):
+        """session_id 已知后，最多 inflight 个分块同时在途发送。
+        返回 (是否已合并, 发送失败的分块索引列表)"""
+        def send(chunk_index):
+            # 在工作线程内读取，保证内存中最多只有 inflight 个分块
+            return self._send_chunk(session, upload, chunk_index, read_chunk(chunk_index))
+        
+        merged = False
+        failed = []
+        with ThreadPoolExecutor(max_workers=inflight, thread_name_prefix='chunk') as pool:
+            futures = {pool.submit(send, chunk_index): chunk_index for chunk_index in chunk_indices}
+            for future in as_completed(futures):
+                result = future.result()
+                if result is None:
+                    failed.append(futures[future])
+                elif self._apply_chunk_result(upload, futures[future], result):
+                    merged = True
+        return merged, sorted(failed)
+    
+    def _record_upload_success(self, video_path, upload, target_folder):
+        """上传合并成功后写入历史记录（状态为 uploaded）"""
+        logger.info(f" 文件 '{upload['filename']}' 上传、合并成功，并已加入转换队列！")
+        self._forget_file_stability(video_path)
+        file_hash = self.get_file_hash(video_path)
+        fingerprint = self.get_content_fingerprint(video_path) if self.config.get('content_dedup', True) else None
+        self.set_uploaded_entry(video_path, {
+            'uploaded_at': datetime.now().isoformat(),
+            'url': upload['server_url'],
+            'additional_args': upload['additional_args'],
+            'target_folder': target_folder,
+            'file_hash': file_hash,
+            'content_fingerprint': fingerprint,
+            'status': 'uploaded', # 等待 check_conversion_status 下载
+            # 可选：存储 session_id 以便后续追踪
+            'session_id': upload['session_id']
+        })
+        self.save_history_record('uploaded_files', video_path)
+        # 有新任务进入服务器队列，让轮询线程立即切换到快速轮询
+        self._poll_wakeup.set()
+    
+    def _choose_chunk_size(self, video_path, server_url):
+        """选择本文件的分块大小：有续传进度时沿用原分块大小，否则由自适应控制器决定"""
+        saved = self.history.get('upload_sessions', {}).get(video_path)
+        if (self.config.get('upload_resume', True) and saved and
+                saved.get('server_url') == server_url and
+                saved.get('file_hash') == self.get_file_hash(video_path)):
+            logger.info(f"分块大小: {saved['chunk_size'] / 1024:.0f}KB (沿用续传进度)")
+            return saved['chunk_size']
+        
+        if not self.config.get('adaptive_chunk_size', True):
+            return self.chunk_sizer.initial_size
+        chunk_size, reason = self.chunk_sizer.choose(server_url)
+        logger.info(f"分块大小: {chunk_size / 1024:.0f}KB ({reason})")
+        return chunk_size
+    
+    def _send_chunk_plan(self, session, upload, chunk_indices, read_chunk, pipeline_mode, inflight):
+        """按发送方式发送指定的分块，返回 'merged'、'ok' 或 'failed'"""
+        readahead = pipeline_mode != 'sequential'
+        last_chunk = upload['total_chunks'] - 1
+        if pipeline_mode != 'parallel' or len(chunk_indices) <= 2:
+            return self._send_chunks_sequential(session, upload, chunk_indices, read_chunk, readahead)
+        
+        if upload['session_id'] is None:
+            # 首块单独发送以获取 session_id
+            status = self._send_chunks_sequential(session, upload, chunk_indices[:1], read_chunk, False)
+            chunk_indices = chunk_indices[1:]
+            if status != 'ok' or upload['session_id'] is None:
+                if status == 'ok':
+                    return self._send_chunks_sequential(session, upload, chunk_indices, read_chunk, readahead)
+                return status
+        
+        # 中间分块并发发送，最后一块在其余分块全部确认后再发送，保证服务器最后合并
+        middle_chunks = [i for i in chunk_indices if i != last_chunk]
+        merged, failed = self._send_chunks_parallel(session, upload, middle_chunks, read_chunk, inflight)
+        if merged:
+            return 'merged'
+        status = 'ok'
+        if failed:
+            # 本次先按顺序重发失败的分块
+            logger.warning(f"[{upload['filename']}] {len(failed)} 个分块并发发送失败，回退为顺序发送")
+            with upload['lock']:
+                rejected = upload['rejected_chunks'].intersection(failed)
+            status = self._send_chunks_sequential(session, upload, failed, read_chunk, readahead)
+            if rejected and status != 'failed':
+                # 并发时被服务器拒绝、按顺序重发却成功：服务器要求按顺序接收分块，之后都使用顺序发送。
+                # 超时、5xx 等临时故障不会让服务器永久回退为顺序发送
+                logger.warning(f"服务器 {upload['server_url']} 不接受乱序分块，之后改为顺序发送")
+                self._sequential_upload_servers.add(upload['server_url'])
+        if status == 'ok' and last_chunk in chunk_indices:
+            status = self._send_chunks_sequential(session, upload, [last_chunk], read_chunk, False)
+        return status
+    
+    def upload_video(self, video_path, additional_args, target_folder, server_url=None):
         """使用分块上传方式上传大视频文件，适配当前后端 session_id 机制"""
-        session = requests.Session()
+        if server_url is None:
+            server_url = self.get_servers()[0]['url']
+        session = self.get_http_session(server_url)
         
         # 确保目标VR文件夹存在 (如果您的脚本逻辑还需要这个)
         vr_folder = os.path.join(target_folder, 'VR')
@@ -196,108 +1789,83 @@ class AutoUploadDownload:
         
         filename = os.path.basename(video_path)
         file_size = os.path.getsize(video_path)
-        chunk_size = 10 * 1024 * 1024  # 10MB 每块（可配置）
+        chunk_size = self._choose_chunk_size(video_path, server_url)
         total_chunks = (file_size // chunk_size) + (1 if file_size % chunk_size else 0)
         
+        # 分块发送方式：sequential 严格顺序 / readahead 顺序发送并预读下一块 / parallel 多块同时在途
+        pipeline_mode = self.config.get('upload_pipeline_mode', 'readahead')
+        if pipeline_mode == 'parallel' and server_url in self._sequential_upload_servers:
+            pipeline_mode = 'readahead'
+        inflight = max(1, self.config.get('upload_inflight_chunks', 4))
+        
         logger.info(f"准备上传大文件: {filename}")
-        logger.info(f"大小: {file_size / (1024*1024):.1f}MB | 分块数: {total_chunks} | 块大小: {chunk_size / 1024:.1f}KB")
+        logger.info(f"大小: {file_size / (1024*1024):.1f}MB | 分块数: {total_chunks} | 块大小: {chunk_size / 1024:.1f}KB | 发送方式: {pipeline_mode}")
         
         # === 分块上传逻辑开始 ===
         # 🟡 关键：初始化 session_id 为 None，首次上传时不会发送
-        current_session_id = None 
+        upload = {
+            'video_path': video_path,
+            'server_url': server_url,
+            'filename': filename,
+            'file_hash': self.get_file_hash(video_path),
+            'chunk_size': chunk_size,
+            'total_chunks': total_chunks,
+            'additional_args': additional_args,
+            'session_id': None,
+            'session_lost': False,  # 服务器表示不认识 session_id
+            'rejected_chunks': set(),  # 被服务器以 4xx 或异常消息拒绝过的分块
+            'acked_chunks': set(),  # 服务器已确认的分块索引
+            'progress_saved_at': 0,
+            'lock': threading.Lock()
+        }
         
         try:
             with open(video_path, 'rb') as f:
-                for chunk_index in range(total_chunks):
-                    # 计算当前块
-                    f.seek(chunk_index * chunk_size)
-                    chunk_data = f.read(chunk_size)
-                    
-                    # 准备分块数据
-                    files = {
-                        'chunk': ('chunk', chunk_data) # 文件块数据
-                    }
-                    data = {
-                        'filename': filename,
-                        'chunk_index': chunk_index,
-                        'total_chunks': total_chunks,
-                        'additional_args': additional_args
-                        # 'session_id': current_session_id # 在下面的条件中添加
-                    }
-                    
-                    # 🟡 关键：如果已有 session_id，则添加到 data 中
-                    if current_session_id is not None:
-                        data['session_id'] = current_session_id
-                    
-                    # 带重试的上传
-                    for attempt in range(self.config['max_retries']):
-                        try:
-                            logger.debug(f"上传块 {chunk_index + 1}/{total_chunks} (尝试 {attempt + 1})")
-                            
-                            response = session.post(
-                                f"{self.config['website_url']}/upload",  # 使用 /upload 接口
-                                files=files,
-                                data=data,
-                                timeout=300  # 每块上传超时5分钟
-                            )
-                            
-                            if response.status_code == 200:
-                                try:
-                                    result = response.json()
-                                except requests.exceptions.JSONDecodeError as e:
-                                    logger.error(f"解析服务器响应失败 (HTTP 200): {e}")
-                                    logger.error(f"响应内容: {response.text}")
-                                    # 如果解析失败，本次尝试视为失败，进行重试
-                                    continue # 跳出本次 attempt 的成功处理，进入下一次重试或循环
-
-                                # 🟡 关键：检查响应是否包含新的 session_id (首次上传或后续上传都会返回)
-                                if 'session_id' in result:
-                                    # 🟡 关键：更新当前的 session_id，用于下一次上传
-                                    # 即使是第一次，也会从服务器获取到新的 session_id
-                                    current_session_id = result['session_id']
-                                    logger.debug(f"获取/更新 session_id: {current_session_id}")
-
-                                # 🟡 关键：检查是否是最终的合并成功消息
-                                if result.get('message') == '上传并合并完成，已加入转换队列':
-                                    logger.info(f" 文件 '{filename}' 上传、合并成功，并已加入转换队列！")
-                                    # 🟡 关键：记录到历史（状态为 uploaded）
-                                    file_hash = self.get_file_hash(video_path)
-                                    self.history['uploaded_files'][video_path] = {
-                                        'uploaded_at': datetime.now().isoformat(),
-                                        'url': self.config['website_url'],
-                                        'additional_args': additional_args,
-                                        'target_folder': target_folder,
-                                        'file_hash': file_hash,
-                                        'status': 'uploaded', # 等待 check_conversion_status 下载
-                                        # 可选：存储 session_id 以便后续追踪
-                                        'session_id': current_session_id 
-                                    }
-                                    self.save_history()
-                                    return True # 上传和合并成功，直接返回
-
-                                # 如果不是最终成功，但块上传成功 (例如 '块 X/Y 上传成功')
-                                if 'message' in result and ('上传成功' in result['message'] or '上传完成' in result['message']):
-                                    logger.info(f" 块 {chunk_index + 1}/{total_chunks} 上传成功: {result.get('message', 'OK')}")
-                                    break # 成功，跳出重试循环，处理下一个块
-                                else:
-                                    # 服务器返回了 200 但消息不是预期的成功，视为失败
-                                    logger.warning(f" 块 {chunk_index} 上传未成功 (HTTP 200 但消息异常): {result}")
-                                    
-                            else:
-                                logger.warning(f" 块 {chunk_index} 上传失败 (HTTP {response.status_code}): {response.text}")
-                                
-                        except Exception as e:
-                            logger.warning(f" 块 {chunk_index} 上传异常 (尝试 {attempt + 1}): {e}")
-                        
-                        # 重试前等待
-                        if attempt < self.config['max_retries'] - 1:
-                            time.sleep(self.config['retry_delay'])
+                read_lock = threading.Lock()
+                streaming = self.config.get('upload_streaming', True)
+                
+                def read_chunk(chunk_index):
+                    if streaming:
+                        # 流式模式只返回分块位置，发送时再从文件分段读取；预读交给操作系统
+                        chunk = FileChunk(f, read_lock, chunk_index * chunk_size,
+                                          min(chunk_size, file_size - chunk_index * chunk_size))
+                        chunk.prefetch()
+                        return chunk
+                    # 多个线程共享同一文件句柄，seek + read 需要加锁
+                    with read_lock:
+                        f.seek(chunk_index * chunk_size)
+                        return f.read(chunk_size)
+                
+                # 有可用的续传进度时，只发送服务器尚未收到的分块
+                remaining_chunks = self._load_upload_progress(session, upload)
+                if remaining_chunks is not None:
+                    status = self._send_chunk_plan(session, upload, remaining_chunks, read_chunk, pipeline_mode, inflight)
+                    if status == 'failed' and upload['session_lost']:
+                        # 服务器明确表示不认识该 session（404 或错误信息提到 session），改为从头上传；
+                        # 其他失败（超时、5xx）保留进度，下次继续续传
+                        logger.warning(f"[{filename}] 服务器已丢弃旧 session，从头上传")
+                        self._clear_upload_progress(video_path)
+                        upload['session_id'] = None
+                        upload['session_lost'] = False
+                        upload['acked_chunks'] = set()
+                        remaining_chunks = None
+                if remaining_chunks is None:
+                    status = self._send_chunk_plan(session, upload, list(range(total_chunks)), read_chunk, pipeline_mode, inflight)
+                
+                if status == 'merged':
+                    # 🟡 关键：记录到历史（状态为 uploaded）
+                    self._record_upload_success(video_path, upload, target_folder)
+                    self._clear_upload_progress(video_path)
+                    return True # 上传和合并成功，直接返回
+                if status == 'failed':
+                    if upload['session_lost']:
+                        self._clear_upload_progress(video_path)
                     else:
-                        # 所有重试均失败
-                        logger.error(f" 块 {chunk_index} 达到最大重试次数，上传中断")
-                        return False  # 整体上传失败
+                        # 保存进度，下次运行时从最后确认的分块继续
+                        self._save_upload_progress(upload, force=True)
+                    return False  # 整体上传失败
                 
-                # === 注意：正常情况下，循环结束前应该因为最终成功消息而 return True ===
+                # === 注意：正常情况下，应该因为最终成功消息而 return True ===
                 # 如果代码执行到这里，意味着所有分块都上传了，但没有收到最终的合并成功消息
                 # 这通常不应该发生，可能是网络问题导致最后的响应没收到
                 logger.warning(f"所有 {total_chunks} 个分块上传完成，但未收到最终合并成功确认。可能需要手动检查或重试。")
@@ -307,85 +1875,538 @@ class AutoUploadDownload:
                 
         except Exception as e:
             logger.error(f"分块上传过程中发生严重错误 {filename}: {e}")
+            self._save_upload_progress(upload, force=True)
             return False
     
     def check_conversion_status(self):
-        """检查转换状态并下载完成的文件（适配新版网站 API - 返回字符串列表）"""
-        session = requests.Session()
+        """检查转换状态并下载完成的文件，返回本次下载的文件数。
+        轮询线程与扫描流程可能同时调用，正在检查时直接跳过"""
+        if not self._status_check_lock.acquire(blocking=False):
+            logger.debug("状态检查正在进行中，跳过本次检查")
+            return 0
+        try:
+            return self._poll_and_download()
+        finally:
+            self._status_check_lock.release()
+    
+    def _poll_and_download(self):
+        """轮询所有服务器（配置中的服务器以及仍有未下载任务的服务器），返回下载的文件总数"""
+        with self.history_lock:
+            server_urls = [server['url'] for server in self.get_servers()]
+            server_urls += [url for url in self._pending_by_server if url and url not in server_urls]
+        if len(server_urls) == 1:
+            downloaded_count = self._poll_server(server_urls[0])
+        else:
+            # 各服务器同时轮询，长轮询或下载较慢的服务器不会拖慢其他服务器
+            with ThreadPoolExecutor(max_workers=len(server_urls), thread_name_prefix='status') as executor:
+                downloaded_count = sum(executor.map(self._poll_server, server_urls))
+        if downloaded_count:
+            # 下载完成后服务器有了空闲名额，提交本地队列中等待的任务
+            self.dispatch_jobs()
+        return downloaded_count
+    
+    def _poll_server(self, server_url):
+        """请求一个服务器的状态接口并下载已转换的文件（适配新版网站 API - 返回字符串列表）"""
+        session = self.get_http_session(server_url)
+        downloaded_count = 0
         
         try:
-            api_url = f"{self.config['website_url']}/api/status"
+            api_url = f"{server_url}/api/status"
             logger.debug(f"请求状态接口: {api_url}")
             
-            response = session.get(api_url, timeout=20)
+            # 长轮询：服务器支持时会保持请求直到有文件转换完成或超时，不支持时会忽略该参数
+            long_poll_seconds = self.config.get('status_long_poll_seconds', 0)
+            params = {'wait': long_poll_seconds} if long_poll_seconds > 0 else None
+            started = time.monotonic()
+            response = session.get(api_url, params=params, timeout=20 + long_poll_seconds)
+            self.metrics.observe('iw3_status_poll_seconds', time.monotonic() - started, server=server_url)
             if response.status_code != 200:
                 logger.warning(f"获取状态失败: {response.status_code} - {response.text}")
-                return
+                return 0
             
             try:
                 data = response.json()
             except json.JSONDecodeError as e:
                 logger.error(f"响应不是有效的JSON: {e}")
-                return
+                return 0
+            
+            # 服务器报告了转换队列长度时记录下来，用于选择负载最低的服务器
+            queue_depth = data.get('queue_depth', data.get('queue_length'))
+            if isinstance(data.get('queue'), list):
+                queue_depth = len(data['queue'])
+            with self.history_lock:
+                if isinstance(queue_depth, int):
+                    self._server_queue_depth[server_url] = queue_depth
+                else:
+                    self._server_queue_depth.pop(server_url, None)
 
             # 提取已转换文件列表
             # 关键：后端返回的是字符串列表，如 ["file1.mp4", "file2.mp4"]
             converted_files = data.get('converted_files', [])
             if not converted_files:
-                logger.info("暂无已转换的文件。")
-                return
+                logger.debug("暂无已转换的文件。")
+                return 0
 
-            logger.info(f"发现 {len(converted_files)} 个已转换文件: {converted_files}")
+            # 轮询频繁，完整列表只在调试日志中输出
+            logger.debug(f"发现 {len(converted_files)} 个已转换文件: {converted_files}")
 
-            # 关键：直接遍历字符串列表中的文件名
-            for filename in converted_files:
+            # 关键：直接遍历列表中的文件名（新版后端也可能返回 {"filename", "session_id"}）
+            for item in converted_files:
+                session_id = None
+                if isinstance(item, dict):
+                    filename, session_id = item.get('filename'), item.get('session_id')
+                else:
+                    filename = item
                 # 确保文件名存在且不为空
                 if not filename or not isinstance(filename, str):
                     continue
 
-                # 在上传历史中查找匹配的原始文件
-                matched = False
-                for uploaded_path, info in self.history['uploaded_files'].items():
-                    # 检查状态为 'uploaded' 且原始文件名匹配
-                    if (info.get('status') == 'uploaded' and 
-                        os.path.basename(uploaded_path) == filename):
-                        
-                        # 找到匹配，开始下载
-                        if self.download_converted_file(session, filename, info['target_folder']):
-                            # 更新上传历史中的状态
-                            info['status'] = 'downloaded'
-                            info['downloaded_at'] = datetime.now().isoformat()
-                            
-                            # 将信息添加到下载历史
-                            self.history['downloaded_files'][uploaded_path] = {
-                                'downloaded_at': datetime.now().isoformat(),
-                                'target_folder': info['target_folder'],
-                                'original_filename': filename
-                            }
-                            logger.info(f"文件已下载并记录: {filename}")
-                        
-                        matched = True
-                        break # 找到匹配项后跳出循环
-
-                if not matched:
-                    logger.warning(f"未找到上传记录的已转换文件: {filename}")
-
-            # 保存更新后的历史记录
-            self.save_history()
+                # 在等待下载的任务中查找（按服务器和文件名索引，只包含 uploaded 状态的记录）
+                uploaded_path = self.find_pending_upload(server_url, filename, session_id)
+                if uploaded_path is None:
+                    # 已下载过的文件会一直出现在服务器列表中，每个文件只记录一次
+                    if (server_url, filename) not in self._unmatched_reported:
+                        self._unmatched_reported.add((server_url, filename))
+                        logger.debug(f"未找到等待下载的上传记录，忽略已转换文件: {filename} ({server_url})")
+                    continue
+                
+                info = self.history['uploaded_files'][uploaded_path]
+                started = time.monotonic()
+                if self.metrics.enabled and info.get('uploaded_at'):
+                    waited = datetime.now() - datetime.fromisoformat(info['uploaded_at'])
+                    self.metrics.observe('iw3_conversion_wait_seconds', waited.total_seconds(), server=server_url)
+                downloaded = self.download_converted_file(session, filename, info['target_folder'], server_url)
+                self.metrics.observe('iw3_download_seconds', time.monotonic() - started, server=server_url,
+                                     result='ok' if downloaded else 'error')
+                if downloaded:
+                    self.mark_downloaded(uploaded_path, filename)
+                    downloaded_count += 1
+                    logger.info(f"文件已下载并记录: {filename}")
+                    self.schedule_retention(uploaded_path)
 
         except requests.exceptions.RequestException as e:
-            logger.error(f"请求网站状态时发生网络错误: {e}")
+            logger.error(f"请求网站状态时发生网络错误 ({server_url}): {e}")
+            with self.history_lock:
+                self._server_queue_depth.pop(server_url, None)
         except Exception as e:
             logger.error(f"检查转换状态时发生未知错误: {e}")
+        return downloaded_count
+    
+    def has_pending_jobs(self):
+        """是否有正在上传或等待服务器转换的任务"""
+        return bool(self._pending_paths) or bool(self._uploads_in_progress)
+    
+    def status_poll_loop(self):
+        """独立的状态轮询线程：有待下载任务时按最短间隔轮询，队列为空时逐步退避到 download_check_interval_minutes"""
+        min_interval = self.config.get('status_poll_min_seconds', 30)
+        max_interval = max(min_interval, self.config.get('download_check_interval_minutes', DEFAULT_DOWNLOAD_CHECK_INTERVAL_MINUTES) * 60)
+        interval = min_interval
+        
+        while not self._stop_event.is_set():
+            try:
+                self.check_conversion_status()
+            except Exception as e:
+                logger.error(f"状态轮询失败: {e}")
+            
+            if self.has_pending_jobs():
+                interval = min_interval
+            else:
+                interval = min(max_interval, interval * 2)
+            logger.debug(f"下次状态轮询间隔: {interval} 秒")
+            
+            # 新文件上传完成时会提前唤醒
+            self._poll_wakeup.wait(interval)
+            self._poll_wakeup.clear()
+    
+    def start_status_poller(self):
+        """启动独立的状态轮询线程"""
+        if self._poller_thread is not None and self._poller_thread.is_alive():
+            return
+        self._poller_thread = threading.Thread(target=self.status_poll_loop, name='status-poller', daemon=True)
+        self._poller_thread.start()
+        logger.info(f"已启动状态轮询: 有待转换任务时每 {self.config.get('status_poll_min_seconds', 30)} 秒，"
+                    f"空闲时最长每 {self.config.get('download_check_interval_minutes', DEFAULT_DOWNLOAD_CHECK_INTERVAL_MINUTES)} 分钟检查一次")
+    
+    def stop(self):
+        """停止轮询线程"""
+        self._stop_event.set()
+        self._poll_wakeup.set()
+    
+    def _load_download_state(self, state_path, download_url):
+        """读取分段下载进度文件，地址不符或文件损坏时返回 None"""
+        try:
+            if os.path.exists(state_path):
+                with open(state_path, 'r', encoding='utf-8') as f:
+                    state = json.load(f)
+                if state.get('url') == download_url and state.get('segments'):
+                    return state
+                logger.info(f"下载进度文件已失效，重新开始: {state_path}")
+        except (OSError, ValueError) as e:
+            logger.warning(f"读取下载进度失败 {state_path}: {e}")
+        return None
+    
+    def _save_download_progress(self, progress, force=False):
+        """保存分段下载进度，按时间间隔节流"""
+        now = time.monotonic()
+        with progress['lock']:
+            if not force and now - progress['saved_at'] < 5:
+                return
+            progress['saved_at'] = now
+            try:
+                _atomic_write_json(progress['state_path'], progress['state'])
+            except OSError as e:
+                logger.warning(f"保存下载进度失败: {e}")
+    
+    def _probe_download(self, session, download_url):
+        """用 1 字节的 Range 请求探测文件总大小、服务器是否支持 Range 以及完整文件的摘要。
+        返回 (HTTP 状态码, 总大小或 None, 是否支持 Range, (算法, 摘要) 或 None)"""
+        try:
+            with session.get(download_url, headers={'Range': 'bytes=0-0'}, stream=True, timeout=(30, 60)) as response:
+                digest = _response_repr_digest(response)
+                if response.status_code == 206:
+                    response.content  # 读完 1 字节响应体，连接才能放回连接池复用
+                    match = re.match(r'bytes \d+-\d+/(\d+)', response.headers.get('Content-Range', ''))
+                    return 206, (int(match.group(1)) if match else None), True, digest
+                length = response.headers.get('Content-Length')
+                if response.status_code == 200 and length and length.isdigit():
+                    return 200, int(length), False, digest
+                return response.status_code, None, False, None
+        except requests.exceptions.RequestException as e:
+            logger.warning(f"探测下载文件信息失败: {e}")
+            return None, None, False, None
+    
+    def _preallocate_file(self, path, size):
+        """预先分配目标文件空间，减少碎片并尽早发现磁盘空间不足"""
+        try:
+            with open(path, 'r+b') as f:
+                if hasattr(os, 'posix_fallocate'):
+                    try:
+                        os.posix_fallocate(f.fileno(), 0, size)
+                        return
+                    except OSError:
+                        pass  # 部分文件系统不支持 fallocate，退回 truncate
+                if os.fstat(f.fileno()).st_size < size:
+                    f.truncate(size)
+        except OSError as e:
+            logger.warning(f"预分配文件空间失败 {path}: {e}")
+    
+    def _check_download_response(self, response, pos, progress, filename):
+        """核对响应的 Content-Range/Content-Length 和 Repr-Digest 是否与本次下载一致。
+        服务器上的文件已变化时返回 False；返回的范围与请求不符时抛出异常（按请求失败重试）"""
+        state = progress['state']
+        total_size = state['total_size']
+        if response.status_code == 206:
+            match = re.match(r'bytes (\d+)-(\d+)/(\d+|\*)', response.headers.get('Content-Range', ''))
+            if match is None or int(match.group(1)) != pos:
+                raise requests.exceptions.HTTPError(
+                    f"Content-Range 与请求的位置 {pos} 不符: {response.headers.get('Content-Range')}")
+            if match.group(3) != '*' and total_size is not None and int(match.group(3)) != total_size:
+                logger.error(f"服务器上的文件大小已变化 ({total_size} -> {match.group(3)} 字节): {filename}")
+                return False
+        elif total_size is not None:
+            length = response.headers.get('Content-Length')
+            if length and length.isdigit() and int(length) != total_size:
+                logger.error(f"服务器上的文件大小已变化 ({total_size} -> {length} 字节): {filename}")
+                return False
+        
+        if not self.config.get('download_verify', True):
+            return True
+        digest = _response_repr_digest(response)
+        if digest is None:
+            return True
+        with progress['lock']:
+            expected = state.get('digest')
+            if expected is None:
+                # 探测时没有拿到摘要：从现在开始校验，已写入的部分在完成时补读
+                state['digest'] = list(digest)
+                progress['hasher'] = {'obj': hashlib.new(digest[0]), 'offset': 0}
+            elif expected[0] == digest[0] and expected[1] != digest[1]:
+                logger.error(f"服务器上的文件内容已变化（摘要不一致）: {filename}")
+                return False
+        return True
     
-    def download_converted_file(self, session, filename, target_folder):
+    def _feed_download_hasher(self, progress, pos, data):
+        """按文件顺序计算完整文件摘要：只有紧接已计算部分写入的数据才参与计算，其余部分在完成时补读"""
+        hasher = progress['hasher']
+        if hasher is None:
+            return
+        with progress['lock']:
+            if hasher['offset'] == pos:
+                hasher['obj'].update(data)
+                hasher['offset'] += len(data)
+    
+    def _reset_download_hasher(self, progress, pos):
+        """pos 之后的数据将被重新写入：已计算的摘要覆盖了这部分时从头开始计算"""
+        with progress['lock']:
+            hasher = progress['hasher']
+            if hasher is not None and hasher['offset'] > pos:
+                progress['hasher'] = {'obj': hashlib.new(progress['state']['digest'][0]), 'offset': 0}
+    
+    def _download_segment(self, session, download_url, target_path, segment, progress, filename):
+        """下载一个分段 [start, end)，segment[2] 记录该分段已写入的字节数。返回是否完成。
+        服务器为响应提供 Content-Digest 时边写边计算，不一致则只重新下载该响应覆盖的范围"""
+        max_retries = self.config.get('max_download_retries', 3)
+        buffer = bytearray(int(self.config.get('download_buffer_size_mb', 4) * 1024 * 1024))
+        view = memoryview(buffer)
+        
+        for attempt in range(max_retries + 1):
+            start, end = segment[0], segment[1]
+            pos = start + segment[2]
+            if end is not None and pos >= end:
+                return True
+            
+            headers = {}
+            if end is not None:
+                headers['Range'] = f'bytes={pos}-{end - 1}'
+            elif pos > 0:
+                headers['Range'] = f'bytes={pos}-'
+            
+            try:
+                with session.get(download_url, headers=headers, stream=True, timeout=(30, 7200), allow_redirects=True) as response:
+                    if response.status_code == 200 and pos > 0:
+                        if len(progress['state']['segments']) > 1:
+                            logger.error(f"服务器不再支持 Range 请求，无法继续分段下载: {filename}")
+                            return False
+                        logger.warning("服务器不支持 Range 请求，将重新开始下载。")
+                        with progress['lock']:
+                            segment[0], segment[2] = 0, 0
+                        pos = 0
+                        self._reset_download_hasher(progress, 0)
+                    elif response.status_code not in (200, 206):
+                        logger.error(f"下载失败 (HTTP {response.status_code}): {filename}")
+                        if 400 <= response.status_code < 500:
+                            return False
+                        raise requests.exceptions.HTTPError(f"HTTP {response.status_code}")
+                    
+                    if not self._check_download_response(response, pos, progress, filename):
+                        progress['changed'] = True
+                        return False
+                    length = response.headers.get('Content-Length')
+                    expected_length = int(length) if length and length.isdigit() else None
+                    content_digest = None
+                    if (self.config.get('download_verify', True)
+                            and response.headers.get('Content-Encoding', 'identity') == 'identity'):
+                        content_digest = _parse_digest_header(response.headers.get('Content-Digest'))
+                    content_hasher = hashlib.new(content_digest[0]) if content_digest else None
+                    response_start, written_before = pos, segment[2]
+                    
+                    # 大缓冲区 readinto：每次循环处理数 MB，而不是 8KB
+                    response.raw.decode_content = True
+                    with open(target_path, 'r+b') as f:
+                        f.seek(pos)
+                        while True:
+                            # 限速时每次只读约 1/4 秒的流量，服务器随之按 TCP 流控放慢发送
+                            n = response.raw.readinto(view[:self.download_limiter.block_size(len(buffer))])
+                            if not n:
+                                break
+                            self.download_limiter.consume(n)
+                            f.write(view[:n])
+                            if content_hasher is not None:
+                                content_hasher.update(view[:n])
+                            self._feed_download_hasher(progress, pos, view[:n])
+                            pos += n
+                            self.metrics.inc('iw3_download_bytes_total', n)
+                            with progress['lock']:
+                                segment[2] += n
+                            self._save_download_progress(progress)
+                
+                received = pos - response_start
+                if (content_hasher is not None and received == expected_length
+                        and base64.b64encode(content_hasher.digest()).decode('ascii') != content_digest[1]):
+                    # 只回退这次响应写入的范围，之前已校验或已写入的部分保留
+                    logger.warning(f"范围 {response_start}-{pos - 1} 校验失败（Content-Digest 不一致），重新下载该范围 ({filename})")
+                    self.metrics.inc('iw3_download_verify_failures_total')
+                    with progress['lock']:
+                        segment[2] = written_before
+                    self._reset_download_hasher(progress, response_start)
+                elif end is not None and segment[0] + segment[2] >= end:
+                    return True
+                elif end is None and (expected_length is None or received >= expected_length):
+                    return True
+                else:
+                    logger.warning(f"分段 {segment[0]}-{end} 连接提前结束，准备续传 ({filename})")
+            except (requests.exceptions.RequestException, Urllib3Error) as e:
+                # 直接读取 response.raw 时，连接中断抛出的是 urllib3 异常
+                logger.warning(f"请求异常 (下载 {filename}) (尝试 {attempt + 1}/{max_retries + 1}): {e}")
+            
+            if attempt < max_retries:
+                self._retry_sleep(attempt, 'download')
+        
+        logger.error(f"下载 {filename} 达到最大重试次数，失败。")
+        return False
+    
+    def _download_segments(self, session, download_url, part_path, progress, filename):
+        """下载所有未完成的分段，多个分段时并发下载。返回是否全部完成"""
+        pending = [seg for seg in progress['state']['segments'] if seg[1] is None or seg[0] + seg[2] < seg[1]]
+        if len(pending) > 1:
+            logger.info(f"分 {len(pending)} 段并发下载: {filename}")
+            with ThreadPoolExecutor(max_workers=len(pending), thread_name_prefix='download') as pool:
+                results = list(pool.map(
+                    lambda seg: self._download_segment(session, download_url, part_path, seg, progress, filename),
+                    pending
+                ))
+            return all(results)
+        return all(self._download_segment(session, download_url, part_path, seg, progress, filename) for seg in pending)
+    
+    def _verify_download_digest(self, part_path, progress, filename):
+        """与服务器提供的完整文件摘要比对。下载时已按顺序计算过的部分不再读取，
+        单连接下载完成时无需再读一遍文件；分段下载或续传时只补读其余部分"""
+        hasher = progress['hasher']
+        if hasher is None:
+            return True
+        algorithm, expected = progress['state']['digest']
+        size = os.path.getsize(part_path)
+        if hasher['offset'] < size:
+            logger.debug(f"补读 {size - hasher['offset']} 字节以计算摘要: {filename}")
+            with open(part_path, 'rb') as f:
+                f.seek(hasher['offset'])
+                for block in iter(lambda: f.read(4 * 1024 * 1024), b''):
+                    hasher['obj'].update(block)
+        if base64.b64encode(hasher['obj'].digest()).decode('ascii') != expected:
+            logger.error(f"下载文件校验失败（{algorithm} 不一致），无法确定损坏的范围，将重新下载: {filename}")
+            return False
+        logger.debug(f"下载文件校验通过 ({algorithm}): {filename}")
+        return True
+    
+    def _discard_download(self, part_path, state_path):
+        """删除临时文件和下载进度，下次从头下载"""
+        for path in (part_path, state_path):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+    
+    def _adopt_legacy_download(self, target_path, part_path, state_path):
+        """旧版本直接写入目标文件：把未完成的下载改名为 .part 继续续传（完成后仍会核对大小和摘要）"""
+        if os.path.exists(part_path) or not os.path.exists(target_path):
+            return
+        logger.info(f"将旧版本未完成的下载改为临时文件继续: {part_path}")
+        os.replace(target_path, part_path)
+        legacy_state_path = f"{target_path}.dlstate"
+        if os.path.exists(legacy_state_path):
+            os.replace(legacy_state_path, state_path)
+    
+    def _download_file(self, session, download_url, target_path, filename):
+        """下载引擎：写入 <文件名>.part，断点续传、大缓冲区写入、预分配，服务器支持 Range 时可多段并发下载。
+        完成后核对大小和服务器提供的摘要，通过后原子改名为目标文件。返回是否成功"""
+        part_path = f"{target_path}.part"
+        state_path = f"{part_path}.dlstate"
+        self._adopt_legacy_download(target_path, part_path, state_path)
+        state = self._load_download_state(state_path, download_url)
+        
+        if state is None:
+            status_code, total_size, supports_range, digest = self._probe_download(session, download_url)
+            if status_code is not None and 400 <= status_code < 500:
+                logger.error(f"下载失败 (HTTP {status_code}): {filename}")
+                return False
+            
+            # --- 断点续传逻辑（没有进度文件时，按已有临时文件大小续传）---
+            resume_byte_pos = 0
+            if os.path.exists(part_path):
+                resume_byte_pos = os.path.getsize(part_path)
+                if resume_byte_pos > 0:
+                    logger.info(f"检测到部分下载的文件，大小: {resume_byte_pos} 字节，尝试续传...")
+                else:
+                    logger.info(f"检测到空文件，重新开始下载...")
+            if resume_byte_pos > 0 and (not supports_range or (total_size is not None and resume_byte_pos > total_size)):
+                logger.warning("无法从已有文件续传，将覆盖现有文件重新下载。")
+                resume_byte_pos = 0
+                with open(part_path, 'wb'):
+                    pass
+            
+            if total_size is None:
+                segments = [[resume_byte_pos, None, 0]]
+            else:
+                remaining = total_size - resume_byte_pos
+                segment_count = 1
+                if supports_range:
+                    min_segment = int(self.config.get('download_min_segment_mb', 32) * 1024 * 1024)
+                    segment_count = max(1, min(self.config.get('download_segments', 1), remaining // max(1, min_segment)))
+                segment_size = -(-remaining // segment_count) if remaining > 0 else 1
+                segments = [[s, min(s + segment_size, total_size), 0]
+                            for s in range(resume_byte_pos, total_size, segment_size)]
+            
+            state = {'url': download_url, 'total_size': total_size, 'segments': segments,
+                     'digest': list(digest) if digest else None}
+            needed = total_size - resume_byte_pos if total_size is not None else 0
+            if not self._check_download_space(os.path.dirname(part_path), needed, filename):
+                return False
+            with open(part_path, 'ab'):
+                pass
+            if total_size and self.config.get('download_preallocate', True):
+                # 预分配后文件大小不再代表下载进度，进度以进度文件为准
+                self._preallocate_file(part_path, total_size)
+                _atomic_write_json(state_path, state)
+        
+        elif state['total_size'] is not None:
+            # 续传：预分配过的空间已经占用，只检查尚未分配的部分
+            stat = os.stat(part_path) if os.path.exists(part_path) else None
+            allocated = 0
+            if stat is not None:
+                allocated = stat.st_blocks * 512 if hasattr(stat, 'st_blocks') else stat.st_size
+            if not self._check_download_space(os.path.dirname(part_path), max(0, state['total_size'] - allocated), filename):
+                return False
+        
+        total_size = state['total_size']
+        written_before = sum(seg[2] for seg in state['segments'])
+        progress = {'state': state, 'state_path': state_path, 'lock': threading.Lock(), 'saved_at': time.monotonic(),
+                    'hasher': None, 'changed': False}
+        if state.get('digest') and self.config.get('download_verify', True):
+            progress['hasher'] = {'obj': hashlib.new(state['digest'][0]), 'offset': 0}
+        started = time.monotonic()
+        
+        ok = self._download_segments(session, download_url, part_path, progress, filename)
+        if ok and total_size is not None and os.path.getsize(part_path) < total_size:
+            # 文件比 Content-Length/Content-Range 给出的大小短：只重新下载缺失的部分
+            actual_size = os.path.getsize(part_path)
+            logger.warning(f"下载文件大小不足 ({actual_size}/{total_size} 字节)，重新下载缺失的部分: {filename}")
+            self.metrics.inc('iw3_download_verify_failures_total')
+            with progress['lock']:
+                for seg in state['segments']:
+                    if seg[0] + seg[2] > actual_size:
+                        seg[2] = max(0, actual_size - seg[0])
+            self._reset_download_hasher(progress, actual_size)
+            ok = self._download_segments(session, download_url, part_path, progress, filename)
+            if ok and os.path.getsize(part_path) < total_size:
+                logger.error(f"下载文件大小仍然不足 ({os.path.getsize(part_path)}/{total_size} 字节): {filename}")
+                ok = False
+        
+        bytes_downloaded = sum(seg[2] for seg in state['segments']) - written_before
+        if progress['changed']:
+            # 服务器上的文件已变化，已下载的部分不能再用
+            self._discard_download(part_path, state_path)
+            return False
+        if not ok:
+            if os.path.exists(state_path) or len(state['segments']) > 1:
+                self._save_download_progress(progress, force=True)
+            return False
+        
+        if total_size is not None and os.path.getsize(part_path) > total_size:
+            with open(part_path, 'r+b') as f:
+                f.truncate(total_size)
+        if not self._verify_download_digest(part_path, progress, filename):
+            self.metrics.inc('iw3_download_verify_failures_total')
+            self._discard_download(part_path, state_path)
+            return False
+        
+        # 校验通过后才改名，播放器和媒体库不会看到写了一半的文件
+        os.replace(part_path, target_path)
+        if os.path.exists(state_path):
+            os.remove(state_path)
+        elapsed = max(time.monotonic() - started, 1e-6)
+        logger.info(f"下载完成: {filename} (本次传输 {bytes_downloaded} 字节, {bytes_downloaded / elapsed / (1024 * 1024):.1f}MB/s)")
+        return True
+    
+    def download_converted_file(self, session, filename, target_folder, server_url=None):
         """
-        下载转换完成的文件，支持断点续传，并提取原始视频内封字幕。
+        下载转换完成的文件（先写入 .part 临时文件，校验后改名），支持断点续传，并将原始视频的内封字幕提取加入后台队列。
         假设服务端不修改文件名，原始视频位于 target_folder 根目录。
         """
         try:
             encoded_filename = quote(filename, safe='')
-            download_url = f"{self.config['website_url']}/download/{encoded_filename}"
+            if server_url is None:
+                server_url = self.get_servers()[0]['url']
+            download_url = f"{server_url}/download/{encoded_filename}"
             
             vr_folder = os.path.join(target_folder, 'VR')
             os.makedirs(vr_folder, exist_ok=True)
@@ -393,190 +2414,1043 @@ class AutoUploadDownload:
             
             logger.info(f"开始下载: {filename} -> {target_path}")
             
-            # --- 断点续传逻辑 ---
-            resume_byte_pos = 0
-            if os.path.exists(target_path):
-                resume_byte_pos = os.path.getsize(target_path)
-                if resume_byte_pos > 0:
-                    logger.info(f"检测到部分下载的文件，大小: {resume_byte_pos} 字节，尝试续传...")
-                else:
-                    logger.info(f"检测到空文件，重新开始下载...")
-                    resume_byte_pos = 0
-
-            max_retries = self.config.get('max_download_retries', 3)
-
-            for attempt in range(max_retries + 1):
-                try:
-                    headers = {}
-                    if resume_byte_pos > 0:
-                        headers['Range'] = f'bytes={resume_byte_pos}-'
-                    
-                    response = session.get(download_url, headers=headers, stream=True, timeout=(30, 7200), allow_redirects=True)
-
-                    if response.status_code == 200:
-                        if resume_byte_pos > 0:
-                            logger.warning("服务器不支持 Range 请求，将重新开始下载。")
-                            os.remove(target_path)
-                            resume_byte_pos = 0
-                            logger.info("将覆盖现有文件重新下载。")
-                        file_mode = 'wb'
-                        expected_status = 200
-                    elif response.status_code == 206:
-                        if resume_byte_pos == 0:
-                            logger.warning("收到 206 状态码但未请求 Range，行为异常。")
-                        file_mode = 'ab'
-                        expected_status = 206
-                    else:
-                        logger.error(f"下载失败 (HTTP {response.status_code}): {filename}")
-                        if 400 <= response.status_code < 500:
-                            return False
-                        if attempt < max_retries:
-                            logger.warning(f"HTTP 错误，准备重试...")
-                            time.sleep(self.config.get('retry_delay', 10))
-                            continue
-                        else:
-                            return False
-
-                    if response.status_code != expected_status:
-                        logger.error(f"预期状态码 {expected_status}，实际为 {response.status_code}")
-                        if attempt < max_retries:
-                            time.sleep(self.config.get('retry_delay', 10))
-                            continue
-                        else:
-                            return False
-
-                    with open(target_path, file_mode) as f:
-                        bytes_downloaded = 0
-                        for chunk in response.iter_content(chunk_size=8192):
-                            if chunk:
-                                f.write(chunk)
-                                bytes_downloaded += len(chunk)
-                    
-                    logger.info(f"下载完成: {filename} (本次传输 {bytes_downloaded} 字节)")
-                    
-                    # ✅✅✅ === 新增功能：提取原始视频内封字幕 ===
-                    # 1. 直接构建原始视频路径
-                    # 因为服务端不修改文件名，原始视频就在 target_folder 根目录下
-                    original_video_path = os.path.join(target_folder, filename)
-                    
-                    if not os.path.exists(original_video_path):
-                        logger.warning(f"原始视频文件不存在，无法提取字幕: {original_video_path}")
-                        return True  # 下载成功，字幕提取失败不影响主流程
-
-                    # 2. 构建 ffmpeg 路径
-                    script_dir = Path(__file__).parent
-                    ffmpeg_path = script_dir / "bin" / "ffmpeg.exe"
-                    if not ffmpeg_path.exists():
-                        logger.warning(f"ffmpeg 未找到: {ffmpeg_path}，跳过字幕提取")
-                        return True
-
-                    # 3. 使用 ffprobe 分析字幕流
-                    try:
-                        import subprocess
-                        cmd_probe = [
-                            str(ffmpeg_path), '-v', 'error', '-select_streams', 's', 
-                            '-show_entries', 'stream=index:stream=codec_type', 
-                            '-of', 'json', original_video_path
-                        ]
-                        result = subprocess.run(cmd_probe, capture_output=True, text=True, check=False)
-                        
-                        if result.returncode != 0:
-                            logger.debug(f"ffprobe 分析字幕流失败: {result.stderr}")
-                            return True
-
-                        try:
-                            streams_info = json.loads(result.stdout)
-                            text_subtitle_streams = []
-                            for stream in streams_info.get('streams', []):
-                                if (stream.get('codec_type') == 'subtitle' and 
-                                    stream.get('codec_name') in ['srt', 'ass', 'subrip', 'text']):
-                                    text_subtitle_streams.append(stream)
-                            
-                            if not text_subtitle_streams:
-                                logger.info(f"原始视频无内封文本字幕，跳过提取: {os.path.basename(original_video_path)}")
-                                return True
-
-                            # 提取第一个文本字幕流
-                            target_subtitle_path = os.path.join(vr_folder, f"{Path(filename).stem}.srt")
-                            if os.path.exists(target_subtitle_path):
-                                logger.info(f"字幕文件已存在，跳过提取: {target_subtitle_path}")
-                                return True
-
-                            stream_index = text_subtitle_streams[0]['index']
-                            cmd_extract = [
-                                str(ffmpeg_path), '-i', original_video_path, 
-                                '-map', f'0:{stream_index}', '-c:s', 'srt', 
-                                '-y', target_subtitle_path
-                            ]
-                            
-                            logger.info(f"正在提取字幕流 {stream_index} -> {target_subtitle_path}")
-                            result_extract = subprocess.run(cmd_extract, capture_output=True, text=True, check=False)
-                            
-                            if result_extract.returncode == 0:
-                                logger.info(f"✅ 字幕提取成功: {target_subtitle_path}")
-                            else:
-                                logger.warning(f"⚠️ 字幕提取失败 (ffmpeg): {result_extract.stderr}")
-                            
-                        except json.JSONDecodeError as e:
-                            logger.error(f"解析 ffprobe 输出失败: {e}")
-                            
-                    except Exception as e:
-                        logger.error(f"执行 ffmpeg 提取字幕时发生错误: {e}")
-                    
-                    # ✅✅✅ === 新增功能结束 ===
-                    
-                    return True
-
-                except requests.exceptions.RequestException as e:
-                    logger.warning(f"请求异常 (下载 {filename}) (尝试 {attempt + 1}/{max_retries + 1}): {e}")
-                    if attempt < max_retries:
-                        time.sleep(self.config.get('retry_delay', 10))
-                    else:
-                        logger.error(f"下载 {filename} 达到最大重试次数，失败。")
-                        return False
-                except OSError as e:
-                    logger.error(f"文件系统错误 (下载 {filename}): {e}")
-                    return False
-                except Exception as e:
-                    logger.error(f"下载文件失败 {filename}: {e}")
+            try:
+                if not self._download_file(session, download_url, target_path, filename):
                     return False
-
-            return False
+            except OSError as e:
+                logger.error(f"文件系统错误 (下载 {filename}): {e}")
+                return False
+            
+            # 字幕提取交给后台线程，下载和状态轮询不等待 ffmpeg
+            self.enqueue_subtitle_job(filename, target_folder)
+            return True
                 
         except Exception as e:
             logger.error(f"下载文件 {filename} 发生未知错误: {e}")
             return False
     
+    def find_tool(self, name):
+        """查找 ffmpeg/ffprobe：优先使用脚本目录 bin/ 下的程序，其次在 PATH 中查找"""
+        with self.history_lock:
+            if name in self._tool_paths:
+                return self._tool_paths[name]
+        
+        bin_dir = Path(__file__).parent / 'bin'
+        candidate = bin_dir / (f"{name}.exe" if os.name == 'nt' else name)
+        tool_path = str(candidate) if candidate.is_file() else shutil.which(name)
+        if tool_path is None:
+            logger.warning(f"未找到 {name}（{bin_dir} 或 PATH），将跳过媒体探测和字幕提取")
+        with self.history_lock:
+            self._tool_paths[name] = tool_path
+        return tool_path
+    
+    def _set_subtitle_job(self, original_video_path, **fields):
+        """更新字幕提取任务记录并保存"""
+        with self.history_lock:
+            jobs = self.history.setdefault('subtitle_jobs', {})
+            job = jobs.setdefault(original_video_path, {})
+            job.update(fields)
+            self.save_history_record('subtitle_jobs', original_video_path)
+    
+    def _get_subtitle_queue(self):
+        """字幕提取队列及其后台线程（首次使用时创建）"""
+        with self.history_lock:
+            if self._subtitle_queue is None:
+                self._subtitle_queue = queue.Queue(maxsize=max(1, self.config.get('subtitle_queue_size', 64)))
+                for i in range(max(1, self.config.get('subtitle_workers', 1))):
+                    thread = threading.Thread(target=self._subtitle_worker_loop, name=f'subtitle-{i}', daemon=True)
+                    thread.start()
+                    self._subtitle_threads.append(thread)
+            return self._subtitle_queue
+    
+    def enqueue_subtitle_job(self, filename, target_folder):
+        """将原始视频的字幕提取加入后台队列，不等待执行；队列已满时留待下次扫描"""
+        if not self.config.get('subtitle_extraction', True):
+            return False
+        original_video_path = os.path.join(target_folder, filename)
+        with self.history_lock:
+            if original_video_path in self._subtitle_queued:
+                return True
+            job = self.history.get('subtitle_jobs', {}).get(original_video_path)
+            if job is None or job.get('status') != 'pending':
+                self._set_subtitle_job(original_video_path, filename=filename, target_folder=target_folder,
+                                       status='pending', queued_at=datetime.now().isoformat())
+            try:
+                self._get_subtitle_queue().put_nowait((original_video_path, filename, target_folder))
+            except queue.Full:
+                logger.info(f"字幕提取队列已满，稍后处理: {filename}")
+                return False
+            self._subtitle_queued.add(original_video_path)
+        return True
+    
+    def requeue_subtitle_jobs(self):
+        """将历史记录中仍为 pending 的字幕提取任务重新加入队列"""
+        with self.history_lock:
+            pending = [(job['filename'], job['target_folder'])
+                       for path, job in self.history.get('subtitle_jobs', {}).items()
+                       if job.get('status') == 'pending' and path not in self._subtitle_queued]
+        for filename, target_folder in pending:
+            if not self.enqueue_subtitle_job(filename, target_folder):
+                break
+    
+    def _subtitle_worker_loop(self):
+        """字幕提取线程：逐个执行队列中的任务，直到 close()"""
+        job_queue = self._subtitle_queue
+        while not self._subtitle_stop.is_set():
+            try:
+                original_video_path, filename, target_folder = job_queue.get(timeout=1)
+            except queue.Empty:
+                continue
+            started = time.monotonic()
+            try:
+                self._extract_embedded_subtitles(original_video_path, filename, target_folder)
+                with self.history_lock:
+                    result = self.history.get('subtitle_jobs', {}).get(original_video_path, {}).get('status')
+                self.metrics.observe('iw3_subtitle_seconds', time.monotonic() - started, result=result)
+            except Exception as e:
+                logger.error(f"提取字幕时发生错误 {filename}: {e}")
+                self._set_subtitle_job(original_video_path, status='failed', error=str(e),
+                                       finished_at=datetime.now().isoformat())
+            finally:
+                with self.history_lock:
+                    self._subtitle_queued.discard(original_video_path)
+                job_queue.task_done()
+            # 字幕已提取（或失败），可以按保留策略处理原始视频
+            self.apply_retention(original_video_path)
+    
+    def _folder_info_for(self, path):
+        """原视频所属的监控文件夹配置（最长前缀匹配），找不到时返回 None"""
+        best = None
+        for folder_info in self.config['folders_to_monitor']:
+            root = os.path.join(folder_info['path'], '')
+            if path.startswith(root) and (best is None or len(root) > len(os.path.join(best['path'], ''))):
+                best = folder_info
+        return best
+    
+    def _retention_action(self, path):
+        folder_info = self._folder_info_for(path) or {}
+        return folder_info.get('after_download_action', self.config.get('after_download_action', 'keep'))
+    
+    def schedule_retention(self, original_video_path):
+        """下载完成后标记原始视频等待按 after_download_action 处理；需要提取字幕时由字幕线程完成后处理"""
+        action = self._retention_action(original_video_path)
+        if action not in ('delete', 'move'):
+            return
+        with self.history_lock:
+            record = self.history['downloaded_files'].get(original_video_path)
+            if record is None:
+                return
+            record['source_action'] = 'pending'
+            self.save_history_record('downloaded_files', original_video_path)
+            waiting_for_subtitles = (original_video_path in self._subtitle_queued or
+                                     self.history.get('subtitle_jobs', {}).get(original_video_path, {}).get('status') == 'pending')
+        if not waiting_for_subtitles:
+            self.apply_retention(original_video_path)
+    
+    def apply_pending_retention(self):
+        """处理上次未完成（例如等待字幕提取时退出）的原始视频保留策略"""
+        with self.history_lock:
+            paths = [path for path, record in self.history['downloaded_files'].items()
+                     if record.get('source_action') == 'pending' and path not in self._subtitle_queued and
+                     self.history.get('subtitle_jobs', {}).get(path, {}).get('status') != 'pending']
+        for path in paths:
+            self.apply_retention(path)
+    
+    def apply_retention(self, original_video_path):
+        """转换结果已下载并通过校验后，按 after_download_action 删除原始视频或移动到 after_download_move_to。
+        只处理下载时已标记为 pending 的记录，启用该设置前下载的文件不受影响"""
+        with self.history_lock:
+            record = self.history['downloaded_files'].get(original_video_path)
+            if not record or record.get('source_action') != 'pending':
+                return
+            record['source_action'] = 'running'  # 字幕线程和下载线程可能同时调用，只处理一次
+            output_path = os.path.join(record['target_folder'], 'VR', record['original_filename'])
+        action = self._retention_action(original_video_path)
+        
+        result = None
+        moved_to = None
+        try:
+            if action not in ('delete', 'move'):
+                result = 'kept'
+            elif not os.path.exists(original_video_path):
+                result = 'missing'
+            elif not os.path.isfile(output_path) or os.path.getsize(output_path) == 0:
+                logger.warning(f"找不到下载的转换结果，保留原始视频: {original_video_path}")
+                result = 'kept'
+            elif action == 'delete':
+                os.remove(original_video_path)
+                logger.info(f"已删除原始视频: {original_video_path}")
+                result = 'deleted'
+            else:
+                move_to = self.config.get('after_download_move_to', '')
+                if not move_to:
+                    logger.warning("after_download_action 为 move 但未设置 after_download_move_to，保留原始视频")
+                    result = 'kept'
+                else:
+                    folder_info = self._folder_info_for(original_video_path)
+                    relative = (os.path.relpath(original_video_path, folder_info['path']) if folder_info
+                                else os.path.basename(original_video_path))
+                    destination = os.path.join(move_to, relative)
+                    if os.path.exists(destination):
+                        logger.warning(f"目标位置已有同名文件，保留原始视频: {destination}")
+                        result = 'kept'
+                    else:
+                        os.makedirs(os.path.dirname(destination), exist_ok=True)
+                        shutil.move(original_video_path, destination)
+                        logger.info(f"已移动原始视频: {original_video_path} -> {destination}")
+                        moved_to = destination
+                        result = 'moved'
+        except OSError as e:
+            logger.error(f"处理原始视频失败 {original_video_path}: {e}")
+            result = 'pending'  # 下次执行时重试
+        
+        # 历史记录可能正在被其他线程写入文件，只在持有锁时修改
+        with self.history_lock:
+            record['source_action'] = result
+            if moved_to:
+                record['source_moved_to'] = moved_to
+            self.save_history_record('downloaded_files', original_video_path)
+    
+    def get_media_info(self, file_path):
+        """获取视频的时长、分辨率、编码和字幕流，按内容指纹缓存在历史记录中，同一内容只运行一次 ffprobe"""
+        fingerprint = self.get_content_fingerprint(file_path)
+        if fingerprint:
+            with self.history_lock:
+                cached = self.history.get('media_probe', {}).get(fingerprint)
+            # 旧版缓存没有单独记录立体标记，重新探测一次
+            if cached is not None and 'stereo_tagged' in cached:
+                return cached
+        
+        ffprobe_path = self.find_tool('ffprobe')
+        if not ffprobe_path:
+            return None
+        cmd_probe = [ffprobe_path, '-v', 'error', '-show_format', '-show_streams', '-of', 'json', file_path]
+        started = time.monotonic()
+        try:
+            result = subprocess.run(cmd_probe, capture_output=True, text=True, check=False,
+                                    timeout=self.config.get('media_probe_timeout_seconds', 60))
+        except (OSError, subprocess.TimeoutExpired) as e:
+            logger.warning(f"ffprobe 运行失败 {file_path}: {e}")
+            return None
+        finally:
+            self.metrics.observe('iw3_probe_seconds', time.monotonic() - started)
+        if result.returncode != 0:
+            logger.warning(f"ffprobe 分析视频失败 {file_path}: {result.stderr.strip()}")
+            return None
+        try:
+            probe = json.loads(result.stdout)
+        except json.JSONDecodeError as e:
+            logger.error(f"解析 ffprobe 输出失败: {e}")
+            return None
+        
+        streams = probe.get('streams', [])
+        video_stream = next((stream for stream in streams if stream.get('codec_type') == 'video'
+                             and not stream.get('disposition', {}).get('attached_pic')), {})
+        try:
+            duration = float(probe.get('format', {}).get('duration') or video_stream.get('duration'))
+        except (TypeError, ValueError):
+            duration = None
+        subtitle_streams = []
+        for stream in streams:
+            if stream.get('codec_type') != 'subtitle':
+                continue
+            language = stream.get('tags', {}).get('language')
+            subtitle_streams.append({
+                'index': stream['index'],
+                'codec_name': stream.get('codec_name'),
+                'tags': {'language': language} if language else {}
+            })
+        info = {
+            'duration': duration,
+            'width': video_stream.get('width'),
+            'height': video_stream.get('height'),
+            'codec': video_stream.get('codec_name'),
+            'stereo_tagged': self._has_stereo_tag(video_stream),
+            'subtitle_streams': subtitle_streams,
+            'probed_at': datetime.now().isoformat()
+        }
+        logger.debug(f"媒体信息 {file_path}: {info}")
+        
+        if fingerprint:
+            with self.history_lock:
+                self.history.setdefault('media_probe', {})[fingerprint] = info
+            self.defer_history_record('media_probe', fingerprint)
+        return info
+    
+    @staticmethod
+    def _has_stereo_tag(video_stream):
+        """视频流是否带有立体标记（stereo_mode 标签或 Stereo 3D side data）"""
+        tags = {key.lower(): str(value).lower() for key, value in video_stream.get('tags', {}).items()}
+        if tags.get('stereo_mode', 'mono') != 'mono':
+            return True
+        return any(side_data.get('side_data_type') == 'Stereo 3D' for side_data in video_stream.get('side_data_list', []))
+    
+    def _is_stereo_3d(self, file_path, info):
+        """根据流的立体标记、画面比例和文件名判断视频是否已经是 3D/SBS。
+        文件名中的 SBS/TAB/3D 等标记可能只是普通标题的一部分，只有画面比例也像 3D
+        （全宽 SBS 或全高 TAB）或开启 skip_3d_by_filename 时才采信"""
+        if info.get('stereo_tagged'):
+            return True
+        width, height = info.get('width'), info.get('height')
+        ratio = width / height if width and height else None
+        if ratio and ratio >= 3.2:
+            return True  # 全宽 SBS，例如 3840x1080
+        if not STEREO_3D_NAME_PATTERN.search(Path(file_path).stem):
+            return False
+        if self.config.get('skip_3d_by_filename', False) or (ratio and (ratio <= 1.0 or ratio >= 2.5)):
+            return True  # 例如全高 TAB 1920x2160、4:3 全宽 SBS 2880x1080
+        with self.history_lock:
+            first_time = file_path not in self._name_only_3d
+            self._name_only_3d.add(file_path)
+        if first_time:
+            logger.info(f"文件名带有 3D/SBS 标记，但视频流没有立体标记、画面比例也不像 3D，照常转换"
+                        f"（确认是 3D 时可开启 skip_3d_by_filename 或用 exclude 排除）: {file_path}")
+        return False
+    
+    def prepare_videos(self, videos, workers=1):
+        """上传前探测：记录媒体信息（用于排序），并跳过已经是 3D/SBS 的视频。workers 大于 1 时并行运行 ffprobe"""
+        if not self.config.get('media_probe', True):
+            return videos
+        
+        if workers > 1 and len(videos) > 1:
+            with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='probe') as pool:
+                infos = list(pool.map(lambda video: self.get_media_info(video['path']), videos))
+        else:
+            infos = [self.get_media_info(video['path']) for video in videos]
+        
+        self.flush_history()
+        
+        prepared = []
+        for video, info in zip(videos, infos):
+            video['media_info'] = info
+            if info and self.config.get('skip_3d_sources', True) and self._is_stereo_3d(video['path'], info):
+                with self.history_lock:
+                    first_time = video['path'] not in self._skipped_3d
+                    self._skipped_3d.add(video['path'])
+                (logger.info if first_time else logger.debug)(f"视频已是 3D/SBS 格式，跳过: {video['path']}")
+                continue
+            prepared.append(video)
+        return prepared
+    
+    def _extract_embedded_subtitles(self, original_video_path, filename, target_folder):
+        """一次 ffmpeg 调用提取原始视频的全部内封文本字幕到 VR 文件夹，结果写入历史记录"""
+        # 因为服务端不修改文件名，原始视频就在 target_folder 根目录下
+        if not os.path.exists(original_video_path):
+            logger.warning(f"原始视频文件不存在，无法提取字幕: {original_video_path}")
+            self._set_subtitle_job(original_video_path, status='skipped', error='source missing',
+                                   finished_at=datetime.now().isoformat())
+            return
+        
+        ffmpeg_path = self.find_tool('ffmpeg')
+        # 上传前已探测过的视频直接使用缓存的字幕流信息
+        media_info = self.get_media_info(original_video_path) if ffmpeg_path else None
+        streams = media_info['subtitle_streams'] if media_info else None
+        if streams is None:
+            self._set_subtitle_job(original_video_path, status='skipped', error='ffmpeg/ffprobe unavailable',
+                                   finished_at=datetime.now().isoformat())
+            return
+        
+        text_streams = [stream for stream in streams if stream.get('codec_name') in TEXT_SUBTITLE_CODECS]
+        if not text_streams:
+            logger.info(f"原始视频无内封文本字幕，跳过提取: {filename}")
+            self._set_subtitle_job(original_video_path, status='none', finished_at=datetime.now().isoformat())
+            return
+        
+        # 第一条字幕使用与视频同名的文件，其余按 <文件名>.<流序号>[.<语言>] 命名
+        vr_folder = os.path.join(target_folder, 'VR')
+        stem = Path(filename).stem
+        cmd_extract = [ffmpeg_path, '-nostdin', '-v', 'error', '-y', '-i', original_video_path]
+        outputs = []
+        for n, stream in enumerate(text_streams):
+            extension, codec = TEXT_SUBTITLE_CODECS[stream['codec_name']]
+            if extension == 'ass' and not self.config.get('subtitle_keep_ass', False):
+                extension, codec = 'srt', 'srt'  # VR 播放器通常只加载 .srt
+            language = (stream.get('tags') or {}).get('language')
+            if n == 0:
+                name = f"{stem}.{extension}"
+            else:
+                name = f"{stem}.{stream['index']}.{language}.{extension}" if language else f"{stem}.{stream['index']}.{extension}"
+            target_subtitle_path = os.path.join(vr_folder, name)
+            if os.path.exists(target_subtitle_path):
+                logger.info(f"字幕文件已存在，跳过提取: {target_subtitle_path}")
+                continue
+            cmd_extract += ['-map', f"0:{stream['index']}", '-c:s', codec, target_subtitle_path]
+            outputs.append(target_subtitle_path)
+        
+        if outputs:
+            logger.info(f"正在提取 {len(outputs)} 条字幕流: {filename}")
+            started = time.monotonic()
+            result = subprocess.run(cmd_extract, capture_output=True, text=True, check=False,
+                                    timeout=self.config.get('subtitle_timeout_seconds', 3600))
+            if result.returncode != 0:
+                logger.warning(f"⚠️ 字幕提取失败 (ffmpeg): {result.stderr.strip()}")
+                for path in outputs:
+                    if os.path.exists(path):
+                        os.remove(path)
+                self._set_subtitle_job(original_video_path, status='failed', error=result.stderr.strip()[-500:],
+                                       finished_at=datetime.now().isoformat())
+                return
+            logger.info(f"✅ 字幕提取成功: {', '.join(os.path.basename(path) for path in outputs)} "
+                        f"({time.monotonic() - started:.1f}s)")
+        
+        self._set_subtitle_job(original_video_path, status='done', error=None,
+                               subtitles=[os.path.basename(path) for path in outputs],
+                               finished_at=datetime.now().isoformat())
+    
+    def get_servers(self):
+        """转换服务器列表 [{'url', 'weight', 'max_concurrent_jobs'}]：配置了 servers 时使用它，否则使用 website_url"""
+        servers = []
+        for server in self.config.get('servers') or [self.config['website_url']]:
+            if isinstance(server, str):
+                server = {'url': server}
+            servers.append({
+                'url': server['url'].rstrip('/'),
+                'weight': max(0.01, float(server.get('weight', 1))),
+                'max_concurrent_jobs': int(server.get('max_concurrent_jobs', self.config.get('max_in_flight_per_server', 3)))
+            })
+        return servers
+    
+    def _server_outstanding(self, server_url):
+        """某个服务器上已上传、尚未下载的任务数（调用方持有 history_lock）"""
+        return len(self._pending_by_server.get(server_url, ()))
+    
+    def _is_pending_expired(self, info, now=None):
+        """已上传超过 pending_expiry_hours 仍未下载的任务：服务器多半已经丢失（重启或删除了任务），
+        不再占用并发名额和磁盘空间估算，但状态轮询仍会继续检查，转换结果出现时照常下载"""
+        hours = self.config.get('pending_expiry_hours', 24)
+        if not hours:
+            return False
+        try:
+            uploaded_at = datetime.fromisoformat(info['uploaded_at'])
+        except (KeyError, TypeError, ValueError):
+            return True  # 无法判断上传时间的旧记录
+        return ((now or datetime.now()) - uploaded_at).total_seconds() > hours * 3600
+    
+    def _server_active_pending(self, server_url):
+        """某个服务器上已上传、尚未下载且未过期的任务数（调用方持有 history_lock）"""
+        now = datetime.now()
+        return sum(1 for path in self._pending_by_server.get(server_url, ())
+                   if not self._is_pending_expired(self.history['uploaded_files'][path], now))
+    
+    def _remote_name_busy(self, server_url, filename, video_path, now=None):
+        """服务器上是否已有来自其他文件夹的同名任务正在上传或等待下载（调用方持有 history_lock）。
+        服务器按文件名保存转换结果，同名任务同时存在时无法区分结果属于哪个原始文件；
+        已过期（服务器多半已丢失）的任务不再阻塞"""
+        uploading = self._uploading_names.get((server_url, filename))
+        if uploading is not None and uploading != video_path:
+            return True
+        return any(path != video_path and not self._is_pending_expired(self.history['uploaded_files'][path], now)
+                   for path in self._pending_by_name.get((server_url, filename), ()))
+    
+    def acquire_server(self, video_path, reserved=0):
+        """为一个文件选择转换服务器：优先沿用未完成的续传会话所在服务器，
+        否则选择 (服务器队列长度或未完成任务数 + 正在上传数) / 权重 最小的服务器。
+        已有同名任务的服务器不参与选择；所有服务器都达到 max_concurrent_jobs（减去保留的 reserved 个名额）
+        或都有同名任务时返回 None，任务留在本地队列中。选中后须调用 release_server"""
+        filename = os.path.basename(video_path)
+        with self.history_lock:
+            candidates = []
+            name_busy = False
+            now = datetime.now()
+            for order, server in enumerate(self.get_servers()):
+                url = server['url']
+                if self._remote_name_busy(url, filename, video_path, now):
+                    name_busy = True
+                    continue
+                pending = self._server_active_pending(url)
+                uploading = self._server_uploading.get(url, 0)
+                limit = server['max_concurrent_jobs']
+                if limit and pending + uploading >= limit:
+                    if url not in self._capped_servers:
+                        self._capped_servers.add(url)
+                        expiry = self.config.get('pending_expiry_hours', 24)
+                        logger.info(f"服务器 {url} 已达到任务上限 {limit}: {pending} 个已上传任务等待转换结果，"
+                                    f"{uploading} 个正在上传，新任务在本地队列中等待"
+                                    + (f"（超过 {expiry} 小时未完成的任务不计入）" if expiry else ""))
+                    continue
+                self._capped_servers.discard(url)
+                if limit and pending + uploading >= max(1, limit - reserved):
+                    continue
+                # 服务器在 /api/status 中报告了队列长度时，以它为准（包含其他客户端提交的任务）
+                queue_depth = self._server_queue_depth.get(url)
+                queued = pending if queue_depth is None else max(queue_depth, pending)
+                candidates.append(((queued + uploading) / server['weight'], order, url))
+            if not candidates:
+                if name_busy and video_path not in self._name_conflicts:
+                    self._name_conflicts.add(video_path)
+                    logger.info(f"其他文件夹中的同名文件 {filename} 正在服务器上转换，等它下载完成后再上传: {video_path}")
+                return None
+            self._name_conflicts.discard(video_path)
+            
+            saved = self.history.get('upload_sessions', {}).get(video_path)
+            saved_url = (saved or {}).get('server_url', '').rstrip('/')
+            server_url = saved_url if any(url == saved_url for _, _, url in candidates) else min(candidates)[2]
+            self._server_uploading[server_url] = self._server_uploading.get(server_url, 0) + 1
+            self._uploading_names[(server_url, filename)] = video_path
+        if len(candidates) > 1:
+            logger.debug(f"为 {os.path.basename(video_path)} 选择服务器 {server_url}，候选负载: "
+                         f"{[(url, round(score, 2)) for score, _, url in candidates]}")
+        return server_url
+    
+    def release_server(self, server_url, video_path):
+        """上传结束（成功后任务已计入未完成任务数）后释放 acquire_server 占用的名额"""
+        with self.history_lock:
+            key = (server_url, os.path.basename(video_path))
+            if self._uploading_names.get(key) == video_path:
+                del self._uploading_names[key]
+            self._server_uploading[server_url] -= 1
+            if not self._server_uploading[server_url]:
+                del self._server_uploading[server_url]
+    
+    def current_rate_limits(self, now=None):
+        """按 bandwidth_schedule 中当前所在的时间段返回 (上传, 下载) 速率上限（字节/秒，0 为不限速）。
+        时间段的结束时间早于开始时间表示跨过午夜，未写明的方向使用 upload/download_rate_limit_mb"""
+        now = now or datetime.now()
+        upload = self.config.get('upload_rate_limit_mb', 0)
+        download = self.config.get('download_rate_limit_mb', 0)
+        minute = now.hour * 60 + now.minute
+        for window in self.config.get('bandwidth_schedule') or []:
+            try:
+                start_hour, start_minute = map(int, str(window['start']).split(':'))
+                end_hour, end_minute = map(int, str(window['end']).split(':'))
+            except (KeyError, TypeError, ValueError):
+                if repr(window) not in self._schedule_warned:
+                    self._schedule_warned.add(repr(window))
+                    logger.warning(f"忽略格式错误的限速时间段（需要 HH:MM 格式的 start/end）: {window}")
+                continue
+            start, end = start_hour * 60 + start_minute, end_hour * 60 + end_minute
+            inside = start <= minute < end if start <= end else (minute >= start or minute < end)
+            if inside:
+                upload = window.get('upload_rate_limit_mb', upload)
+                download = window.get('download_rate_limit_mb', download)
+                break
+        mb = 1024 * 1024
+        return int((upload or 0) * mb), int((download or 0) * mb)
+    
+    def refresh_rate_limits(self):
+        """重新读取修改过的配置文件并按当前时间段更新限速，正在进行的传输立即按新速率继续"""
+        self.reload_live_config()
+        limits = self.current_rate_limits()
+        if limits == self._rate_limits:
+            return
+        self._rate_limits = limits
+        self.upload_limiter.set_rate(limits[0])
+        self.download_limiter.set_rate(limits[1])
+        describe = lambda rate: f"{rate / (1024 * 1024):.1f}MB/s" if rate else "不限速"
+        logger.info(f"传输限速: 上传 {describe(limits[0])}，下载 {describe(limits[1])}")
+    
+    def _collect_metrics(self):
+        """导出指标时采集当前的队列长度"""
+        with self.history_lock:
+            gauges = [
+                ('iw3_job_queue_depth', {}, len(self._job_queue)),
+                ('iw3_uploads_in_progress', {}, len(self._uploads_in_progress)),
+                ('iw3_subtitle_queue_depth', {}, len(self._subtitle_queued)),
+                ('iw3_rate_limit_bytes_per_second', {'direction': 'upload'}, self.upload_limiter.rate),
+                ('iw3_rate_limit_bytes_per_second', {'direction': 'download'}, self.download_limiter.rate),
+            ]
+            for server_url in {server['url'] for server in self.get_servers()} | set(self._pending_by_server):
+                gauges.append(('iw3_pending_jobs', {'server': server_url}, self._server_outstanding(server_url)))
+            for server_url, queue_depth in self._server_queue_depth.items():
+                gauges.append(('iw3_server_queue_depth', {'server': server_url}, queue_depth))
+        for volume in self.disk_status().values():
+            gauges.append(('iw3_disk_free_bytes', {'path': volume['path']}, volume['free']))
+            gauges.append(('iw3_disk_committed_bytes', {'path': volume['path']}, volume['committed']))
+        return gauges
+    
+    def start_metrics_exporter(self):
+        """按配置启动指标 HTTP 接口（metrics_port）和/或定期写入 textfile（metrics_textfile）"""
+        if not self.metrics.enabled:
+            return
+        port = self.config.get('metrics_port', 0)
+        if port and self._metrics_server is None:
+            try:
+                server = http.server.ThreadingHTTPServer((self.config.get('metrics_bind', '127.0.0.1'), port), _MetricsHandler)
+            except OSError as e:
+                logger.error(f"启动指标接口失败 (端口 {port}): {e}")
+            else:
+                server.daemon_threads = True
+                server.metrics = self.metrics
+                self._metrics_server = server
+                threading.Thread(target=server.serve_forever, name='metrics-http', daemon=True).start()
+                logger.info(f"指标接口已启动: http://{self.config.get('metrics_bind', '127.0.0.1')}:{port}/metrics")
+        
+        textfile = self.config.get('metrics_textfile', '')
+        if textfile and self._metrics_writer is None:
+            self._metrics_writer = threading.Thread(target=self._metrics_textfile_loop, args=(textfile,),
+                                                    name='metrics-textfile', daemon=True)
+            self._metrics_writer.start()
+            logger.info(f"指标将定期写入: {textfile}")
+    
+    def _metrics_textfile_loop(self, textfile):
+        """定期把指标原子写入 textfile（供 node_exporter textfile collector 读取）"""
+        interval = max(1, self.config.get('metrics_textfile_seconds', 15))
+        while True:
+            try:
+                tmp_path = f"{textfile}.tmp"
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    f.write(self.metrics.render())
+                os.replace(tmp_path, textfile)
+            except OSError as e:
+                logger.warning(f"写入指标文件失败 {textfile}: {e}")
+            if self._stop_event.wait(interval):
+                return
+    
+    def _get_server_semaphore(self, server_url):
+        """获取限制单个服务器并发上传数的信号量"""
+        with self.history_lock:
+            if server_url not in self._server_semaphores:
+                self._server_semaphores[server_url] = threading.BoundedSemaphore(
+                    max(1, self.config.get('max_uploads_per_server', 2))
+                )
+            return self._server_semaphores[server_url]
+    
+    def _get_upload_executor(self):
+        """扫描和文件夹监听共用的上传线程池，总并发数为 upload_concurrency"""
+        with self.history_lock:
+            if self._upload_executor is None:
+                self._upload_executor = ThreadPoolExecutor(
+                    max_workers=max(1, self.config.get('upload_concurrency', 2)),
+                    thread_name_prefix='upload'
+                )
+            return self._upload_executor
+    
+    def _upload_worker(self, video, server_url):
+        """上传线程入口：同一文件不会被重复上传，且遵守单服务器并发上限。
+        server_url 由 dispatch_jobs 选定，结束后释放名额并提交队列中的下一个任务"""
+        video_path = video['path']
+        try:
+            with self.history_lock:
+                if video_path in self._uploads_in_progress:
+                    logger.info(f"文件正在上传中，跳过: {video_path}")
+                    return None
+                self._uploads_in_progress.add(video_path)
+            
+            try:
+                # 以下检查可能读取文件计算内容指纹，不持有 history_lock，以免阻塞轮询和其他上传
+                # 排队期间文件可能已被移走，或已被另一路（监听/扫描）上传完成
+                if not os.path.isfile(video_path):
+                    logger.debug(f"文件已不存在，跳过: {video_path}")
+                    return None
+                # 排队期间文件又被写入过，等待下一次检查
+                if not self.is_file_stable(video_path):
+                    logger.info(f"文件在排队期间发生变化，稍后再上传: {video_path}")
+                    return None
+                if self.is_file_processed(video_path):
+                    self._forget_file_stability(video_path)
+                    logger.debug(f"跳过已处理的文件: {video_path}")
+                    return None
+                with self._get_server_semaphore(server_url):
+                    started = time.monotonic()
+                    success = self.upload_video(
+                        video_path, 
+                        video['folder_info']['additional_args'],
+                        video['target_folder'],
+                        server_url
+                    )
+                    self.metrics.observe('iw3_upload_seconds', time.monotonic() - started, server=server_url,
+                                         result='ok' if success else 'error')
+                    return success
+            finally:
+                with self.history_lock:
+                    self._uploads_in_progress.discard(video_path)
+        finally:
+            with self.history_lock:
+                self.release_server(server_url, video_path)
+                self._dispatched_paths.discard(video_path)
+            self.dispatch_jobs()
+    
+    def _log_upload_result(self, video, future):
+        """记录上传任务的结果"""
+        try:
+            success = future.result()
+            if success:
+                logger.info(f"成功上传: {video['path']}")
+            elif success is not None:
+                logger.error(f"上传失败: {video['path']}")
+        except Exception as e:
+            logger.error(f"处理视频失败 {video['path']}: {e}")
+    
+    def _is_fresh(self, video):
+        """修改时间在 fresh_hours 内的视频视为新剧集"""
+        fresh_hours = self.config.get('fresh_hours', 48)
+        return fresh_hours > 0 and time.time() - video['mtime'] < fresh_hours * 3600
+    
+    def _job_sort_key(self, video):
+        """任务排序：文件夹优先级高的在前，同一优先级内新剧集在前，再按 upload_order 排序"""
+        order = self.config.get('upload_order', 'priority')
+        info = video.get('media_info')
+        duration = info['duration'] if info and info.get('duration') is not None else float('inf')
+        if order == 'scan':
+            secondary = video['seq']
+        elif order == 'newest_first':
+            secondary = -video['mtime']
+        else:  # shortest_first 及其别名 priority（默认值）: 时长短的先上传
+            secondary = duration
+        return (-video['folder_info'].get('priority', 0), not self._is_fresh(video), secondary, video['seq'])
+    
+    def schedule_videos(self, videos):
+        """把视频加入本地任务队列（已在队列中的会被更新），并尝试按空闲名额提交上传"""
+        with self.history_lock:
+            for video in videos:
+                video_path = video['path']
+                if video_path in self._dispatched_paths:
+                    continue
+                try:
+                    video['mtime'] = os.path.getmtime(video_path)
+                except OSError:
+                    continue
+                queued = self._job_queue.get(video_path)
+                video['seq'] = queued['seq'] if queued else next(self._job_seq)
+                self._job_queue[video_path] = video
+        return self.dispatch_jobs()
+    
+    def dispatch_jobs(self):
+        """按优先级从本地队列提交上传任务，返回本次提交的任务数。
+        同时提交的任务不超过 upload_concurrency，其余留在本地队列，新加入的高优先级任务可以插到前面；
+        每个服务器已上传未下载加正在上传的任务不超过 max_in_flight_per_server，
+        其中 fresh_reserved_slots 个名额只留给新剧集，积压的旧文件不会占满服务器队列；
+        输出磁盘剩余空间不足以容纳已提交任务的转换结果时暂停提交该磁盘上的任务"""
+        dispatched = 0
+        with self.history_lock:
+            if self._stop_event.is_set() or not self._job_queue:
+                return 0
+            capacity = max(1, self.config.get('upload_concurrency', 2)) - len(self._dispatched_paths)
+            reserved = self.config.get('fresh_reserved_slots', 1)
+            volumes = self.disk_status() if capacity > 0 else {}
+            for video in sorted(self._job_queue.values(), key=self._job_sort_key):
+                if dispatched >= capacity:
+                    break
+                if not self._admit_by_disk_space(video, volumes):
+                    continue  # 该视频的输出磁盘已满，其他磁盘上的任务仍可提交
+                server_url = self.acquire_server(video['path'], 0 if self._is_fresh(video) else reserved)
+                if server_url is None:
+                    continue  # 服务器已满（或剩余名额留给新剧集），后面的新剧集仍可能提交
+                del self._job_queue[video['path']]
+                self._dispatched_paths.add(video['path'])
+                future = self._get_upload_executor().submit(self._upload_worker, video, server_url)
+                future.add_done_callback(lambda f, video=video: self._log_upload_result(video, f))
+                dispatched += 1
+            waiting = len(self._job_queue)
+        if dispatched:
+            logger.info(f"已提交 {dispatched} 个上传任务，{waiting} 个任务在本地队列中等待")
+        elif waiting:
+            logger.debug(f"{waiting} 个任务在本地队列中等待服务器空闲")
+        return dispatched
+    
+    def _volume(self, folder):
+        """文件夹所在的文件系统（st_dev），按文件夹缓存；文件夹不存在时返回 None"""
+        with self.history_lock:
+            if folder in self._volume_of:
+                return self._volume_of[folder]
+        try:
+            volume = os.stat(folder).st_dev
+        except OSError:
+            return None
+        with self.history_lock:
+            self._volume_of[folder] = volume
+        return volume
+    
+    def _estimate_output(self, video_path, target_folder):
+        """预计转换结果占用的空间: (文件系统, 字节数)，按原视频大小 × output_size_factor 估算"""
+        with self.history_lock:
+            cached = self._output_estimates.get(video_path)
+        if cached is not None:
+            return cached
+        try:
+            size = os.path.getsize(video_path)
+        except OSError:
+            size = 0
+        estimate = (self._volume(target_folder), int(size * self.config.get('output_size_factor', 2.0)))
+        with self.history_lock:
+            self._output_estimates[video_path] = estimate
+        return estimate
+    
+    def disk_status(self):
+        """各输出文件系统的空间情况 {st_dev: {'path', 'free', 'total', 'committed'}}。
+        committed 为已上传（等待下载）和正在上传的任务预计还要占用的空间"""
+        with self.history_lock:
+            jobs = {}
+            now = datetime.now()
+            for path in self._pending_paths:
+                info = self.history['uploaded_files'][path]
+                if not self._is_pending_expired(info, now):
+                    jobs[path] = info.get('target_folder') or os.path.dirname(path)
+            for path in self._dispatched_paths:
+                jobs.setdefault(path, os.path.dirname(path))
+            folders = {folder_info['path'] for folder_info in self.config['folders_to_monitor']}
+            # 已结束的任务不再需要估算
+            for path in set(self._output_estimates) - set(jobs):
+                del self._output_estimates[path]
+        
+        volumes = {}
+        for folder in sorted(folders) + sorted(set(jobs.values())):
+            volume = self._volume(folder)
+            if volume is None or volume in volumes:
+                continue
+            try:
+                usage = shutil.disk_usage(folder)
+            except OSError:
+                continue
+            volumes[volume] = {'path': folder, 'free': usage.free, 'total': usage.total, 'committed': 0}
+        for path, target_folder in jobs.items():
+            volume, size = self._estimate_output(path, target_folder)
+            if volume in volumes:
+                volumes[volume]['committed'] += size
+        return volumes
+    
+    def _admit_by_disk_space(self, video, volumes):
+        """输出文件系统的剩余空间减去已提交任务的预计输出后仍高于 disk_reserve_gb 时才提交上传，
+        提交后把该任务的预计输出计入 volumes"""
+        reserve = self.config.get('disk_reserve_gb', 2) * 1024 ** 3
+        if reserve <= 0:
+            return True
+        volume, size = self._estimate_output(video['path'], video['target_folder'])
+        status = volumes.get(volume)
+        if status is None:
+            return True
+        available = status['free'] - status['committed'] - size
+        if available < reserve:
+            if volume not in self._disk_blocked:
+                self._disk_blocked.add(volume)
+                logger.warning(f"输出磁盘空间不足，暂停提交上传: {status['path']} 剩余 {status['free'] / 1024 ** 3:.1f}GB，"
+                               f"已提交任务预计还需 {status['committed'] / 1024 ** 3:.1f}GB")
+            return False
+        if volume in self._disk_blocked:
+            self._disk_blocked.discard(volume)
+            logger.info(f"输出磁盘空间已恢复，继续提交上传: {status['path']}")
+        status['committed'] += size
+        return True
+    
+    def _check_download_space(self, folder, needed, filename):
+        """下载还需写入 needed 字节：写完后剩余空间会低于 disk_reserve_gb 时推迟下载（返回 False）"""
+        reserve = self.config.get('disk_reserve_gb', 2) * 1024 ** 3
+        if reserve <= 0:
+            return True
+        try:
+            free = shutil.disk_usage(folder).free
+        except OSError:
+            return True
+        if free - needed < reserve:
+            with self.history_lock:
+                first = filename not in self._disk_deferred
+                self._disk_deferred.add(filename)
+            if first:
+                logger.warning(f"磁盘剩余空间不足，推迟下载: {filename}（需要 {needed / 1024 ** 3:.1f}GB，"
+                               f"剩余 {free / 1024 ** 3:.1f}GB，保留 {reserve / 1024 ** 3:.1f}GB）")
+            return False
+        with self.history_lock:
+            self._disk_deferred.discard(filename)
+        return True
+    
+    def job_states(self, paths):
+        """视频在本次运行中的处理状态 {路径: queued / uploading / converting / downloaded / skipped / expired / failed}。
+        expired 为已上传超过 pending_expiry_hours 仍未转换完成（服务器多半已丢失该任务）"""
+        states = {}
+        unrecorded = []
+        now = datetime.now()
+        with self.history_lock:
+            for path in paths:
+                info = self.history['uploaded_files'].get(path)
+                if path in self._job_queue:
+                    states[path] = 'queued'
+                elif path in self._dispatched_paths:
+                    states[path] = 'uploading'
+                elif path in self._pending_paths:
+                    states[path] = 'expired' if self._is_pending_expired(info, now) else 'converting'
+                elif info and info.get('status') == 'downloaded':
+                    states[path] = 'downloaded'
+                elif info is None:
+                    unrecorded.append(path)
+                else:
+                    states[path] = 'failed'
+        # 可能需要读取文件计算内容指纹，不持有 history_lock
+        for path in unrecorded:
+            if os.path.isfile(path) and self.is_file_processed(path):
+                states[path] = 'skipped'  # 排队期间发现内容与已处理的文件相同
+            else:
+                states[path] = 'failed'
+        return states
+    
+    def wait_for_jobs(self, paths, timeout=None, report_seconds=60):
+        """等待指定视频全部结束（下载完成、跳过、上传失败或超过 pending_expiry_hours 仍未转换完成）
+        以及字幕提取队列清空，返回 job_states。超时或 stop() 后返回当前状态；
+        每 report_seconds 秒输出一次进度，并处理搁置的字幕提取和限速调整"""
+        deadline = time.monotonic() + timeout if timeout else None
+        last_report = time.monotonic()
+        while True:
+            states = self.job_states(paths)
+            counts = Counter(states.values())
+            active = counts['queued'] + counts['uploading'] + counts['converting']
+            with self.history_lock:
+                subtitles = len(self._subtitle_queued)
+            if not active and not subtitles:
+                self.requeue_subtitle_jobs()
+                with self.history_lock:
+                    if not self._subtitle_queued:
+                        return states
+            if self._stop_event.is_set() or (deadline is not None and time.monotonic() >= deadline):
+                return states
+            if time.monotonic() - last_report >= report_seconds:
+                last_report = time.monotonic()
+                logger.info(f"进度: 已下载 {counts['downloaded']}/{len(paths)}，转换中 {counts['converting']}，"
+                            f"上传中 {counts['uploading']}，排队 {counts['queued']}，失败 {counts['failed'] + counts['expired']}，"
+                            f"等待提取字幕 {subtitles}")
+                self.refresh_rate_limits()
+                self.requeue_subtitle_jobs()
+                self.apply_pending_retention()
+            self._stop_event.wait(1)
+    
+    def _make_video_entry(self, file_path, folder_info):
+        """构造待上传视频的描述"""
+        return {
+            'path': file_path,
+            'folder_info': folder_info,
+            'target_folder': os.path.dirname(file_path)  # 目标文件夹是原文件夹
+        }
+    
+    def _watch_subtree(self, watcher, dir_path, folder_info, folders, check_existing=False):
+        """递归模式下监听 dir_path 及其所有子文件夹（跳过 VR 和 exclude 匹配的文件夹）。
+        check_existing 为 True 时（新建或移入的文件夹）同时检查其中已有的视频"""
+        if not self._scan_allows(folder_info, dir_path, is_dir=True):
+            return
+        for current, dirnames, filenames in os.walk(dir_path):
+            dirnames[:] = [name for name in dirnames
+                           if self._scan_allows(folder_info, os.path.join(current, name), is_dir=True)]
+            if current not in folders:
+                try:
+                    watcher.add_watch(current, watch_subdirs=True)
+                    folders[current] = folder_info
+                except OSError as e:
+                    logger.warning(f"无法监听文件夹 {current}: {e}")
+            if not check_existing:
+                continue
+            for name in filenames:
+                file_path = os.path.join(current, name)
+                if (os.path.splitext(name.lower())[1] in VIDEO_EXTENSIONS
+                        and self._scan_allows(folder_info, file_path)):
+                    self._check_watched_file(file_path, folder_info)
+    
+    def _watch_loop(self, watcher, folders):
+        """监听线程：文件写完关闭或被移入时立即加入上传队列"""
+        while not self._stop_event.is_set():
+            try:
+                events = watcher.read_events(timeout=1.0)
+            except OSError as e:
+                logger.error(f"读取文件夹监听事件失败: {e}")
+                break
+            for folder_path, name, mask in events:
+                if folder_path is None:
+                    # 事件队列溢出，做一次完整扫描补回丢失的事件
+                    logger.warning("文件夹监听事件溢出，执行一次完整扫描")
+                    self.schedule_videos(self.prepare_videos(self.find_new_videos()))
+                    continue
+                file_path = os.path.join(folder_path, name)
+                folder_info = folders[folder_path]
+                if mask & watcher.IN_ISDIR:
+                    # 新建或移入的子文件夹，仅递归模式下处理
+                    if self._scan_rules(folder_info)[0]:
+                        self._watch_subtree(watcher, file_path, folder_info, folders, check_existing=True)
+                    continue
+                if not mask & (watcher.IN_CLOSE_WRITE | watcher.IN_MOVED_TO):
+                    continue
+                if os.path.splitext(name.lower())[1] not in VIDEO_EXTENSIONS:
+                    continue
+                if self._scan_allows(folder_info, file_path):
+                    self._check_watched_file(file_path, folder_info)
+        watcher.close()
+    
+    def _check_watched_file(self, file_path, folder_info):
+        """监听到的文件写入完成（静默期内无变化）后加入上传队列，否则延迟再检查"""
+        with self.history_lock:
+            self._stability_timers.pop(file_path, None)
+        if self._stop_event.is_set() or not os.path.isfile(file_path):
+            return
+        # 先检查是否写完：写入中的文件不计算内容指纹（full 模式下每次都会读取整个文件）
+        if self.is_file_stable(file_path):
+            processed = self.is_file_processed(file_path)
+            self.flush_history()
+            if processed:
+                self._forget_file_stability(file_path)
+            else:
+                logger.info(f"监听到新视频: {file_path}")
+                self.schedule_videos(self.prepare_videos([self._make_video_entry(file_path, folder_info)]))
+            return
+        
+        with self.history_lock:
+            if file_path in self._stability_timers:
+                return  # 已有待执行的检查
+            timer = threading.Timer(self.config.get('file_stable_seconds', 60) + 1,
+                                    self._check_watched_file, args=(file_path, folder_info))
+            timer.daemon = True
+            self._stability_timers[file_path] = timer
+        logger.debug(f"文件仍在写入，{self.config.get('file_stable_seconds', 60)} 秒后再检查: {file_path}")
+        timer.start()
+    
+    def start_folder_watcher(self):
+        """启动文件夹监听（Linux inotify）。不支持或失败时返回 False，仅依靠定时扫描"""
+        watch_mode = self.config.get('watch_mode', 'auto')
+        if watch_mode == 'poll':
+            return False
+        if not InotifyWatcher.is_supported():
+            if watch_mode == 'inotify':
+                logger.warning("当前系统不支持 inotify，使用定时扫描")
+            return False
+        
+        try:
+            watcher = InotifyWatcher()
+        except (OSError, AttributeError) as e:
+            logger.warning(f"初始化 inotify 失败，使用定时扫描: {e}")
+            return False
+        
+        folders = {}
+        for folder_info in self.config['folders_to_monitor']:
+            folder_path = folder_info['path']
+            if self._scan_rules(folder_info)[0]:
+                self._watch_subtree(watcher, folder_path, folder_info, folders)
+                continue
+            try:
+                watcher.add_watch(folder_path)
+                folders[folder_path] = folder_info
+            except OSError as e:
+                logger.warning(f"无法监听文件夹 {folder_path}: {e}")
+        if not folders:
+            watcher.close()
+            return False
+        
+        self._watcher_thread = threading.Thread(target=self._watch_loop, args=(watcher, folders),
+                                                name='folder-watcher', daemon=True)
+        self._watcher_thread.start()
+        logger.info(f"已启动文件夹监听 (inotify): {len(folders)} 个文件夹，定时扫描仍作为补充")
+        return True
+    
     def run_once(self):
         """执行一次完整流程"""
         logger.info("开始执行自动化任务...")
         
+        # 重新排队上次未完成（或因队列已满而搁置）的字幕提取任务
+        self.requeue_subtitle_jobs()
+        self.apply_pending_retention()
+        
         # 1. 查找新视频并上传
-        new_videos = self.find_new_videos()
+        # 探测媒体信息，跳过 3D/SBS 视频并排序
+        new_videos = self.prepare_videos(self.find_new_videos())
         logger.info(f"找到 {len(new_videos)} 个新视频")
         
-        for video in new_videos:
-            try:
-                success = self.upload_video(
-                    video['path'], 
-                    video['folder_info']['additional_args'],
-                    video['target_folder']
-                )
-                if success:
-                    logger.info(f"成功上传: {video['path']}")
-                else:
-                    logger.error(f"上传失败: {video['path']}")
-            except Exception as e:
-                logger.error(f"处理视频失败 {video['path']}: {e}")
+        # 加入本地任务队列，按优先级和服务器空闲名额在后台上传，不在这里等待
+        self.schedule_videos(new_videos)
         
-        # 2. 检查并下载已转换的文件
-        self.check_conversion_status()
+        # 2. 上传进行的同时检查并下载已转换的文件，下载不必等待上传队列清空
+        #    （轮询线程运行时由其负责，这里不再检查）
+        if self._poller_thread is None:
+            self.check_conversion_status()
         
         logger.info("自动化任务执行完成")
     
     def start_scheduler(self):
         """启动定时任务"""
         logger.info(f"启动自动化脚本，监控配置: {self.config_file}")
+        self.start_metrics_exporter()
         
         # 每30分钟检查新视频
         schedule.every(self.config['check_interval_minutes']).minutes.do(self.run_once)
@@ -587,6 +3461,15 @@ class AutoUploadDownload:
         
         logger.info(f"已设置定时任务: 每 {self.config['check_interval_minutes']} 分钟检查一次")
         
+        # 限速按时间段切换，修改配置文件中的限速设置后也在一分钟内生效
+        schedule.every(1).minutes.do(self.refresh_rate_limits)
+        
+        # 状态轮询在独立线程中运行，已转换的文件不必等待下一次扫描
+        self.start_status_poller()
+        
+        # 文件夹监听：新文件写完即上传，定时扫描用于补漏
+        self.start_folder_watcher()
+        
         # 立即执行一次
         self.run_once()
         
@@ -595,12 +3478,12 @@ class AutoUploadDownload:
             schedule.run_pending()
             time.sleep(60)  # 每分钟检查一次
 
-def create_sample_config():
+def create_sample_config(path='auto_config.json'):
     """创建示例配置文件"""
     config = {
         'website_url': 'http://localhost:5000',
         'check_interval_minutes': 30,
-        'download_check_interval_minutes': 30,
+        'download_check_interval_minutes': DEFAULT_DOWNLOAD_CHECK_INTERVAL_MINUTES,
         'folders_to_monitor': [
             {
                 'path': 'D:/videos',
@@ -616,17 +3499,247 @@ def create_sample_config():
         'retry_delay': 10
     }
     
-    with open('auto_config.json', 'w', encoding='utf-8') as f:
+    with open(path, 'w', encoding='utf-8') as f:
         json.dump(config, f, indent=4, ensure_ascii=False)
     
-    print("已创建示例配置文件 auto_config.json")
+    print(f"已创建示例配置文件 {path}")
     print("请根据您的实际情况修改配置文件")
 
-if __name__ == "__main__":
+
+def _format_size(num_bytes):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if abs(num_bytes) < 1024:
+            return f"{num_bytes:.1f}{unit}"
+        num_bytes /= 1024
+    return f"{num_bytes:.1f}TB"
+
+
+def _format_duration(seconds):
+    seconds = int(seconds)
+    return f"{seconds // 3600}小时{seconds % 3600 // 60:02d}分" if seconds >= 3600 else f"{seconds // 60}分{seconds % 60:02d}秒"
+
+
+def build_ingest_plan(auto, paths, folders, args):
+    """扫描、计算指纹并探测给定路径（folders 为对应的 folder_info），返回 (待上传的视频, 计划)"""
+    started = time.monotonic()
+    stats = {'processed': 0, 'unstable': 0}
+    videos = auto.find_new_videos(stats=stats)
+    
+    # 直接指定的单个文件
+    for path, folder_info in zip(paths, folders):
+        if not os.path.isfile(path):
+            continue
+        if not auto.is_file_stable(path):
+            stats['unstable'] += 1
+        elif auto.is_file_processed(path):
+            stats['processed'] += 1
+        else:
+            videos.append(auto._make_video_entry(path, folder_info))
+    
+    found = len(videos)
+    videos = auto.prepare_videos(videos, workers=args.probe_workers)
+    
+    total_bytes = 0
+    total_duration = 0.0
+    folders = {}
+    for video in videos:
+        size = os.path.getsize(video['path'])
+        total_bytes += size
+        info = video.get('media_info')
+        if info and info.get('duration'):
+            total_duration += info['duration']
+        folder = folders.setdefault(video['folder_info']['path'], {'files': 0, 'bytes': 0})
+        folder['files'] += 1
+        folder['bytes'] += size
+    
+    # 传输速率：命令行指定 > 当前生效的限速 > 默认值
+    mb = 1024 * 1024
+    upload_limit, download_limit = auto.current_rate_limits()
+    upload_rate = args.assume_upload_mb * mb if args.assume_upload_mb else (upload_limit or 50 * mb)
+    download_rate = args.assume_download_mb * mb if args.assume_download_mb else (download_limit or 50 * mb)
+    output_bytes = int(total_bytes * auto.config.get('output_size_factor', 2.0))
+    
+    volumes = auto.disk_status()
+    disk = []
+    for volume, status in volumes.items():
+        needed = sum(auto._estimate_output(video['path'], video['target_folder'])[1] for video in videos
+                     if auto._volume(video['target_folder']) == volume)
+        if needed:
+            disk.append({'path': status['path'], 'free': status['free'], 'needed': needed + status['committed'],
+                         'reserve': int(auto.config.get('disk_reserve_gb', 2) * 1024 ** 3)})
+    
+    plan = {
+        'paths': paths,
+        'servers': [server['url'] for server in auto.get_servers()],
+        'files': len(videos),
+        'bytes': total_bytes,
+        'duration_seconds': round(total_duration, 1),
+        'estimated_output_bytes': output_bytes,
+        'skipped': {'processed': stats['processed'], 'writing': stats['unstable'], 'stereo_3d': found - len(videos)},
+        'upload_bytes_per_second': upload_rate,
+        'download_bytes_per_second': download_rate,
+        'estimated_upload_seconds': round(total_bytes / upload_rate, 1),
+        'estimated_download_seconds': round(output_bytes / download_rate, 1),
+        'folders': folders,
+        'disk': disk,
+        'scan_seconds': round(time.monotonic() - started, 2),
+        'videos': [{'path': video['path'], 'bytes': os.path.getsize(video['path']),
+                    'duration': (video.get('media_info') or {}).get('duration')} for video in videos],
+    }
+    return videos, plan
+
+
+def print_ingest_plan(plan):
+    print("=== 导入计划 ===")
+    print(f"服务器: {', '.join(plan['servers'])}")
+    for path, folder in plan['folders'].items():
+        print(f"  {path}: {folder['files']} 个文件, {_format_size(folder['bytes'])}")
+    print(f"待上传: {plan['files']} 个文件, {_format_size(plan['bytes'])}"
+          + (f", 总时长 {_format_duration(plan['duration_seconds'])}" if plan['duration_seconds'] else ""))
+    skipped = plan['skipped']
+    print(f"跳过: 已处理 {skipped['processed']}, 仍在写入 {skipped['writing']}, 3D/SBS {skipped['stereo_3d']}")
+    print(f"预计输出: {_format_size(plan['estimated_output_bytes'])}")
+    for volume in plan['disk']:
+        warning = "（空间不足，部分任务会等待）" if volume['free'] - volume['needed'] < volume['reserve'] else ""
+        print(f"  磁盘 {volume['path']}: 剩余 {_format_size(volume['free'])}, 需要 {_format_size(volume['needed'])}{warning}")
+    print(f"预计传输时间: 上传 {_format_duration(plan['estimated_upload_seconds'])}"
+          f"（{plan['upload_bytes_per_second'] / (1024 * 1024):.1f}MB/s），"
+          f"下载 {_format_duration(plan['estimated_download_seconds'])}"
+          f"（{plan['download_bytes_per_second'] / (1024 * 1024):.1f}MB/s），上传和下载同时进行，不含服务器转换时间")
+    print(f"扫描耗时: {plan['scan_seconds']:.1f} 秒")
+    sys.stdout.flush()
+
+
+def run_ingest(args):
+    """一次性导入: 扫描给定路径、输出计划，然后上传、轮询并下载，直到全部结束。返回退出码"""
+    auto = AutoUploadDownload(args.config)
+    
+    # 给定路径替代配置中的监控文件夹；与已配置的文件夹相同时沿用其设置（优先级、参数、include/exclude 等）
+    configured = {os.path.normpath(folder['path']): folder for folder in auto.config['folders_to_monitor']}
+    paths = [os.path.abspath(path) for path in args.paths]
+    folders = []
+    for path in paths:
+        if not os.path.exists(path):
+            print(f"路径不存在: {path}", file=sys.stderr)
+            auto.close()
+            return 2
+        folder_path = path if os.path.isdir(path) else os.path.dirname(path)
+        folder_info = dict(configured.get(os.path.normpath(folder_path), {}))
+        folder_info['path'] = folder_path
+        folder_info.setdefault('additional_args', '')
+        if args.additional_args is not None:
+            folder_info['additional_args'] = args.additional_args
+        if args.recursive:
+            folder_info['recursive'] = True
+        if args.include:
+            folder_info['include'] = args.include
+        if args.exclude:
+            folder_info['exclude'] = args.exclude
+        if not os.path.isdir(path):
+            folder_info['include'] = [os.path.basename(path)]
+        folders.append(folder_info)
+    auto.config['folders_to_monitor'] = [folder for folder, path in zip(folders, paths) if os.path.isdir(path)]
+    
+    # 命令行参数只影响本次运行，不写回配置文件
+    if args.server:
+        auto.config['servers'] = [{'url': url} for url in args.server]
+    for key, value in (('upload_concurrency', args.upload_concurrency),
+                       ('max_in_flight_per_server', args.max_in_flight),
+                       ('download_segments', args.download_segments),
+                       ('status_poll_min_seconds', args.poll_seconds)):
+        if value is not None:
+            auto.config[key] = value
+    
+    try:
+        videos, plan = build_ingest_plan(auto, paths, folders, args)
+        # 单个文件的 folder_info 只在构建计划时使用
+        auto.config['folders_to_monitor'] = folders
+        print_ingest_plan(plan)
+        if args.plan_json:
+            with open(args.plan_json, 'w', encoding='utf-8') as f:
+                json.dump(plan, f, indent=2, ensure_ascii=False)
+            print(f"计划已写入: {args.plan_json}")
+        if args.dry_run or not videos:
+            return 0
+        
+        started = time.monotonic()
+        auto.start_metrics_exporter()
+        auto.start_status_poller()
+        auto.schedule_videos(videos)
+        job_paths = [video['path'] for video in videos]
+        try:
+            states = auto.wait_for_jobs(job_paths, timeout=args.timeout * 3600 if args.timeout else None,
+                                        report_seconds=args.report_seconds)
+            interrupted = False
+        except KeyboardInterrupt:
+            states = auto.job_states(job_paths)
+            interrupted = True
+        elapsed = time.monotonic() - started
+        
+        counts = Counter(states.values())
+        done_bytes = sum(item['bytes'] for item in plan['videos'] if states.get(item['path']) == 'downloaded')
+        print("=== 导入结果 ===")
+        print(f"已下载 {counts['downloaded']}/{len(job_paths)}，跳过 {counts['skipped']}，"
+              f"失败 {counts['failed'] + counts['expired']}"
+              + (f"（其中 {counts['expired']} 个超过 {auto.config.get('pending_expiry_hours', 24)} 小时仍未转换完成）"
+                 if counts['expired'] else "") + "，"
+              f"未完成 {counts['queued'] + counts['uploading'] + counts['converting']}"
+              + ("（已中断）" if interrupted else ""))
+        print(f"耗时 {_format_duration(elapsed)}，已完成 {_format_size(done_bytes)}"
+              + (f"（{done_bytes / elapsed / (1024 * 1024):.1f}MB/s）" if elapsed > 0 else ""))
+        unfinished = sorted(path for path, state in states.items() if state not in ('downloaded', 'skipped'))
+        for path in unfinished[:20]:
+            print(f"  {states[path]}: {path}")
+        if len(unfinished) > 20:
+            print(f"  ... 另有 {len(unfinished) - 20} 个")
+        if interrupted:
+            return 130
+        return 1 if unfinished else 0
+    finally:
+        auto.stop()
+        auto.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='配合 IW3 Web GUI 使用的自动上传/下载脚本')
+    parser.add_argument('--config', default='auto_config.json', help='配置文件（默认 auto_config.json）')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.add_parser('run', help='定时扫描监控文件夹并自动上传/下载（默认）')
+    
+    ingest = subparsers.add_parser('ingest', help='一次性导入给定路径中的视频，全部完成后退出',
+                                   description='扫描给定文件夹/文件，输出计划后上传、轮询并下载，直到全部结束；'
+                                               '有失败或未完成的文件时以非零状态退出')
+    ingest.add_argument('paths', nargs='+', help='要导入的文件夹或视频文件')
+    ingest.add_argument('--dry-run', action='store_true', help='只输出计划，不上传')
+    ingest.add_argument('--plan-json', help='把计划（含文件列表）写入 JSON 文件')
+    ingest.add_argument('--recursive', action='store_true', help='递归扫描子文件夹')
+    ingest.add_argument('--include', action='append', help='只导入匹配该通配符的视频（可多次指定）')
+    ingest.add_argument('--exclude', action='append', help='跳过匹配该通配符的视频和子文件夹（可多次指定）')
+    ingest.add_argument('--args', dest='additional_args', help='转换附加参数（默认沿用配置）')
+    ingest.add_argument('--server', action='append', help='转换服务器地址（可多次指定，默认沿用配置）')
+    ingest.add_argument('--upload-concurrency', type=int, help='同时上传的文件数')
+    ingest.add_argument('--max-in-flight', type=int, help='每个服务器已上传未下载 + 正在上传的任务数上限')
+    ingest.add_argument('--download-segments', type=int, help='每个文件的下载分段数')
+    ingest.add_argument('--probe-workers', type=int, default=4, help='同时运行的 ffprobe 数（默认 4）')
+    ingest.add_argument('--poll-seconds', type=float, help='有待转换任务时的状态轮询间隔（秒）')
+    ingest.add_argument('--assume-upload-mb', type=float, help='估算时间用的上传速率（MB/s），默认使用限速或 50')
+    ingest.add_argument('--assume-download-mb', type=float, help='估算时间用的下载速率（MB/s），默认使用限速或 50')
+    ingest.add_argument('--timeout', type=float, default=0, help='最长运行时间（小时），0 为不限制')
+    ingest.add_argument('--report-seconds', type=float, default=60, help='进度输出间隔（秒）')
+    
+    args = parser.parse_args(argv)
+    if args.command == 'ingest':
+        return run_ingest(args)
+    
     # 如果没有配置文件，创建示例配置
-    if not os.path.exists('auto_config.json'):
-        create_sample_config()
+    if not os.path.exists(args.config):
+        create_sample_config(args.config)
     
     # 创建自动化实例并启动
-    auto = AutoUploadDownload()
-    auto.start_scheduler()
\ No newline at end of file
+    auto = AutoUploadDownload(args.config)
+    auto.start_scheduler()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
\ No newline at end of file
@@ -0,0 +1,409 @@
+"""
+本地 IW3 Web GUI 模拟服务器，用于在没有 GPU 服务器的情况下测试和压测 auto_upload_download.py。
+
+实现的接口与真实服务器一致：
+  POST /upload                 分块上传（multipart，首块返回 session_id，最后一块合并后加入转换队列）
+  GET  /api/upload_status      查询某个 session 已收到的分块
+  GET  /api/status             已转换文件列表（支持长轮询 wait 参数，附带 queue_depth）
+  GET  /download/<文件名>       下载转换结果，支持单段 Range 请求，可附带 Repr-Digest/Content-Digest
+
+可配置每个请求的延迟、带宽上限、失败注入（5xx、断开连接、下载内容损坏）和转换耗时。
+单独运行: python bench/mock_iw3_server.py --port 5000 --conversion-delay 30
+"""
+import argparse
+import base64
+import hashlib
+import json
+import os
+import random
+import re
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlparse
+
+# 与真实服务器一致的合并完成消息
+UPLOAD_COMPLETE_MESSAGE = '上传并合并完成，已加入转换队列'
+
+BLOCK_SIZE = 256 * 1024
+
+
+def parse_multipart(body, content_type):
+    """解析 multipart/form-data 请求体，返回 {字段名: bytes}"""
+    match = re.search(r'boundary="?([^";]+)"?', content_type or '')
+    if not match:
+        raise ValueError('缺少 multipart boundary')
+    delimiter = b'--' + match.group(1).encode('latin-1')
+    fields = {}
+    for part in body.split(delimiter)[1:]:
+        if part.startswith(b'--'):
+            break
+        headers, _, value = part[2:].partition(b'\r\n\r\n')
+        name = re.search(rb'name="([^"]*)"', headers)
+        if name:
+            fields[name.group(1).decode('utf-8')] = value[:-2]  # 去掉结尾的 \r\n
+    return fields
+
+
+class _Throttle:
+    """按带宽上限节流（字节/秒），0 为不限制"""
+
+    def __init__(self, bytes_per_second):
+        self.bytes_per_second = bytes_per_second
+        self.started = time.monotonic()
+        self.transferred = 0
+
+    def account(self, num_bytes):
+        if not self.bytes_per_second:
+            return
+        self.transferred += num_bytes
+        delay = self.transferred / self.bytes_per_second - (time.monotonic() - self.started)
+        if delay > 0:
+            time.sleep(delay)
+
+
+class MockIW3Server:
+    """在后台线程中运行的模拟服务器，start() 后通过 url 访问"""
+
+    def __init__(self, host='127.0.0.1', port=0, storage_dir=None, latency=0.0, bandwidth_mbps=0.0,
+                 failure_rate=0.0, drop_rate=0.0, conversion_delay=0.0, conversion_slots=1, seed=None,
+                 digest=False, corrupt_rate=0.0):
+        self.latency = latency
+        self.bytes_per_second = bandwidth_mbps * 1024 * 1024 / 8
+        self.failure_rate = failure_rate
+        self.drop_rate = drop_rate
+        self.digest = digest
+        self.corrupt_rate = corrupt_rate
+        self.conversion_delay = conversion_delay
+        self.conversion_slots = max(1, conversion_slots)
+        self.random = random.Random(seed)
+        self._own_storage = storage_dir is None
+        self.storage_dir = storage_dir or tempfile.mkdtemp(prefix='mock_iw3_')
+        os.makedirs(os.path.join(self.storage_dir, 'sessions'), exist_ok=True)
+        os.makedirs(os.path.join(self.storage_dir, 'converted'), exist_ok=True)
+
+        self.sessions = {}  # {session_id: {'filename', 'total_chunks', 'received': set()}}
+        self.converted = []  # 已转换文件名（按完成顺序）
+        self.queue = deque()  # 等待转换的文件名
+        self.converting = 0
+        self.stats = {'requests': 0, 'upload_chunks': 0, 'upload_bytes': 0, 'status_polls': 0,
+                      'downloads': 0, 'download_bytes': 0, 'injected_failures': 0, 'dropped_connections': 0,
+                      'corrupted_responses': 0}
+        self._digests = {}  # {(路径, 大小, 修改时间): Repr-Digest}
+        self.lock = threading.Lock()
+        self.converted_changed = threading.Condition(self.lock)
+        self._stop = threading.Event()
+
+        handler = type('Handler', (_MockHandler,), {'mock': self})
+        self.httpd = ThreadingHTTPServer((host, port), handler)
+        self.httpd.daemon_threads = True
+        self.url = f"http://{host}:{self.httpd.server_address[1]}"
+        self._threads = []
+
+    def start(self):
+        self._threads = [threading.Thread(target=self.httpd.serve_forever, name='mock-http', daemon=True)]
+        self._threads += [threading.Thread(target=self._convert_loop, name=f'mock-gpu-{i}', daemon=True)
+                          for i in range(self.conversion_slots)]
+        for thread in self._threads:
+            thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        with self.lock:
+            self.converted_changed.notify_all()
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        if self._own_storage:
+            shutil.rmtree(self.storage_dir, ignore_errors=True)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    # --- 测试数据准备 ---
+
+    def add_converted_file(self, filename, size):
+        """直接放入一个已转换的文件（稀疏文件），用于下载测试"""
+        with open(os.path.join(self.storage_dir, 'converted', filename), 'wb') as f:
+            f.truncate(size)
+        with self.lock:
+            self.converted.append(filename)
+            self.converted_changed.notify_all()
+
+    def preload_converted(self, filenames):
+        """只在 /api/status 列表中加入文件名（不生成文件），模拟服务器上大量历史转换记录"""
+        with self.lock:
+            self.converted.extend(filenames)
+
+    # --- 模拟转换 ---
+
+    def _convert_loop(self):
+        while not self._stop.is_set():
+            with self.lock:
+                filename = self.queue.popleft() if self.queue else None
+                if filename:
+                    self.converting += 1
+            if filename is None:
+                self._stop.wait(0.01)
+                continue
+            if self.conversion_delay:
+                self._stop.wait(self.conversion_delay)
+            with self.lock:
+                self.converting -= 1
+                self.converted.append(filename)
+                self.converted_changed.notify_all()
+
+    def file_digest(self, path, start=0, length=None):
+        """sha-256 摘要（RFC 9530 格式）；完整文件的结果按大小和修改时间缓存"""
+        stat = os.stat(path)
+        key = (path, stat.st_size, stat.st_mtime_ns)
+        if length is None:
+            with self.lock:
+                if key in self._digests:
+                    return self._digests[key]
+            length = stat.st_size
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            f.seek(start)
+            remaining = length
+            while remaining > 0:
+                block = f.read(min(4 * 1024 * 1024, remaining))
+                if not block:
+                    break
+                digest.update(block)
+                remaining -= len(block)
+        value = f"sha-256=:{base64.b64encode(digest.digest()).decode('ascii')}:"
+        if start == 0 and length == stat.st_size:
+            with self.lock:
+                self._digests[key] = value
+        return value
+
+    def should_fail(self):
+        if self.failure_rate and self.random.random() < self.failure_rate:
+            with self.lock:
+                self.stats['injected_failures'] += 1
+            return True
+        return False
+
+
+class _MockHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    mock = None  # 由 MockIW3Server 设置
+
+    def log_message(self, format, *args):
+        pass
+
+    def _begin(self):
+        with self.mock.lock:
+            self.mock.stats['requests'] += 1
+        if self.mock.latency:
+            time.sleep(self.mock.latency)
+
+    def _send_json(self, obj, status=200):
+        body = json.dumps(obj, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_body(self):
+        remaining = int(self.headers.get('Content-Length', 0))
+        throttle = _Throttle(self.mock.bytes_per_second)
+        parts = []
+        while remaining > 0:
+            block = self.rfile.read(min(BLOCK_SIZE, remaining))
+            if not block:
+                break
+            parts.append(block)
+            remaining -= len(block)
+            throttle.account(len(block))
+        return b''.join(parts)
+
+    def do_POST(self):
+        self._begin()
+        if urlparse(self.path).path != '/upload':
+            self._read_body()
+            return self._send_json({'error': 'not found'}, 404)
+        body = self._read_body()
+        if self.mock.should_fail():
+            return self._send_json({'error': 'injected failure'}, 500)
+        try:
+            fields = parse_multipart(body, self.headers.get('Content-Type'))
+            filename = os.path.basename(fields['filename'].decode('utf-8'))
+            chunk_index = int(fields['chunk_index'])
+            total_chunks = int(fields['total_chunks'])
+            chunk = fields['chunk']
+        except (KeyError, ValueError) as e:
+            return self._send_json({'error': f'bad request: {e}'}, 400)
+
+        mock = self.mock
+        session_id = fields.get('session_id', b'').decode('utf-8') or uuid.uuid4().hex
+        session_dir = os.path.join(mock.storage_dir, 'sessions', session_id)
+        os.makedirs(session_dir, exist_ok=True)
+        with open(os.path.join(session_dir, str(chunk_index)), 'wb') as f:
+            f.write(chunk)
+
+        with mock.lock:
+            session = mock.sessions.setdefault(session_id, {'filename': filename, 'total_chunks': total_chunks,
+                                                            'received': set()})
+            session['received'].add(chunk_index)
+            mock.stats['upload_chunks'] += 1
+            mock.stats['upload_bytes'] += len(chunk)
+            complete = len(session['received']) == total_chunks
+            if complete:
+                del mock.sessions[session_id]
+
+        if not complete:
+            return self._send_json({'session_id': session_id, 'message': f'块 {chunk_index + 1}/{total_chunks} 上传成功'})
+
+        # 合并后加入转换队列
+        with open(os.path.join(mock.storage_dir, 'converted', filename), 'wb') as out:
+            for i in range(total_chunks):
+                with open(os.path.join(session_dir, str(i)), 'rb') as f:
+                    shutil.copyfileobj(f, out, BLOCK_SIZE)
+        shutil.rmtree(session_dir, ignore_errors=True)
+        with mock.lock:
+            mock.queue.append(filename)
+        self._send_json({'session_id': session_id, 'message': UPLOAD_COMPLETE_MESSAGE})
+
+    def do_GET(self):
+        self._begin()
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        if url.path == '/api/status':
+            return self._status(query)
+        if url.path == '/api/upload_status':
+            session_id = query.get('session_id', [''])[0]
+            with self.mock.lock:
+                session = self.mock.sessions.get(session_id)
+                received = sorted(session['received']) if session else None
+            if received is None:
+                return self._send_json({'error': 'unknown session'}, 404)
+            return self._send_json({'session_id': session_id, 'received_chunks': received})
+        if url.path.startswith('/download/'):
+            return self._download(unquote(url.path[len('/download/'):]))
+        self._send_json({'error': 'not found'}, 404)
+
+    def _status(self, query):
+        mock = self.mock
+        wait = float(query.get('wait', ['0'])[0] or 0)
+        with mock.lock:
+            mock.stats['status_polls'] += 1
+            if wait > 0:
+                # 长轮询：等到有新文件转换完成或超时
+                known = len(mock.converted)
+                mock.converted_changed.wait_for(lambda: len(mock.converted) != known or mock._stop.is_set(),
+                                                timeout=wait)
+            converted = list(mock.converted)
+            queue_depth = len(mock.queue) + mock.converting
+        self._send_json({'converted_files': converted, 'queue_depth': queue_depth})
+
+    def _download(self, filename):
+        mock = self.mock
+        path = os.path.join(mock.storage_dir, 'converted', os.path.basename(filename))
+        if not os.path.isfile(path):
+            return self._send_json({'error': 'not found'}, 404)
+        if mock.should_fail():
+            return self._send_json({'error': 'injected failure'}, 503)
+
+        size = os.path.getsize(path)
+        start, end = 0, size - 1
+        range_header = self.headers.get('Range')
+        match = re.fullmatch(r'bytes=(\d*)-(\d*)', range_header or '')
+        if match and (match.group(1) or match.group(2)):
+            if match.group(1):
+                start = int(match.group(1))
+                end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+            else:
+                start = max(0, size - int(match.group(2)))
+            if start >= size or start > end:
+                self.send_response(416)
+                self.send_header('Content-Range', f'bytes */{size}')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+        else:
+            self.send_response(200)
+        length = end - start + 1
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(length))
+        self.send_header('Accept-Ranges', 'bytes')
+        if mock.digest:
+            self.send_header('Repr-Digest', mock.file_digest(path))
+            self.send_header('Content-Digest', mock.file_digest(path, start, length))
+        self.end_headers()
+
+        # 内容损坏注入：翻转第一个数据块的首字节（摘要仍按原始内容计算）
+        corrupt = length > 0 and mock.corrupt_rate and mock.random.random() < mock.corrupt_rate
+        if corrupt:
+            with mock.lock:
+                mock.stats['corrupted_responses'] += 1
+
+        # 连接中断注入：只发送一半后断开
+        drop_at = length // 2 if length > 1 and mock.drop_rate and mock.random.random() < mock.drop_rate else None
+        throttle = _Throttle(mock.bytes_per_second)
+        sent = 0
+        with open(path, 'rb') as f:
+            f.seek(start)
+            while sent < length:
+                block = f.read(min(BLOCK_SIZE, length - sent, (drop_at - sent) if drop_at is not None else BLOCK_SIZE))
+                if not block:
+                    break
+                if corrupt:
+                    block = bytes([block[0] ^ 0xFF]) + block[1:]
+                    corrupt = False
+                self.wfile.write(block)
+                sent += len(block)
+                throttle.account(len(block))
+                if drop_at is not None and sent >= drop_at:
+                    with mock.lock:
+                        mock.stats['dropped_connections'] += 1
+                    self.close_connection = True
+                    return
+        with mock.lock:
+            mock.stats['downloads'] += 1
+            mock.stats['download_bytes'] += sent
+
+
+def main():
+    parser = argparse.ArgumentParser(description='本地 IW3 Web GUI 模拟服务器')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--storage-dir', help='上传和转换结果的存放目录（默认使用临时目录）')
+    parser.add_argument('--latency', type=float, default=0.0, help='每个请求的额外延迟（秒）')
+    parser.add_argument('--bandwidth-mbps', type=float, default=0.0, help='每个连接的带宽上限（Mbit/s），0 为不限制')
+    parser.add_argument('--failure-rate', type=float, default=0.0, help='分块上传/下载请求返回 5xx 的概率')
+    parser.add_argument('--drop-rate', type=float, default=0.0, help='下载传输到一半断开连接的概率')
+    parser.add_argument('--conversion-delay', type=float, default=0.0, help='每个文件的模拟转换耗时（秒）')
+    parser.add_argument('--conversion-slots', type=int, default=1, help='同时转换的文件数')
+    parser.add_argument('--seed', type=int, help='失败注入的随机种子')
+    parser.add_argument('--digest', action='store_true', help='下载响应附带 sha-256 Repr-Digest/Content-Digest')
+    parser.add_argument('--corrupt-rate', type=float, default=0.0, help='下载响应内容被损坏的概率')
+    args = parser.parse_args()
+
+    server = MockIW3Server(args.host, args.port, args.storage_dir, args.latency, args.bandwidth_mbps,
+                           args.failure_rate, args.drop_rate, args.conversion_delay, args.conversion_slots,
+                           args.seed, args.digest, args.corrupt_rate)
+    server.start()
+    print(f"模拟服务器已启动: {server.url}（存储目录 {server.storage_dir}），Ctrl+C 退出")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
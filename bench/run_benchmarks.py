@@ -0,0 +1,393 @@
+"""
+auto_upload_download.py 性能基准测试。
+
+每个场景都在临时目录中运行，并使用本地模拟服务器（mock_iw3_server.py）代替 IW3 Web GUI，
+结果以 JSON 写入 --output，可用 --compare 与之前的结果对比。
+
+场景:
+  scan      扫描包含大量文件的文件夹（首次扫描 / 再次扫描），以及递归扫描已全部处理过的多级媒体库
+  upload    单个大文件在各分块发送方式下的上传吞吐
+  download  单连接与分段下载的吞吐
+  poll      历史记录很多、服务器已转换列表很长时单次状态轮询的开销
+  e2e       多个文件从扫描、上传、服务器转换到下载完成的端到端延迟
+
+用法: python bench/run_benchmarks.py --scenarios scan,upload --scan-files 100000 --output results.json
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+
+BENCH_DIR = Path(__file__).resolve().parent
+sys.path.insert(0, str(BENCH_DIR.parent))
+sys.path.insert(0, str(BENCH_DIR))
+
+from mock_iw3_server import MockIW3Server  # noqa: E402
+
+SCENARIOS = ('scan', 'upload', 'download', 'poll', 'e2e')
+MB = 1024 * 1024
+
+auto_upload_download = None  # 在工作目录中导入（模块导入时会在当前目录创建日志文件）
+
+
+def make_client(workdir, server_url, **overrides):
+    """在 workdir 中创建使用独立配置和历史记录的 AutoUploadDownload 实例"""
+    config = {
+        'website_url': server_url,
+        'history_file': os.path.join(workdir, 'upload_history.json'),
+        'folders_to_monitor': [],
+        'file_stable_seconds': 0,
+        'media_probe': False,
+        'subtitle_extraction': False,
+        'retry_delay': 0.1,
+        'retry_max_delay': 0.5,
+    }
+    config.update(overrides)
+    config_path = os.path.join(workdir, 'auto_config.json')
+    with open(config_path, 'w', encoding='utf-8') as f:
+        json.dump(config, f, ensure_ascii=False)
+    return auto_upload_download.AutoUploadDownload(config_path)
+
+
+def make_file(path, size):
+    """生成指定大小的测试文件：开头写入少量随机数据，其余为稀疏空间"""
+    with open(path, 'wb') as f:
+        f.write(os.urandom(min(size, MB)))
+        f.truncate(size)
+
+
+def mb_per_second(num_bytes, seconds):
+    return round(num_bytes / MB / seconds, 2) if seconds > 0 else None
+
+
+def bench_scan(args):
+    with tempfile.TemporaryDirectory() as workdir:
+        folder = os.path.join(workdir, 'videos')
+        os.makedirs(folder)
+        started = time.perf_counter()
+        for i in range(args.scan_files):
+            open(os.path.join(folder, f'episode_{i:07d}.mp4'), 'wb').close()
+        setup_seconds = time.perf_counter() - started
+
+        client = make_client(workdir, 'http://127.0.0.1:9', history_backend=args.history_backend,
+                             folders_to_monitor=[{'path': folder, 'additional_args': ''}])
+        try:
+            started = time.perf_counter()
+            found = len(client.find_new_videos())
+            cold_seconds = time.perf_counter() - started
+            started = time.perf_counter()
+            client.find_new_videos()
+            warm_seconds = time.perf_counter() - started
+        finally:
+            client.close()
+    result = {
+        'files': args.scan_files,
+        'found': found,
+        'history_backend': args.history_backend,
+        'setup_seconds': round(setup_seconds, 3),
+        'cold_seconds': round(cold_seconds, 3),
+        'warm_seconds': round(warm_seconds, 3),
+        'cold_files_per_second': round(args.scan_files / cold_seconds, 1) if cold_seconds else None,
+        'warm_files_per_second': round(args.scan_files / warm_seconds, 1) if warm_seconds else None,
+    }
+    if args.scan_dirs > 0:
+        result['recursive'] = bench_scan_recursive(args)
+    return result
+
+
+def bench_scan_recursive(args):
+    """文件分布在 scan_dirs 个子文件夹中且都已处理过：再次扫描时只应检查文件夹本身"""
+    with tempfile.TemporaryDirectory() as workdir:
+        folder = os.path.join(workdir, 'library')
+        files_per_dir = max(1, -(-args.scan_files // args.scan_dirs))
+        dirs = []
+        for i in range(args.scan_files):
+            if i % files_per_dir == 0:
+                dirs.append(os.path.join(folder, f'show_{len(dirs):05d}', 'season_01'))
+                os.makedirs(dirs[-1])
+            open(os.path.join(dirs[-1], f'episode_{i:07d}.mp4'), 'wb').close()
+        # 刚修改过的文件夹不会被缓存，把修改时间调到过去
+        past = time.time() - 3600
+        for dir_path in dirs:
+            for path in (dir_path, os.path.dirname(dir_path)):
+                os.utime(path, (past, past))
+        os.utime(folder, (past, past))
+
+        client = make_client(workdir, 'http://127.0.0.1:9', history_backend=args.history_backend,
+                             content_dedup=False,
+                             folders_to_monitor=[{'path': folder, 'additional_args': '', 'recursive': True}])
+        try:
+            started = time.perf_counter()
+            videos = client.find_new_videos()
+            cold_seconds = time.perf_counter() - started
+            # 标记为已下载，模拟已经全部处理过的媒体库
+            for video in videos:
+                client.history['uploaded_files'][video['path']] = {
+                    'file_hash': client.get_file_hash(video['path']), 'status': 'downloaded'}
+            client.save_history()
+            client._rebuild_history_index()
+            client.find_new_videos()  # 更新文件夹缓存中的未处理文件列表
+
+            started = time.perf_counter()
+            client.find_new_videos()
+            processed_seconds = time.perf_counter() - started
+
+            open(os.path.join(dirs[0], 'episode_new.mp4'), 'wb').close()
+            started = time.perf_counter()
+            found = len(client.find_new_videos())
+            changed_seconds = time.perf_counter() - started
+        finally:
+            client.close()
+    return {
+        'dirs': len(dirs),
+        'found_after_change': found,
+        'cold_seconds': round(cold_seconds, 3),
+        'processed_rescan_seconds': round(processed_seconds, 3),
+        'changed_rescan_seconds': round(changed_seconds, 3),
+    }
+
+
+def mock_server(args, **overrides):
+    options = dict(latency=args.latency, bandwidth_mbps=args.bandwidth_mbps, failure_rate=args.failure_rate,
+                   drop_rate=args.drop_rate, conversion_delay=args.conversion_delay, seed=args.seed,
+                   digest=args.digest, corrupt_rate=args.corrupt_rate)
+    options.update(overrides)
+    return MockIW3Server(**options)
+
+
+def bench_upload(args):
+    size = int(args.upload_mb * MB)
+    results = {'file_mb': args.upload_mb, 'modes': {}}
+    for mode in ('sequential', 'readahead', 'parallel'):
+        with tempfile.TemporaryDirectory() as workdir, mock_server(args) as server:
+            video_path = os.path.join(workdir, f'upload_{mode}.mp4')
+            make_file(video_path, size)
+            client = make_client(workdir, server.url, upload_pipeline_mode=mode, history_backend=args.history_backend)
+            try:
+                started = time.perf_counter()
+                success = client.upload_video(video_path, '', workdir, server.url)
+                seconds = time.perf_counter() - started
+            finally:
+                client.close()
+            results['modes'][mode] = {
+                'success': bool(success),
+                'seconds': round(seconds, 3),
+                'mb_per_second': mb_per_second(size, seconds),
+                'chunks_sent': server.stats['upload_chunks'],
+                'injected_failures': server.stats['injected_failures'],
+            }
+    return results
+
+
+def bench_download(args):
+    size = int(args.download_mb * MB)
+    results = {'file_mb': args.download_mb, 'segments': {}}
+    for segments in sorted({1, args.download_segments}):
+        with tempfile.TemporaryDirectory() as workdir, mock_server(args) as server:
+            server.add_converted_file('download.mp4', size)
+            client = make_client(workdir, server.url, download_segments=segments,
+                                 download_min_segment_mb=max(1, args.download_mb // max(1, segments)))
+            try:
+                session = client.get_http_session(server.url)
+                started = time.perf_counter()
+                success = client.download_converted_file(session, 'download.mp4', workdir, server.url)
+                seconds = time.perf_counter() - started
+            finally:
+                client.close()
+            results['segments'][str(segments)] = {
+                'success': bool(success),
+                'seconds': round(seconds, 3),
+                'mb_per_second': mb_per_second(size, seconds),
+                'dropped_connections': server.stats['dropped_connections'],
+                'injected_failures': server.stats['injected_failures'],
+                'corrupted_responses': server.stats['corrupted_responses'],
+            }
+    return results
+
+
+def bench_poll(args):
+    with tempfile.TemporaryDirectory() as workdir, mock_server(args, failure_rate=0, drop_rate=0) as server:
+        client = make_client(workdir, server.url)
+        try:
+            # 已下载的历史记录，服务器已转换列表中也都有这些文件
+            names = [f'old_{i:07d}.mp4' for i in range(args.history_entries)]
+            for name in names:
+                client.set_uploaded_entry(os.path.join(workdir, 'videos', name), {
+                    'url': server.url, 'status': 'downloaded', 'target_folder': workdir,
+                    'uploaded_at': datetime.now().isoformat(), 'session_id': None,
+                })
+            # 等待转换的任务（不在已转换列表中，不会触发下载）
+            for i in range(args.pending_entries):
+                client.set_uploaded_entry(os.path.join(workdir, 'videos', f'pending_{i:05d}.mp4'), {
+                    'url': server.url, 'status': 'uploaded', 'target_folder': workdir,
+                    'uploaded_at': datetime.now().isoformat(), 'session_id': f'session-{i}',
+                })
+            server.preload_converted(names)
+
+            timings = []
+            for _ in range(args.polls):
+                started = time.perf_counter()
+                client.check_conversion_status()
+                timings.append(time.perf_counter() - started)
+        finally:
+            client.close()
+    return {
+        'history_entries': args.history_entries,
+        'pending_entries': args.pending_entries,
+        'polls': args.polls,
+        'mean_ms': round(statistics.mean(timings) * 1000, 3),
+        'median_ms': round(statistics.median(timings) * 1000, 3),
+        'max_ms': round(max(timings) * 1000, 3),
+    }
+
+
+def bench_e2e(args):
+    size = int(args.e2e_mb * MB)
+    with tempfile.TemporaryDirectory() as workdir, mock_server(args) as server:
+        folder = os.path.join(workdir, 'videos')
+        os.makedirs(folder)
+        for i in range(args.e2e_files):
+            make_file(os.path.join(folder, f'e2e_{i:03d}.mp4'), size)
+        client = make_client(workdir, server.url, status_poll_min_seconds=args.poll_interval,
+                             history_backend=args.history_backend,
+                             folders_to_monitor=[{'path': folder, 'additional_args': ''}])
+        try:
+            started_at = datetime.now()
+            started = time.perf_counter()
+            client.start_status_poller()
+            client.run_once()
+            deadline = started + args.timeout
+            while time.perf_counter() < deadline:
+                with client.history_lock:
+                    done = len(client.history['downloaded_files'])
+                if done >= args.e2e_files:
+                    break
+                time.sleep(0.05)
+            total_seconds = time.perf_counter() - started
+            with client.history_lock:
+                latencies = [(datetime.fromisoformat(info['downloaded_at']) - started_at).total_seconds()
+                             for info in client.history['downloaded_files'].values()]
+        finally:
+            client.stop()
+            client.close()
+    return {
+        'files': args.e2e_files,
+        'file_mb': args.e2e_mb,
+        'conversion_delay': args.conversion_delay,
+        'completed': len(latencies),
+        'total_seconds': round(total_seconds, 3),
+        'latency_median_seconds': round(statistics.median(latencies), 3) if latencies else None,
+        'latency_max_seconds': round(max(latencies), 3) if latencies else None,
+        'server_status_polls': server.stats['status_polls'],
+        'server_requests': server.stats['requests'],
+    }
+
+
+def flatten(data, prefix=''):
+    """把嵌套结果展开为 {'scenario.key': 数值}"""
+    flat = {}
+    for key, value in data.items():
+        name = f'{prefix}.{key}' if prefix else key
+        if isinstance(value, dict):
+            flat.update(flatten(value, name))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[name] = value
+    return flat
+
+
+def compare(results, baseline_path, threshold):
+    """与基线结果对比，输出变化超过 threshold 的数值"""
+    with open(baseline_path, 'r', encoding='utf-8') as f:
+        baseline = flatten(json.load(f)['results'])
+    current = flatten(results)
+    for name in sorted(current):
+        old, new = baseline.get(name), current[name]
+        if old and abs(new - old) / abs(old) > threshold:
+            print(f'{name}: {old} -> {new} ({(new - old) / abs(old):+.0%})')
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=BENCH_DIR.parent, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='auto_upload_download.py 性能基准测试')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS), help=f'逗号分隔的场景（{",".join(SCENARIOS)}）')
+    parser.add_argument('--output', default='benchmark_results.json', help='结果 JSON 文件')
+    parser.add_argument('--compare', help='与之前的结果 JSON 对比')
+    parser.add_argument('--compare-threshold', type=float, default=0.1, help='对比时输出的最小变化比例')
+    parser.add_argument('--history-backend', default='json', choices=('json', 'journal', 'sqlite'),
+                        help='历史记录存储方式（默认 json，与脚本默认配置相同）')
+    parser.add_argument('--scan-files', type=int, default=100000)
+    parser.add_argument('--scan-dirs', type=int, default=2000, help='递归扫描测试的子文件夹数，0 为不测试')
+    parser.add_argument('--upload-mb', type=float, default=256)
+    parser.add_argument('--download-mb', type=float, default=256)
+    parser.add_argument('--download-segments', type=int, default=4)
+    parser.add_argument('--history-entries', type=int, default=50000)
+    parser.add_argument('--pending-entries', type=int, default=20)
+    parser.add_argument('--polls', type=int, default=20)
+    parser.add_argument('--e2e-files', type=int, default=6)
+    parser.add_argument('--e2e-mb', type=float, default=16)
+    parser.add_argument('--poll-interval', type=float, default=0.2, help='e2e 场景的状态轮询间隔（秒）')
+    parser.add_argument('--timeout', type=float, default=600, help='e2e 场景的超时时间（秒）')
+    # 模拟服务器参数
+    parser.add_argument('--latency', type=float, default=0.0, help='每个请求的额外延迟（秒）')
+    parser.add_argument('--bandwidth-mbps', type=float, default=0.0, help='每个连接的带宽上限（Mbit/s）')
+    parser.add_argument('--failure-rate', type=float, default=0.0, help='请求返回 5xx 的概率')
+    parser.add_argument('--drop-rate', type=float, default=0.0, help='下载中途断开的概率')
+    parser.add_argument('--digest', action='store_true', help='下载响应附带 Repr-Digest/Content-Digest（测试校验开销）')
+    parser.add_argument('--corrupt-rate', type=float, default=0.0, help='下载响应内容被损坏的概率')
+    parser.add_argument('--conversion-delay', type=float, default=0.5, help='每个文件的模拟转换耗时（秒）')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    scenarios = [name.strip() for name in args.scenarios.split(',') if name.strip()]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f'未知的场景: {", ".join(sorted(unknown))}')
+    output_path = os.path.abspath(args.output)
+    compare_path = os.path.abspath(args.compare) if args.compare else None
+
+    global auto_upload_download
+    workdir = tempfile.mkdtemp(prefix='iw3_bench_')
+    os.chdir(workdir)
+    import auto_upload_download
+    logging.getLogger('auto_upload_download').setLevel(logging.WARNING)
+
+    results = {}
+    for name in scenarios:
+        print(f'运行场景: {name}', file=sys.stderr)
+        started = time.perf_counter()
+        results[name] = globals()[f'bench_{name}'](args)
+        print(f'  {json.dumps(results[name], ensure_ascii=False)} ({time.perf_counter() - started:.1f}s)',
+              file=sys.stderr)
+
+    report = {
+        'timestamp': datetime.now().isoformat(),
+        'git_commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'args': vars(args),
+        'results': results,
+    }
+    with open(output_path, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    print(f'结果已写入: {output_path}（运行日志: {os.path.join(workdir, "auto_upload_download.log")}）', file=sys.stderr)
+    if compare_path:
+        compare(results, compare_path, args.compare_threshold)
+
+
+if __name__ == '__main__':
+    main()